@@ -4,17 +4,59 @@
 
 """
 
+import atexit
 import collections
+import concurrent.futures
+import hashlib
+import json
 import logging
+from multiprocessing import shared_memory
+import os
+import os.path
+import shutil
+import tempfile
 
 import networkx as nx
 import numpy as np
 
 from ntg_common import db_tools
-from ntg_common.db_tools import execute, executemany, executemany_raw
+from ntg_common.db_tools import execute, fetch_arrays, copy_from_arrays, swap_table
 from ntg_common.tools import log
 
 
+PRECO_CHUNK_SIZE = 512
+"""No. of passages the pre-coherence engine processes at once."""
+
+POSTCO_CHUNK_SIZE = 256
+"""No. of passages the post-coherence kernel processes at once."""
+
+POSTCO_BLOCK_SIZE = 1 << 22
+"""Max. no. of (ms x ms x passage) elements the post-coherence kernel processes at once."""
+
+SHARDS_PER_JOB = 4
+"""No. of shards of the manuscript rows to hand to every worker process."""
+
+MAX_COVER_SIZE = 12
+"""Max. no. of ancestors in a set cover.  See :func:`set_cover`."""
+
+Range = collections.namedtuple ('Range', 'rg_id range start end')
+
+SNAPSHOT_VERSION = 3
+"""Version of the on-disk format of :func:`save_params`.  Bump on incompatible changes."""
+
+SNAPSHOT_TABLES = ('apparatus', 'cliques', 'ms_cliques', 'locstem', 'passages', 'manuscripts', 'ranges')
+"""The tables the snapshot of :func:`save_params` depends on."""
+
+MS_ID_A = 1
+"""The ms_id of the virtual manuscript 'A'."""
+
+SNAPSHOT_ARRAYS = ('variant_matrix', 'def_bits', 'mask_matrix', 'explain_matrix',
+                   'source_matrix', 'certain_bits')
+"""The attributes of :class:`CBGM_Params` saved by :func:`save_params`.  Only
+what the API server needs, the labez and def matrices of the coherence kernels
+are not saved."""
+
+
 class CBGM_Params ():
     """ Structure that holds intermediate results of the CBGM. """
 
@@ -40,11 +82,23 @@ class CBGM_Params ():
     labez_matrix = None
     """Integer matrix (mss x passages) of labez.  Each entry represents one reading:
     0 = lacuna, 1 = 'a', 2 = 'b', ...  Used by the pre-coherence computations.
+    The values are computed by the SQL function ord_labez () and always fit
+    into an uint8.
 
     """
 
     def_matrix = None
-    """Boolean matrix (mss x passages) set if ms. is defined at passage."""
+    """Boolean matrix (mss x passages) set if ms. is defined at passage.  Used
+    unpacked by the pre- and post-coherence kernels, which feed it into matrix
+    products and broadcasts.
+
+    """
+
+    def_bits = None
+    """The :attr:`def_matrix` packed into bits (mss x ceil (passages / 8)).
+    See :func:`pack_bits`.  Used by the set cover and for the range lengths.
+
+    """
 
     and_matrix = None
     """Integer matrix (ranges x mss x mss) with counts of the passages that are
@@ -83,6 +137,34 @@ class CBGM_Params ():
 
     """
 
+    mask_matrix = None
+    """Integer matrix (mss x passages) with the bitmask of the reading of each ms.
+    See :func:`build_mask_matrices`.
+
+    """
+
+    explain_matrix = None
+    """Integer matrix (mss x passages) with the bitmask of the reading of each ms.
+    or-ed with the bitmasks of all its prior readings.  Bit 0 is set if the
+    source of the reading is unclear.  Used by the set cover in the API server.
+
+    """
+
+    source_matrix = None
+    """Integer matrix (mss x passages) with the bitmasks of the immediate sources
+    of the reading of each ms.  Bit 0 is set if a source is unclear.  The
+    original reading '*' has no bit, so a reading whose only source is '*' has
+    0 here.  Used by the congruence checks in the API server.
+
+    """
+
+    certain_bits = None
+    """Set if the reading of the ms. at the passage is certain, lacunae
+    included.  Packed into bits like :attr:`def_bits`.  Used by the congruence
+    checks in the API server.
+
+    """
+
 
 def create_labez_matrix (dba, parameters, val):
     """Create the :attr:`labez matrix <scripts.cceh.cbgm.CBGM_Params.labez_matrix>`."""
@@ -108,8 +190,8 @@ def create_labez_matrix (dba, parameters, val):
         WHERE NOT (variant)
         """, parameters)
 
-        for row in res:
-            variant_matrix [0, row[0]] = False
+        pass_ids, = fetch_arrays (res, [np.int32])
+        variant_matrix [0, pass_ids] = False
         val.variant_matrix = variant_matrix
 
         # get no. of manuscripts
@@ -120,7 +202,6 @@ def create_labez_matrix (dba, parameters, val):
         val.n_mss = res.fetchone ()[0]
 
         # get no. of ranges
-        Range = collections.namedtuple ('Range', 'rg_id range start end')
         res = execute (conn, """
         SELECT rg_id, range, MIN (pass_id) - 1 AS first_id, MAX (pass_id) AS last_id
         FROM ranges ch
@@ -135,7 +216,7 @@ def create_labez_matrix (dba, parameters, val):
         # Matrix ms x pass
 
         # Initialize all manuscripts to the labez 'a'
-        labez_matrix  = np.broadcast_to (np.array ([1], np.uint32), (val.n_mss, val.n_passages)).copy ()
+        labez_matrix  = np.broadcast_to (np.array ([1], np.uint8), (val.n_mss, val.n_passages)).copy ()
 
         # overwrite matrix where actual labez is not 'a'
         res = execute (conn, """
@@ -144,8 +225,8 @@ def create_labez_matrix (dba, parameters, val):
         WHERE labez != 'a' AND cbgm
         """, parameters)
 
-        for row in res:
-            labez_matrix [row[0], row[1]] = row[2]
+        ms_ids, pass_ids, labez = fetch_arrays (res, [np.int32, np.int32, np.uint8])
+        labez_matrix [ms_ids, pass_ids] = labez
 
         # clear matrix where reading is uncertain
         res = execute (conn, """
@@ -154,37 +235,432 @@ def create_labez_matrix (dba, parameters, val):
         WHERE certainty != 1.0
         """, parameters)
 
-        for row in res:
-            labez_matrix [row[0], row[1]] = 0
+        ms_ids, pass_ids = fetch_arrays (res, [np.int32, np.int32])
+        labez_matrix [ms_ids, pass_ids] = 0
 
         val.labez_matrix = labez_matrix
 
         # Boolean matrix ms x pass set where passage is defined
         val.def_matrix = np.greater (val.labez_matrix, 0)
         val.def_matrix = np.logical_and (val.def_matrix, val.variant_matrix) # mask invariant passages
+        val.def_bits   = pack_bits (val.def_matrix)
 
         log (logging.INFO, '  Size of the labez matrix: ' + str (val.labez_matrix.shape))
 
 
+def _snapshot_dir (cache_dir, marker):
+    key = hashlib.sha1 (('%d:%s' % (SNAPSHOT_VERSION, marker)).encode ('utf-8')).hexdigest ()
+    return os.path.join (cache_dir, 'cbgm-' + key)
+
+
+def save_params (val, cache_dir, marker):
+    """Save a snapshot of the CBGM parameters to disk.
+
+    Saves the scalars and ranges into a json manifest and every array in
+    :data:`SNAPSHOT_ARRAYS` that is not None into an .npy file.  The snapshot is
+    keyed on a change marker, see :func:`ntg_common.db_tools.change_marker`.
+
+    The snapshot is written into a temporary directory that is then renamed, so
+    other processes never see a half-written snapshot.  Older snapshots are
+    removed.
+
+    :param str cache_dir: the directory that holds the snapshots
+    :param str marker:    the database change marker
+
+    """
+
+    os.makedirs (cache_dir, exist_ok = True)
+    tmp_dir = tempfile.mkdtemp (prefix = '.tmp-', dir = cache_dir)
+
+    arrays = [name for name in SNAPSHOT_ARRAYS if getattr (val, name, None) is not None]
+    manifest = {
+        'version'    : SNAPSHOT_VERSION,
+        'marker'     : marker,
+        'n_mss'      : val.n_mss,
+        'n_passages' : val.n_passages,
+        'ranges'     : [list (r) for r in val.ranges],
+        'arrays'     : arrays,
+    }
+    for name in arrays:
+        np.save (os.path.join (tmp_dir, name + '.npy'), getattr (val, name))
+    with open (os.path.join (tmp_dir, 'manifest.json'), 'w') as fp:
+        json.dump (manifest, fp)
+
+    snapshot_dir = _snapshot_dir (cache_dir, marker)
+    shutil.rmtree (snapshot_dir, ignore_errors = True)
+    try:
+        os.rename (tmp_dir, snapshot_dir)
+    except OSError:
+        # another process was faster
+        shutil.rmtree (tmp_dir, ignore_errors = True)
+        return
+
+    for entry in os.listdir (cache_dir):
+        path = os.path.join (cache_dir, entry)
+        if entry.startswith ('cbgm-') and path != snapshot_dir:
+            shutil.rmtree (path, ignore_errors = True)
+
+    log (logging.INFO, "Saved CBGM snapshot to %s" % snapshot_dir)
+
+
+def load_params (cache_dir, marker):
+    """Load a snapshot of the CBGM parameters from disk.
+
+    The arrays are memory-mapped copy-on-write: all processes that load the
+    same snapshot share the physical pages until one of them writes into an
+    array.
+
+    :param str cache_dir: the directory that holds the snapshots
+    :param str marker:    the current database change marker
+    :return: the :class:`CBGM_Params` or None if there is no valid snapshot
+
+    """
+
+    snapshot_dir = _snapshot_dir (cache_dir, marker)
+    try:
+        with open (os.path.join (snapshot_dir, 'manifest.json')) as fp:
+            manifest = json.load (fp)
+        if manifest['version'] != SNAPSHOT_VERSION or manifest['marker'] != marker:
+            return None
+
+        val = CBGM_Params ()
+        val.n_mss        = manifest['n_mss']
+        val.n_passages   = manifest['n_passages']
+        val.ranges       = [Range._make (r) for r in manifest['ranges']]
+        val.n_ranges     = len (val.ranges)
+        val.range_starts = [r.start for r in val.ranges]
+        val.range_ends   = [r.end   for r in val.ranges]
+        for name in manifest['arrays']:
+            setattr (val, name, np.load (os.path.join (snapshot_dir, name + '.npy'), mmap_mode = 'c'))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    log (logging.INFO, "Loaded CBGM snapshot from %s" % snapshot_dir)
+    return val
+
+
+def _prefix_sum (a):
+    """Prefix sums along the last axis with a leading zero.
+
+    Returns an int64 array with the last axis one longer than a's, so that
+    the sum of a[..., start:end] is cs[..., end] - cs[..., start].
+
+    """
+    cs = np.zeros (a.shape[:-1] + (a.shape[-1] + 1, ), dtype = np.int64)
+    np.cumsum (a, axis = -1, out = cs[..., 1:])
+    return cs
+
+
 def count_by_range (a, range_starts, range_ends):
     """Count true bits in array ranges
 
     Count the bits that are true in multiple ranges of the same array of booleans.
 
+    Works on the last axis of an array of any dimension, so that a whole block
+    of rows (eg. mss. or pairs of mss.) is counted in one pass.  The ranges may
+    overlap.
+
     :param numpy.Array a:      Input array
     :type a: np.Array of np.bool:
     :param int[] range_starts: Starting offsets of the ranges to count.
     :param int[] range_ends:   Ending offsets of the ranges to count.
+    :return: int64 array of shape a.shape[:-1] + (no. of ranges, )
+
+    """
+    cs = _prefix_sum (a)  # cs[..., 0] = 0, cs[..., 1] = a[..., 0], ..., cs[..., n] = total
+    return cs[..., range_ends] - cs[..., range_starts]
+
+
+_POPCOUNT = np.array ([bin (i).count ('1') for i in range (256)], dtype = np.uint8)
+"""Lookup table: the no. of bits set in each byte value."""
+
+
+def pack_bits (a):
+    """Pack a boolean array into bits along the last axis.
+
+    Passage n goes into bit (n % 8) of byte (n // 8).  The packed array takes 1/8
+    of the memory and boolean operations on it touch 1/8 of the bytes.
+
+    :param a: Input array
+    :type a: np.Array of np.bool
+    :return: np.Array of np.uint8
+
+    """
+    return np.packbits (a, axis = -1, bitorder = 'little')
+
+
+def unpack_bits (bits, n):
+    """Unpack an array packed with :func:`pack_bits`.
+
+    :param int n: The length of the last axis of the unpacked array.
+
+    """
+    return np.unpackbits (bits, axis = -1, count = n, bitorder = 'little').astype (np.bool_)
+
+
+def popcount (bits):
+    """Count the bits set in a packed array along the last axis."""
+
+    return _POPCOUNT[bits].sum (axis = -1, dtype = np.int64)
+
+
+def count_bits_by_range (bits, range_starts, range_ends):
+    """Count set bits in ranges of a packed array
+
+    Like :func:`count_by_range` but operates on arrays packed with
+    :func:`pack_bits`.  The ranges need not start or end on a byte boundary.
+    Works on the last axis, so a whole matrix of mss. can be counted at once.
+
+    :param bits: Input array packed with :func:`pack_bits`.
+    :param int[] range_starts: Starting offsets (in bits) of the ranges to count.
+    :param int[] range_ends:   Ending offsets (in bits) of the ranges to count.
+
+    """
+
+    n_bytes = bits.shape[-1]
+    cs = _prefix_sum (_POPCOUNT[bits])
+
+    def prefix (offsets):
+        # no. of bits set before offset: whole bytes + the low bits of the partial byte
+        offsets = np.asarray (offsets, dtype = np.int64)
+        byte    = offsets // 8
+        low     = (1 << (offsets % 8)) - 1
+        partial = bits[..., np.minimum (byte, n_bytes - 1)] & low
+        return cs[..., byte] + _POPCOUNT[partial]
+
+    return prefix (range_ends) - prefix (range_starts)
+
+
+class _SharedArrays ():
+    """A set of numpy arrays in shared memory.
+
+    The creating process calls :meth:`put` to copy arrays into new shared
+    memory blocks and passes :meth:`descriptors` to the worker processes, which
+    in turn call :meth:`attach` to map the same blocks.
+
+    """
+
+    def __init__ (self):
+        self.blocks = dict ()
+        self.arrays = dict ()
+        self.owner  = False
+
+    def put (self, key, a):
+        """Copy the array into a new shared memory block."""
+
+        self.owner = True
+        shm = shared_memory.SharedMemory (create = True, size = max (1, a.nbytes))
+        self.blocks[key] = (shm, a.shape, a.dtype.str)
+        self._view (key)[...] = a
+
+    def get (self, key):
+        """Return a private copy of the shared array."""
+
+        return self._view (key).copy ()
+
+    def descriptors (self):
+        """Return a picklable description of the shared blocks."""
+
+        return { key : (shm.name, shape, dtype) for key, (shm, shape, dtype) in self.blocks.items () }
+
+    @classmethod
+    def attach (cls, descriptors):
+        """Map the blocks created in another process."""
+
+        self = cls ()
+        for key, (name, shape, dtype) in descriptors.items ():
+            shm = shared_memory.SharedMemory (name = name)
+            self.blocks[key] = (shm, shape, dtype)
+            self.arrays[key] = self._view (key)
+        return self
+
+    def close (self):
+        """Close all blocks.  The owner also frees them."""
+
+        # views into the blocks must be gone before we can close them
+        self.arrays.clear ()
+        for shm, dummy_shape, dummy_dtype in self.blocks.values ():
+            shm.close ()
+            if self.owner:
+                shm.unlink ()
+        self.blocks.clear ()
+
+    def _view (self, key):
+        shm, shape, dtype = self.blocks[key]
+        return np.ndarray (shape, dtype, buffer = shm.buf)
+
+
+_worker_val = None
+"""The :class:`CBGM_Params` of a worker process."""
+
+_WORKER_PARAMS = ('labez_matrix', 'def_matrix', 'def_bits', 'mask_matrix', 'explain_matrix')
+"""The shared arrays that go into the :class:`CBGM_Params` of a worker process."""
+
+_worker_shared = None
+"""The :class:`_SharedArrays` of a worker process."""
+
+
+def _worker_init (descriptors, n_mss, n_passages, ranges):
+    """Initialize a worker process of :func:`run_sharded`."""
+
+    global _worker_val, _worker_shared
+
+    _worker_shared = _SharedArrays.attach (descriptors)
+    atexit.register (_worker_shared.close)
+
+    _worker_val = CBGM_Params ()
+    _worker_val.n_mss        = n_mss
+    _worker_val.n_passages   = n_passages
+    _worker_val.n_ranges     = len (ranges)
+    _worker_val.ranges       = ranges
+    for key in _WORKER_PARAMS:
+        setattr (_worker_val, key, _worker_shared.arrays.get (key))
+
+
+def _shards (n_rows, n_shards):
+    """Split n_rows rows into at most n_shards contiguous shards of similar size.
+
+    :return: list of tuples (row_start, row_end)
 
     """
-    cs = np.cumsum (a)    # cs[0] = a[0], cs[1] = cs[0] + a[1], ..., cs[n] = total
-    cs = np.insert (cs, 0, 0)
-    cs_start = cs[range_starts] # get the sums at the range beginnings
-    cs_end   = cs[range_ends]   # get the sums at the range ends
-    return cs_end - cs_start
 
+    bounds = np.linspace (0, n_rows, min (n_rows, n_shards) + 1).astype (int)
+    return [(int (lo), int (hi)) for lo, hi in zip (bounds[:-1], bounds[1:])]
+
+
+def run_sharded (val, jobs, func, inputs, outputs, *args):
+    """Compute the (ranges x mss x mss) matrices in a pool of worker processes.
+
+    The j-rows of the matrices are split into shards.  Every worker process
+    computes whole shards, ie. its rows against all k-rows.  The input arrays
+    and the output matrices are put into shared memory, so that they are not
+    pickled for every worker.  The workers write their rows straight into the
+    shared output matrices.  Since the shards do not overlap no locking is
+    needed and the result is identical to the serial computation.
+
+    :param CBGM_Params val: the CBGM parameters
+    :param int jobs:        the no. of worker processes
+    :param func:            a module-level function called as
+                            func (row_start, row_end, \*args) in the worker.
+                            The worker finds the shared arrays in
+                            _worker_shared.arrays.
+    :param dict inputs:     arrays the workers read.  The labez_matrix,
+                            def_matrix, def_bits, mask_matrix, and
+                            explain_matrix go into the worker's
+                            :class:`CBGM_Params`.
+    :param dict outputs:    arrays the workers write.  Copied back into
+                            the arrays given here when all workers are done.
+    :return: list of the return values of func
 
-def calculate_mss_similarity_preco (_dba, _parameters, val):
+    """
+
+    shared = _SharedArrays ()
+    try:
+        for key, a in inputs.items ():
+            shared.put (key, a)
+        for key, a in outputs.items ():
+            shared.put (key, a)
+
+        with concurrent.futures.ProcessPoolExecutor (
+                max_workers = jobs,
+                initializer = _worker_init,
+                initargs = (shared.descriptors (), val.n_mss, val.n_passages, val.ranges)) as executor:
+            futures = [executor.submit (func, row_start, row_end, *args)
+                       for row_start, row_end in _shards (val.n_mss, jobs * SHARDS_PER_JOB)]
+            results = [f.result () for f in futures]
+
+        for key, a in outputs.items ():
+            a[...] = shared.get (key)
+
+        return results
+    finally:
+        shared.close ()
+
+
+def _preco_worker (row_start, row_end):
+    arrays = _worker_shared.arrays
+    _preco_rows (_worker_val, row_start, row_end, arrays['and_matrix'], arrays['eq_matrix'])
+
+
+def _postco_worker (row_start, row_end, do_checks):
+    arrays = _worker_shared.arrays
+    return _postco_rows (_worker_val, arrays['mask_matrix'], arrays['anc_matrix'],
+                         arrays['quest_matrix'], row_start, row_end,
+                         arrays['ancestor_matrix'], arrays['unclear_matrix'], do_checks)
+
+
+def _range_chunks (ranges, n_passages, chunk_size):
+    """Split the passages into chunks.
+
+    Every chunk lies either completely inside or completely outside of every
+    range, so that a count obtained for the chunk can simply be added to the
+    count of every range that contains it.  Passages that are contained in more
+    than one range (eg. in a chapter and in 'All') are thus processed only once.
+
+    :param list ranges:    list of (named tuple Range)
+    :param int n_passages: the no. of passages
+    :param int chunk_size: the maximum no. of passages in one chunk
+    :return: iterator over tuples (start, end, indices of the containing ranges)
+
+    """
+
+    bounds = sorted (set ([0, n_passages] + [r.start for r in ranges] + [r.end for r in ranges]))
+    for lo, hi in zip (bounds[:-1], bounds[1:]):
+        indices = [i for i, r in enumerate (ranges) if r.start <= lo and hi <= r.end]
+        for start in range (lo, hi, chunk_size):
+            yield start, min (hi, start + chunk_size), indices
+
+
+def _preco_chunk (labez, defined, rows):
+    """Calculate the pre-coherence counts of some mss. in a chunk of passages.
+
+    The count of the passages defined in both mss. is the matrix product of the
+    def matrix with its transpose.  To count the equal passages we one-hot
+    encode the readings: we build a boolean matrix with one column for each
+    reading at each passage that is set if the ms. offers that reading.  The
+    product of this matrix with its transpose counts the readings two mss.
+    have in common.
+
+    float32 represents all integers up to 2**24 exactly, which is plenty for a
+    chunk.
+
+    :param labez:   the (mss x chunk) slice of the labez matrix
+    :param defined: the (mss x chunk) slice of the def matrix
+    :param rows:    the slice of the mss. to compare against all mss.
+    :return: tuple of two (rows x mss) uint16 matrices (and, eq)
+
+    """
+
+    def_f = defined.astype (np.float32)
+    and_chunk = np.dot (def_f[rows], def_f.T)
+
+    labez = np.where (defined, labez, 0)
+    columns = [labez == l for l in np.unique (labez) if l > 0]
+    if columns:
+        onehot = np.concatenate (columns, axis = 1)
+        onehot = onehot[:, onehot.any (axis = 0)].astype (np.float32)
+        eq_chunk = np.dot (onehot[rows], onehot.T)
+    else:
+        eq_chunk = np.zeros_like (and_chunk)
+
+    return and_chunk.astype (np.uint16), eq_chunk.astype (np.uint16)
+
+
+def _preco_rows (val, row_start, row_end, and_matrix, eq_matrix):
+    """Calculate the rows row_start to row_end of the and and eq matrices."""
+
+    rows = slice (row_start, row_end)
+    for start, end, indices in _range_chunks (val.ranges, val.n_passages, PRECO_CHUNK_SIZE):
+        if not indices:
+            continue
+        and_chunk, eq_chunk = _preco_chunk (val.labez_matrix[:, start:end],
+                                            val.def_matrix[:, start:end], rows)
+        for i in indices:
+            and_matrix[i, rows] += and_chunk
+            eq_matrix[i, rows]  += eq_chunk
+
+
+def calculate_mss_similarity_preco (_dba, _parameters, val, jobs = 1):
     r"""Calculate pre-coherence mss similarity
 
     The pre-coherence similarity is defined as:
@@ -204,6 +680,8 @@ def calculate_mss_similarity_preco (_dba, _parameters, val):
 
         --VGA/VG05_all3.pl
 
+    :param int jobs: the no. of worker processes to use.  See :func:`run_sharded`.
+
     """
 
     # Matrix range x ms x ms with count of the passages that are defined in both mss
@@ -216,24 +694,259 @@ def calculate_mss_similarity_preco (_dba, _parameters, val):
     val.range_ends   = [ch.end   for ch in val.ranges]
 
     # pre-genealogical coherence outputs symmetrical matrices
-    # loop over all mss O(n_mss² * n_ranges * n_passages)
+    #
+    # Instead of looping over all pairs of mss. we compute the counts for all
+    # pairs at once as matrix products over chunks of passages.  The counts of
+    # a chunk are then added to every range that contains the chunk.
+
+    if jobs > 1:
+        run_sharded (val, jobs, _preco_worker,
+                     dict (labez_matrix = val.labez_matrix, def_matrix = val.def_matrix),
+                     dict (and_matrix = val.and_matrix, eq_matrix = val.eq_matrix))
+    else:
+        _preco_rows (val, 0, val.n_mss, val.and_matrix, val.eq_matrix)
+
+    # a ms. is not compared to itself
+    for i in range (0, val.n_ranges):
+        np.fill_diagonal (val.and_matrix[i], 0)
+        np.fill_diagonal (val.eq_matrix[i], 0)
+
 
-    for j in range (0, val.n_mss):
-        labezj = val.labez_matrix[j]
-        defj   = val.def_matrix[j]
+def _postco_older_than_A (mask_matrix, anc_matrix):
+    """Sanity test: log all mss. that have a reading older than the reading of 'A'."""
 
-        for k in range (j + 1, val.n_mss):
-            labezk = val.labez_matrix[k]
-            defk   = val.def_matrix[k]
+    n_mss = mask_matrix.shape[0]
+    n_rows = max (1, POSTCO_BLOCK_SIZE // max (1, mask_matrix.shape[1]))
+    for k0 in range (1, n_mss, n_rows):
+        k1 = min (n_mss, k0 + n_rows)
+        varidk_is_older = np.bitwise_and (mask_matrix[k0:k1], anc_matrix[0]) > 0
+        for k in np.nonzero (varidk_is_older.any (axis = 1))[0]:
+            log (logging.ERROR, "Found varid older than A in msid: %d = %s"
+                 % (k0 + k, np.nonzero (varidk_is_older[k])))
 
-            def_and  = np.logical_and (defj, defk)
-            labez_eq = np.logical_and (def_and, np.equal (labezj, labezk))
 
-            val.and_matrix[:,j,k] = val.and_matrix[:,k,j] = count_by_range (def_and, val.range_starts, val.range_ends)
-            val.eq_matrix[:,j,k]  = val.eq_matrix[:,k,j]  = count_by_range (labez_eq, val.range_starts, val.range_ends)
+def _postco_rows (val, mask_matrix, anc_matrix, quest_matrix, row_start, row_end,
+                  ancestor_matrix, unclear_matrix, do_checks):
+    """The post-coherence kernel.
 
+    Calculates the rows row_start to row_end of the ancestor and unclear
+    matrices.  The rows are processed in tiles of j rows.  Each tile is compared
+    to all k rows at once by broadcasting the (tile x 1 x passages) mask matrix
+    against the (1 x mss x passages) ancestor matrix.  To keep the temporary
+    (tile x mss x passages) arrays small the passages are processed in chunks.
 
-def calculate_mss_similarity_postco (dba, parameters, val, do_checks = True):
+    :return: the set of passages with loops in the local stemma
+
+    """
+
+    local_stemmas_with_loops = set ()
+
+    n_tile = max (1, POSTCO_BLOCK_SIZE // (val.n_mss * POSTCO_CHUNK_SIZE))
+
+    for start, end, indices in _range_chunks (val.ranges, val.n_passages, POSTCO_CHUNK_SIZE):
+        mask    = mask_matrix[:, start:end]
+        anc     = anc_matrix[:, start:end]
+        quest   = quest_matrix[:, start:end] > 0
+        defined = val.def_matrix[:, start:end]
+        labez   = val.labez_matrix[:, start:end]
+
+        for j0 in range (row_start, row_end, n_tile):
+            j1 = min (row_end, j0 + n_tile)
+            # See: VGA/VGActs_allGenTab3Ph3.pl
+
+            # set bit if the reading of j is ancestral to the reading of k
+            varidj_is_older = np.bitwise_and (mask[j0:j1, None], anc[None]) > 0
+            varidk_is_older = np.bitwise_and (mask[None], anc[j0:j1, None]) > 0
+
+            # error check for loops
+            if do_checks:
+                check = np.logical_and (varidj_is_older, varidk_is_older)
+                if np.any (check):
+                    not_check       = np.logical_not (check)
+                    varidj_is_older = np.logical_and (varidj_is_older, not_check)
+                    varidk_is_older = np.logical_and (varidk_is_older, not_check)
+
+                    local_stemmas_with_loops |= set (
+                        int (start + n) for n in np.nonzero (check.any (axis = (0, 1)))[0])
+
+            if not indices:
+                continue
+
+            # wenn die vergl. Hss. von einander abweichen u. eine von ihnen
+            # Q1 = '?' hat, UND KEINE VON IHNEN QUELLE DER ANDEREN IST, ist
+            # die Beziehung 'UNCLEAR'
+
+            unclear = np.logical_and (defined[j0:j1, None], defined[None])
+            unclear &= np.not_equal (labez[j0:j1, None], labez[None])
+            unclear &= np.logical_or (quest[j0:j1, None], quest[None])
+            unclear &= np.logical_not (np.logical_or (varidj_is_older, varidk_is_older))
+
+            n_older   = np.count_nonzero (varidj_is_older, axis = 2).astype (np.uint16)
+            n_unclear = np.count_nonzero (unclear, axis = 2).astype (np.uint16)
+            for i in indices:
+                ancestor_matrix[i, j0:j1] += n_older
+                unclear_matrix[i, j0:j1]  += n_unclear
+
+    return local_stemmas_with_loops
+
+
+def _local_stemma_masks (conn, pass_id, begadr, endadr, do_checks):
+    """Load a local stemma and build the bitmasks of its readings.
+
+    See :func:`calculate_mss_similarity_postco` for an explanation of the
+    bitmasks.  Every node of the returned graph gets the attributes 'mask',
+    'parents', and 'ancestors'.
+
+    :return: the graph or None if the stemma is unusable
+
+    """
+
+    G = db_tools.local_stemma_to_nx (conn, pass_id, True) # True == add isolated roots
+
+    if do_checks:
+        # sanity tests
+        # connect the graph through a root node for the following tests:
+        G.add_node ('root', label = 'root')
+        G.add_edge ('root', '*')
+        G.add_edge ('root', '?')
+        if not nx.is_weakly_connected (G):
+            # use it anyway
+            log (logging.WARNING, "Local Stemma @ %s-%s is not connected (pass_id=%s)." %
+                 (begadr, endadr, pass_id))
+        if not nx.is_directed_acyclic_graph (G):
+            # don't use these
+            log (logging.ERROR, "Local Stemma @ %s-%s is not a directed acyclic graph (pass_id=%s)." %
+                 (begadr, endadr, pass_id))
+            return None
+        # ... and remove it again
+        G.remove_node ('root')
+
+    G.nodes['*']['mask'] = 0
+    G.nodes['?']['mask'] = 1 # bitmask == 1 signifies source is unclear
+
+    # build node bitmasks.  Every node gets a different bit set.
+    i = 1
+    for n in sorted (G.nodes ()):
+        attrs = G.nodes[n]
+        attrs['parents'] = 0
+        attrs['ancestors'] = 0
+        if 'mask' not in attrs:
+            i += 1
+            if i < 64:
+                attrs['mask'] = (1 << i)
+            else:
+                attrs['mask'] = 0
+                # mask is 64 bit only
+                log (logging.ERROR, "Too many cliques in local stemma @ %s-%s (pass_id=%s)." %
+                     (begadr, endadr, pass_id))
+
+    # build the parents bit mask. We set the bits of the parent nodes.
+    for n in G:
+        mask = G.nodes[n]['mask']
+        for succ in G.successors (n):
+            G.nodes[succ]['parents'] |= mask
+
+    # build the ancestors mask.  We set the bits of all node ancestors.
+    TC = nx.transitive_closure (G)
+    for n in TC:
+        # transitive_closure does not copy attributes !
+        mask = G.nodes[n]['mask']
+        for succ in TC.successors (n):
+            G.nodes[succ]['ancestors'] |= mask
+
+    return G
+
+
+def build_mask_matrices (conn, parameters, n_mss, pass_ids, do_checks = True):
+    """Build the bitmask matrices of some passages from their local stemmata.
+
+    See :func:`calculate_mss_similarity_postco` for an explanation of the
+    bitmasks.
+
+    :param int n_mss:       the no. of manuscripts
+    :param list pass_ids:   the passages to build, column i is pass_ids[i]
+    :param bool do_checks:  check the local stemmas for sanity
+    :return: tuple of three (mss x len (pass_ids)) uint64 matrices with the
+             bitmasks of the reading, of its parents and of its ancestors
+
+    """
+
+    pass_ids = list (pass_ids)
+    columns = { pass_id : i for i, pass_id in enumerate (pass_ids) }
+
+    res = execute (conn, """
+    SELECT pass_id, begadr, endadr FROM passages
+    WHERE pass_id = ANY (:pass_ids)
+    ORDER BY pass_id
+    """, dict (parameters, pass_ids = pass_ids))
+
+    stemmas = dict ()
+    for pass_id, begadr, endadr in res.fetchall ():
+        G = _local_stemma_masks (conn, pass_id, begadr, endadr, do_checks)
+        if G is not None:
+            stemmas[pass_id] = G
+
+    # Matrix mss x passages containing the bitmask of the current reading
+    mask_matrix     = np.zeros ((n_mss, len (pass_ids)), np.uint64)
+    # Matrix mss x passages containing the bitmask of the parent readings
+    parent_matrix   = np.zeros ((n_mss, len (pass_ids)), np.uint64)
+    # Matrix mss x passages containing the bitmask of the ancestral readings
+    ancestor_matrix = np.zeros ((n_mss, len (pass_ids)), np.uint64)
+
+    # load ms x pass
+    res = execute (conn, """
+    SELECT pass_id,
+           ms_id - 1 AS ms_id,
+           labez_clique (labez, clique) AS labez_clique
+    FROM apparatus_cliques_view a
+    WHERE pass_id = ANY (:pass_ids) AND labez !~ '^z[u-z]' AND cbgm
+    ORDER BY pass_id
+    """, dict (parameters, pass_ids = pass_ids))
+
+    LocStemEd = collections.namedtuple ('LocStemEd', 'pass_id ms_id labez_clique')
+    rows = list (map (LocStemEd._make, res))
+
+    error_count = 0
+    for row in rows:
+        try:
+            attrs = stemmas[row.pass_id].nodes[row.labez_clique]
+            col = columns[row.pass_id]
+            mask_matrix     [row.ms_id, col] = attrs['mask']
+            parent_matrix   [row.ms_id, col] = attrs['parents']
+            ancestor_matrix [row.ms_id, col] = attrs['ancestors']
+        except KeyError:
+            error_count += 1
+
+    if error_count and do_checks:
+        log (logging.WARNING, "Could not find labez and clique in LocStem in %d cases." % error_count)
+
+    return mask_matrix, parent_matrix, ancestor_matrix
+
+
+def update_passage_masks (conn, parameters, val, pass_id):
+    """Update the :attr:`CBGM_Params.mask_matrix`,
+    :attr:`CBGM_Params.explain_matrix`, :attr:`CBGM_Params.source_matrix` and
+    :attr:`CBGM_Params.def_bits` after an edit of a local stemma.
+
+    The def bits change if the edit changed the reading of 'A', see
+    :func:`update_A_text`.  The editor already refuses stemmas with cycles, so
+    we skip the checks.
+
+    """
+
+    mask, parents, ancestors = build_mask_matrices (conn, parameters, val.n_mss, [pass_id], False)
+    val.mask_matrix[:, pass_id - 1]    = mask[:, 0]
+    val.explain_matrix[:, pass_id - 1] = mask[:, 0] | ancestors[:, 0]
+    if val.source_matrix is not None:
+        val.source_matrix[:, pass_id - 1] = parents[:, 0]
+    if val.def_bits is not None:
+        _labez, defined = _passage_labez_matrix (conn, parameters, pass_id)
+        byte, bit = divmod (pass_id - 1, 8)
+        val.def_bits[:, byte] &= np.uint8 (~(1 << bit) & 0xff)
+        val.def_bits[:, byte] |= defined[:, 0].astype (np.uint8) << bit
+
+
+def calculate_mss_similarity_postco (dba, parameters, val, do_checks = True, jobs = 1):
     """Calculate post-coherence mss similarity
 
     Genealogical coherence outputs asymmetrical matrices.
@@ -370,115 +1083,22 @@ def calculate_mss_similarity_postco (dba, parameters, val, do_checks = True):
     Reversing the role of the two manuscripts (mask_matrix and ancestor_matrix)
     gives us the number of posterior readings.
 
+    :param bool do_checks: check the local stemmas for sanity
+    :param int jobs:       the no. of worker processes to use.  See :func:`run_sharded`.
+
     """
 
     with dba.engine.begin () as conn:
 
-        # Load all passages into memory
-
-        res = execute (conn, """
-        SELECT pass_id, begadr, endadr FROM passages
-        ORDER BY pass_id
-        """, parameters)
-
-        stemmas = dict ()
-        for pass_id, begadr, endadr in res.fetchall ():
-            G = db_tools.local_stemma_to_nx (conn, pass_id, True) # True == add isolated roots
-
-            if do_checks:
-                # sanity tests
-                # connect the graph through a root node for the following tests:
-                G.add_node ('root', label = 'root')
-                G.add_edge ('root', '*')
-                G.add_edge ('root', '?')
-                if not nx.is_weakly_connected (G):
-                    # use it anyway
-                    log (logging.WARNING, "Local Stemma @ %s-%s is not connected (pass_id=%s)." %
-                         (begadr, endadr, pass_id))
-                if not nx.is_directed_acyclic_graph (G):
-                    # don't use these
-                    log (logging.ERROR, "Local Stemma @ %s-%s is not a directed acyclic graph (pass_id=%s)." %
-                         (begadr, endadr, pass_id))
-                    continue
-                # ... and remove it again
-                G.remove_node ('root')
-
-            G.nodes['*']['mask'] = 0
-            G.nodes['?']['mask'] = 1 # bitmask == 1 signifies source is unclear
-
-            # build node bitmasks.  Every node gets a different bit set.
-            i = 1
-            for n in sorted (G.nodes ()):
-                attrs = G.nodes[n]
-                attrs['parents'] = 0
-                attrs['ancestors'] = 0
-                if 'mask' not in attrs:
-                    i += 1
-                    if i < 64:
-                        attrs['mask'] = (1 << i)
-                    else:
-                        attrs['mask'] = 0
-                        # mask is 64 bit only
-                        log (logging.ERROR, "Too many cliques in local stemma @ %s-%s (pass_id=%s)." %
-                             (begadr, endadr, pass_id))
-
-            # build the parents bit mask. We set the bits of the parent nodes.
-            for n in G:
-                mask = G.nodes[n]['mask']
-                for succ in G.successors (n):
-                    G.nodes[succ]['parents'] |= mask
-
-            # build the ancestors mask.  We set the bits of all node ancestors.
-            TC = nx.transitive_closure (G)
-            for n in TC:
-                # transitive_closure does not copy attributes !
-                mask = G.nodes[n]['mask']
-                for succ in TC.successors (n):
-                    G.nodes[succ]['ancestors'] |= mask
-
-            # save the graph for later
-            stemmas[pass_id - 1] = G
-
-        # Matrix mss x passages containing the bitmask of the current reading
-        mask_matrix     = np.zeros ((val.n_mss, val.n_passages), np.uint64)
-        # Matrix mss x passages containing the bitmask of the parent readings
-        parent_matrix   = np.zeros ((val.n_mss, val.n_passages), np.uint64)
-        # Matrix mss x passages containing the bitmask of the ancestral readings
-        ancestor_matrix = np.zeros ((val.n_mss, val.n_passages), np.uint64)
-
-        # load ms x pass
-        res = execute (conn, """
-        SELECT pass_id - 1 AS pass_id,
-               ms_id   - 1 AS ms_id,
-               labez_clique (labez, clique) AS labez_clique
-        FROM apparatus_cliques_view a
-        WHERE labez !~ '^z[u-z]' AND cbgm
-        ORDER BY pass_id
-        """, parameters)
-
-        LocStemEd = collections.namedtuple ('LocStemEd', 'pass_id ms_id labez_clique')
-        rows = list (map (LocStemEd._make, res))
+        mask_matrix, parent_matrix, ancestor_matrix = build_mask_matrices (
+            conn, parameters, val.n_mss, range (1, val.n_passages + 1), do_checks)
 
         # If ((current bitmask of ms j) and (ancestor bitmask of ms k) > 0) then
         # ms j is an ancestor of ms k.
 
-        error_count = 0
-        for row in rows:
-            try:
-                attrs = stemmas[row.pass_id].nodes[row.labez_clique]
-                mask_matrix     [row.ms_id, row.pass_id] = attrs['mask']
-                parent_matrix   [row.ms_id, row.pass_id] = attrs['parents']
-                ancestor_matrix [row.ms_id, row.pass_id] = attrs['ancestors']
-            except KeyError:
-                error_count += 1
-                # print (row.pass_id + 1)
-                # print (str (e))
-
         # Matrix mss x passages containing True if source is unclear (s1 = '?')
         quest_matrix = np.bitwise_and (parent_matrix, 1)  # 1 means source unclear
 
-        if error_count:
-            log (logging.WARNING, "Could not find labez and clique in LocStem in %d cases." % error_count)
         log (logging.DEBUG, "mask:\n"      + str (mask_matrix))
         log (logging.DEBUG, "parents:\n"   + str (parent_matrix))
         log (logging.DEBUG, "ancestors:\n" + str (ancestor_matrix))
@@ -486,55 +1106,357 @@ def calculate_mss_similarity_postco (dba, parameters, val, do_checks = True):
 
         def postco (mask_matrix, anc_matrix):
 
-            local_stemmas_with_loops = set ()
-
             # Matrix range x ms x ms with count of the passages that are older in ms1 than in ms2
             ancestor_matrix = np.zeros ((val.n_ranges, val.n_mss, val.n_mss), dtype = np.uint16)
 
             # Matrix range x ms x ms with count of the passages whose relationship is unclear in ms1 and ms2
             unclear_matrix  = np.zeros ((val.n_ranges, val.n_mss, val.n_mss), dtype = np.uint16)
 
-            for j in range (0, val.n_mss):
-                for k in range (0, val.n_mss):
-                    # See: VGA/VGActs_allGenTab3Ph3.pl
+            _postco_older_than_A (mask_matrix, anc_matrix)
+
+            if jobs > 1:
+                local_stemmas_with_loops = set ().union (*run_sharded (
+                    val, jobs, _postco_worker,
+                    dict (labez_matrix = val.labez_matrix, def_matrix = val.def_matrix,
+                          mask_matrix = mask_matrix, anc_matrix = anc_matrix,
+                          quest_matrix = quest_matrix),
+                    dict (ancestor_matrix = ancestor_matrix, unclear_matrix = unclear_matrix),
+                    do_checks))
+            else:
+                local_stemmas_with_loops = _postco_rows (
+                    val, mask_matrix, anc_matrix, quest_matrix, 0, val.n_mss,
+                    ancestor_matrix, unclear_matrix, do_checks)
 
-                    # set bit if the reading of j is ancestral to the reading of k
-                    varidj_is_older = np.bitwise_and (mask_matrix[j], anc_matrix[k]) > 0
-                    varidk_is_older = np.bitwise_and (mask_matrix[k], anc_matrix[j]) > 0
+            if local_stemmas_with_loops:
+                log (logging.ERROR, "Found loops in local stemmata: %s" % sorted (local_stemmas_with_loops))
 
-                    if j == 0 and k > 0 and varidk_is_older.any ():
-                        log (logging.ERROR, "Found varid older than A in msid: %d = %s"
-                             % (k, np.nonzero (varidk_is_older)))
+            return ancestor_matrix, unclear_matrix
 
-                    # error check for loops
-                    if do_checks:
-                        check = np.logical_and (varidj_is_older, varidk_is_older)
-                        if np.any (check):
-                            not_check       = np.logical_not (check)
-                            varidj_is_older = np.logical_and (varidj_is_older, not_check)
-                            varidk_is_older = np.logical_and (varidk_is_older, not_check)
+        val.parent_matrix,   val.unclear_parent_matrix   = postco (mask_matrix, parent_matrix)
+        val.ancestor_matrix, val.unclear_ancestor_matrix = postco (mask_matrix, ancestor_matrix)
 
-                            local_stemmas_with_loops |= set (np.nonzero (check)[0])
+        # keep the masks for the set cover and the congruence checks
+        val.mask_matrix    = mask_matrix
+        val.explain_matrix = np.bitwise_or (mask_matrix, ancestor_matrix)
+        val.source_matrix  = parent_matrix
+        create_certain_bits (conn, parameters, val)
 
-                    # wenn die vergl. Hss. von einander abweichen u. eine von ihnen
-                    # Q1 = '?' hat, UND KEINE VON IHNEN QUELLE DER ANDEREN IST, ist
-                    # die Beziehung 'UNCLEAR'
 
-                    unclear = np.logical_and (val.def_matrix[j], val.def_matrix[k])
-                    unclear = np.logical_and (unclear, np.not_equal (val.labez_matrix[j], val.labez_matrix[k]))
-                    unclear = np.logical_and (unclear, np.logical_or (quest_matrix[j], quest_matrix[k]))
-                    unclear = np.logical_and (unclear, np.logical_not (np.logical_or (varidj_is_older, varidk_is_older)))
+def _passage_labez_matrix (conn, parameters, pass_id):
+    """Read the labez and def matrices of one passage.
 
-                    ancestor_matrix[:,j,k] = count_by_range (varidj_is_older, val.range_starts, val.range_ends)
-                    unclear_matrix[:,j,k]  = count_by_range (unclear, val.range_starts, val.range_ends)
+    This is :func:`create_labez_matrix` restricted to a single passage.
 
-            if local_stemmas_with_loops:
-                log (logging.ERROR, "Found loops in local stemmata: %s" % sorted (local_stemmas_with_loops))
+    :return: tuple of two (mss x 1) matrices (labez, def)
 
-            return ancestor_matrix, unclear_matrix
+    """
 
-        val.parent_matrix,   val.unclear_parent_matrix   = postco (mask_matrix, parent_matrix)
-        val.ancestor_matrix, val.unclear_ancestor_matrix = postco (mask_matrix, ancestor_matrix)
+    res = execute (conn, """
+    SELECT count (*)
+    FROM manuscripts
+    """, parameters)
+    n_mss = res.fetchone ()[0]
+
+    res = execute (conn, """
+    SELECT variant
+    FROM passages
+    WHERE pass_id = :pass_id
+    """, dict (parameters, pass_id = pass_id))
+    variant = res.fetchone ()[0]
+
+    labez_matrix = np.ones ((n_mss, 1), np.uint8)
+
+    res = execute (conn, """
+    SELECT ms_id - 1, ord_labez (labez) as labez
+    FROM apparatus a
+    WHERE pass_id = :pass_id AND labez != 'a' AND cbgm
+    """, dict (parameters, pass_id = pass_id))
+
+    for row in res:
+        labez_matrix [row[0], 0] = row[1]
+
+    res = execute (conn, """
+    SELECT DISTINCT ms_id - 1
+    FROM apparatus
+    WHERE pass_id = :pass_id AND certainty != 1.0
+    """, dict (parameters, pass_id = pass_id))
+
+    for row in res:
+        labez_matrix [row[0], 0] = 0
+
+    return labez_matrix, np.logical_and (np.greater (labez_matrix, 0), variant)
+
+
+def calculate_passage_counts (conn, parameters, pass_id, do_checks = True):
+    """Calculate the pre- and post-coherence counts of one passage.
+
+    This is :func:`calculate_mss_similarity_preco` and
+    :func:`calculate_mss_similarity_postco` restricted to a single passage.  It
+    reads the current state of the database, including the uncommitted changes
+    of the current transaction.  See :func:`update_affinity_table`.
+
+    The pre-coherence counts change only if the reading of 'A' changes, see
+    :func:`update_A_text`.  The diagonal of the common matrix is not cleared:
+    it tells whether the ms. is defined at the passage, which
+    :func:`update_affinity_table` needs for the length of the ms. ranges.
+
+    :return: tuple of six (mss x mss) uint16 matrices (common, equal,
+             ancestor, unclear_ancestor, parent, unclear_parent)
+
+    """
+
+    labez_matrix, def_matrix = _passage_labez_matrix (conn, parameters, pass_id)
+    n_mss = labez_matrix.shape[0]
+
+    common, equal = _preco_chunk (labez_matrix, def_matrix, slice (0, n_mss))
+    np.fill_diagonal (equal, 0)
+    result = [common, equal]
+
+    val = CBGM_Params ()
+    val.n_mss      = n_mss
+    val.n_passages = 1
+    val.n_ranges   = 1
+    val.ranges     = [Range (None, None, 0, 1)]
+    val.labez_matrix = labez_matrix
+    val.def_matrix   = def_matrix
+
+    mask_matrix, parent_matrix, ancestor_matrix = build_mask_matrices (
+        conn, parameters, n_mss, [pass_id], do_checks)
+
+    quest_matrix = np.bitwise_and (parent_matrix, 1)
+
+    for anc_matrix in (ancestor_matrix, parent_matrix):
+        older   = np.zeros ((1, n_mss, n_mss), dtype = np.uint16)
+        unclear = np.zeros ((1, n_mss, n_mss), dtype = np.uint16)
+        _postco_rows (val, mask_matrix, anc_matrix, quest_matrix, 0, n_mss, older, unclear, do_checks)
+        result += [older[0], unclear[0]]
+
+    return tuple (result)
+
+
+def update_A_text (conn, parameters, pass_id):
+    """Update the reading of 'A' at one passage after an edit of its local stemma.
+
+    This is :func:`build_A_text <scripts.cceh.cbgm.build_A_text>` restricted to
+    a single passage.  Call it in the transaction of the edit, before
+    :func:`calculate_passage_counts`.  The write goes through
+    apparatus_cliques_view and its triggers keep the materialized apparatus up
+    to date.
+
+    :return: True if the reading of 'A' changed
+
+    """
+
+    params = dict (parameters, ms_id = MS_ID_A, pass_id = pass_id)
+
+    res = execute (conn, """
+    SELECT CASE WHEN p.fehlvers THEN 'zu' ELSE COALESCE (l.labez,  'zz') END,
+           CASE WHEN p.fehlvers THEN '1'  ELSE COALESCE (l.clique, '1')  END
+    FROM passages p
+    LEFT JOIN locstem l ON (l.pass_id, l.source_labez) = (p.pass_id, '*')
+    WHERE p.pass_id = :pass_id
+    """, params)
+    labez, clique = res.fetchone ()
+
+    res = execute (conn, """
+    SELECT labez, clique
+    FROM apparatus_cliques_view
+    WHERE (ms_id, pass_id) = (:ms_id, :pass_id)
+    """, params)
+    if [tuple (row) for row in res] == [(labez, clique)]:
+        return False
+
+    execute (conn, """
+    DELETE FROM apparatus_cliques_view
+    WHERE (ms_id, pass_id) = (:ms_id, :pass_id);
+    INSERT INTO apparatus_cliques_view (ms_id, pass_id, labez, clique, cbgm, origin, lesart)
+    VALUES (:ms_id, :pass_id, :labez, :clique, true, 'LOC', NULL)
+    """, dict (params, labez = labez, clique = clique))
+
+    log (logging.INFO, "Set the reading of 'A' at pass_id %d to %s%s." % (pass_id, labez, clique))
+    return True
+
+
+def update_affinity_table (conn, parameters, pass_id, old, new):
+    """Update the affinity table after an edit of a local stemma.
+
+    Instead of rerunning the whole CBGM we apply the difference between the
+    counts of the edited passage before and after the edit to all ranges that
+    contain the passage.
+
+    The common and equal columns depend on the readings only.  They change if
+    the edit changed the reading of 'A', see :func:`update_A_text`.  Then we
+    also recalculate the affinity column, fix the length of the ms. ranges,
+    and insert or delete the rows of the pairs of mss. that gained or lost
+    their only passage in common.
+
+    :param int pass_id: the edited passage
+    :param tuple old:   the counts before the edit as returned by :func:`calculate_passage_counts`
+    :param tuple new:   the counts after the edit
+    :return: the no. of changed rows
+
+    """
+
+    common, equal, ancestor, unclear, parent, unclear_parent = [
+        n.astype (np.int32) - o.astype (np.int32) for o, n in zip (old, new)
+    ]
+
+    # the diagonal tells if the ms. is defined, see calculate_passage_counts ()
+    length = np.diagonal (common).copy ()
+    np.fill_diagonal (common, 0)
+
+    deltas = [common, equal, ancestor, ancestor.T, unclear, parent, parent.T, unclear_parent]
+
+    params = dict (parameters, pass_id = pass_id)
+
+    ms_ids = np.nonzero (length)[0]
+    if len (ms_ids):
+        execute (conn, """
+        DROP TABLE IF EXISTS ms_ranges_delta;
+        CREATE TEMPORARY TABLE ms_ranges_delta (
+          ms_id  INTEGER,
+          length INTEGER
+        ) ON COMMIT DROP
+        """, parameters)
+
+        copy_from_arrays (conn, 'ms_ranges_delta', [('ms_id', '>i4'), ('length', '>i4')],
+                          [[ms_ids + 1, length[ms_ids]]])
+
+        execute (conn, """
+        UPDATE ms_ranges mr
+        SET length = mr.length + d.length
+        FROM ms_ranges_delta d, ranges ch, passages p
+        WHERE mr.ms_id = d.ms_id
+          AND mr.rg_id = ch.rg_id
+          AND ch.passage @> p.passage
+          AND p.pass_id = :pass_id
+        """, params)
+
+    j, k = np.nonzero (np.logical_or.reduce ([d != 0 for d in deltas]))
+    if len (j) == 0:
+        return 0
+
+    execute (conn, """
+    DROP TABLE IF EXISTS affinity_delta;
+    CREATE TEMPORARY TABLE affinity_delta (
+      ms_id1    INTEGER,
+      ms_id2    INTEGER,
+      common    INTEGER,
+      equal     INTEGER,
+      older     INTEGER,
+      newer     INTEGER,
+      unclear   INTEGER,
+      p_older   INTEGER,
+      p_newer   INTEGER,
+      p_unclear INTEGER
+    ) ON COMMIT DROP
+    """, parameters)
+
+    columns = ['ms_id1', 'ms_id2', 'common', 'equal',
+               'older', 'newer', 'unclear', 'p_older', 'p_newer', 'p_unclear']
+    copy_from_arrays (conn, 'affinity_delta', [(c, '>i4') for c in columns],
+                      [[j + 1, k + 1] + [d[j, k] for d in deltas]])
+
+    res = execute (conn, """
+    UPDATE affinity aff
+    SET affinity  = CASE WHEN aff.common + d.common > 0
+                         THEN (aff.equal + d.equal)::float / (aff.common + d.common)
+                         ELSE 0 END,
+        common    = aff.common    + d.common,
+        equal     = aff.equal     + d.equal,
+        older     = aff.older     + d.older,
+        newer     = aff.newer     + d.newer,
+        unclear   = aff.unclear   + d.unclear,
+        p_older   = aff.p_older   + d.p_older,
+        p_newer   = aff.p_newer   + d.p_newer,
+        p_unclear = aff.p_unclear + d.p_unclear
+    FROM affinity_delta d, ranges ch, passages p
+    WHERE (aff.ms_id1, aff.ms_id2) = (d.ms_id1, d.ms_id2)
+      AND aff.rg_id = ch.rg_id
+      AND ch.passage @> p.passage
+      AND p.pass_id = :pass_id
+    """, params)
+    rowcount = res.rowcount
+
+    if common.any ():
+        # the cbgm.py script writes rows only for mss. with passages in common
+        res = execute (conn, """
+        DELETE FROM affinity aff
+        USING affinity_delta d, ranges ch, passages p
+        WHERE (aff.ms_id1, aff.ms_id2) = (d.ms_id1, d.ms_id2)
+          AND aff.rg_id = ch.rg_id
+          AND ch.passage @> p.passage
+          AND p.pass_id = :pass_id
+          AND aff.common = 0
+        """, params)
+        rowcount += res.rowcount
+
+        res = execute (conn, """
+        INSERT INTO affinity (rg_id, ms_id1, ms_id2, affinity, common, equal,
+                              older, newer, unclear, p_older, p_newer, p_unclear)
+        SELECT ch.rg_id, d.ms_id1, d.ms_id2, d.equal::float / d.common, d.common, d.equal,
+               d.older, d.newer, d.unclear, d.p_older, d.p_newer, d.p_unclear
+        FROM affinity_delta d, ranges ch, passages p
+        WHERE ch.passage @> p.passage
+          AND p.pass_id = :pass_id
+          AND d.common > 0
+          AND NOT EXISTS (
+            SELECT 1 FROM affinity aff
+            WHERE (aff.rg_id, aff.ms_id1, aff.ms_id2) = (ch.rg_id, d.ms_id1, d.ms_id2)
+          )
+        """, params)
+        rowcount += res.rowcount
+
+    log (logging.INFO, "Updated %d rows of the affinity table for pass_id %d." % (rowcount, pass_id))
+    return rowcount
+
+
+AFFINITY_COLUMNS = [
+    ('rg_id',     '>i4'),
+    ('ms_id1',    '>i4'),
+    ('ms_id2',    '>i4'),
+    ('affinity',  '>f8'),
+    ('common',    '>i4'),
+    ('equal',     '>i4'),
+    ('older',     '>i4'),
+    ('newer',     '>i4'),
+    ('unclear',   '>i4'),
+    ('p_older',   '>i4'),
+    ('p_newer',   '>i4'),
+    ('p_unclear', '>i4'),
+]
+"""The columns of the affinity table and their binary COPY types."""
+
+
+def _affinity_batches (val):
+    """Build the rows of the affinity table, one batch for each range.
+
+    There is a row for every pair of different mss. with passages in common.
+
+    :return: iterator over lists of column arrays in the order of :data:`AFFINITY_COLUMNS`
+
+    """
+
+    not_diagonal = np.logical_not (np.eye (val.n_mss, dtype = np.bool_))
+
+    for i, range_ in enumerate (val.ranges):
+        j, k = np.nonzero (np.logical_and (val.and_matrix[i] > 0, not_diagonal))
+        common = val.and_matrix[i, j, k]
+        equal  = val.eq_matrix[i, j, k]
+        yield [
+            np.full (len (j), range_.rg_id),
+            j + 1,
+            k + 1,
+            equal / common,
+            common,
+            equal,
+            val.ancestor_matrix[i, j, k],
+            val.ancestor_matrix[i, k, j],
+            val.unclear_ancestor_matrix[i, j, k],
+            val.parent_matrix[i, j, k],
+            val.parent_matrix[i, k, j],
+            val.unclear_parent_matrix[i, j, k],
+        ]
 
 
 def write_affinity_table (dba, parameters, val):
@@ -557,58 +1479,283 @@ def write_affinity_table (dba, parameters, val):
             log (logging.ERROR, "norel < 0 in mss. %s"
                  % (np.nonzero (np.less (norel_matrix, 0))))
 
-        # calculate ranges lengths using numpy
-        params = []
-        for i in range (0, val.n_mss):
-            for range_ in val.ranges:
-                length = int (np.sum (val.def_matrix[i, range_.start:range_.end]))
-                params.append ( { 'ms_id': i + 1, 'range': range_.rg_id, 'length': length } )
+        # calculate the range lengths of all mss. at once
+        lengths = count_bits_by_range (val.def_bits,
+                                       [r.start for r in val.ranges],
+                                       [r.end   for r in val.ranges])   # mss x ranges
+        ms_ids, rg_ids = np.meshgrid (np.arange (1, val.n_mss + 1),
+                                      [r.rg_id for r in val.ranges], indexing = 'ij')
+
+        execute (conn, """
+        CREATE TEMPORARY TABLE ms_ranges_length (
+          rg_id  INTEGER,
+          ms_id  INTEGER,
+          length INTEGER
+        ) ON COMMIT DROP
+        """, parameters)
 
-        executemany (conn, """
-        UPDATE ms_ranges
-        SET length = :length
-        WHERE ms_id = :ms_id AND rg_id = :range
-        """, parameters, params)
+        copy_from_arrays (conn, 'ms_ranges_length', [('rg_id', '>i4'), ('ms_id', '>i4'), ('length', '>i4')],
+                          [[rg_ids.ravel (), ms_ids.ravel (), lengths.ravel ()]])
+
+        execute (conn, """
+        UPDATE ms_ranges mr
+        SET length = l.length
+        FROM ms_ranges_length l
+        WHERE (mr.ms_id, mr.rg_id) = (l.ms_id, l.rg_id)
+        """, parameters)
 
         log (logging.INFO, "  Filling Affinity table ...")
 
-        # execute (conn, "TRUNCATE affinity", parameters) # fast but needs access exclusive lock
-        execute (conn, "DELETE FROM affinity", parameters)
-
-        for i, range_ in enumerate (val.ranges):
-            values = []
-            for j in range (0, val.n_mss):
-                for k in range (0, val.n_mss):
-                    if j != k:
-                        common = int (val.and_matrix[i,j,k])
-                        equal  = int (val.eq_matrix[i,j,k])
-                        if common > 0:
-                            values.append ( (
-                                range_.rg_id,
-                                j + 1,
-                                k + 1,
-                                float (equal) / common,
-                                common,
-                                equal,
-                                int (val.ancestor_matrix[i,j,k]),
-                                int (val.ancestor_matrix[i,k,j]),
-                                int (val.unclear_ancestor_matrix[i,j,k]),
-                                int (val.parent_matrix[i,j,k]),
-                                int (val.parent_matrix[i,k,j]),
-                                int (val.unclear_parent_matrix[i,j,k]),
-                            ) )
-
-            # speed gain for using executemany_raw: 65s to 55s :-(
-            # probably the bottleneck here is string formatting with %s
-            executemany_raw (conn, """
-            INSERT INTO affinity (rg_id, ms_id1, ms_id2,
-                                  affinity, common, equal,
-                                  older, newer, unclear,
-                                  p_older, p_newer, p_unclear)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, parameters, values)
+        # Fill a shadow table without indices, then swap it for the old one.
+        # Readers see the old table until we commit.
+        execute (conn, """
+        DROP TABLE IF EXISTS affinity_new;
+        CREATE TABLE affinity_new (LIKE affinity INCLUDING DEFAULTS);
+        """, parameters)
+
+        copy_from_arrays (conn, 'affinity_new', AFFINITY_COLUMNS, _affinity_batches (val))
+
+        log (logging.INFO, "  Swapping Affinity table ...")
+        swap_table (conn, 'affinity', 'affinity_new', parameters)
 
         log (logging.DEBUG, "eq:"        + str (val.eq_matrix))
         log (logging.DEBUG, "ancestor:"  + str (val.ancestor_matrix))
         log (logging.DEBUG, "unclear:"   + str (val.unclear_ancestor_matrix))
         log (logging.DEBUG, "and:"       + str (val.and_matrix))
+
+
+def create_certain_bits (conn, parameters, val):
+    """Create the :attr:`CBGM_Params.certain_bits`."""
+
+    res = execute (conn, """
+    SELECT DISTINCT ms_id - 1, pass_id - 1
+    FROM apparatus
+    WHERE certainty = 1.0
+    """, parameters)
+
+    ms_ids, pass_ids = fetch_arrays (res, [np.int32, np.int32])
+    certain_matrix = np.zeros ((val.n_mss, val.n_passages), dtype = np.bool_)
+    certain_matrix[ms_ids, pass_ids] = True
+    val.certain_bits = pack_bits (certain_matrix)
+
+
+def create_set_cover_params (dba, cache_dir = None):
+    """Create the :class:`CBGM_Params` needed by :func:`set_cover`.
+
+    These are the :attr:`CBGM_Params.def_bits`, the
+    :attr:`CBGM_Params.mask_matrix` and the :attr:`CBGM_Params.explain_matrix`.
+    The API server also uses them for the congruence checks, which need the
+    :attr:`CBGM_Params.source_matrix` and the :attr:`CBGM_Params.certain_bits`.
+
+    If cache_dir is given, first try to load a snapshot from there, and save a
+    snapshot there after building the matrices.  See: :func:`save_params`.
+
+    """
+
+    with dba.engine.begin () as conn:
+        val = None
+        if cache_dir:
+            marker = db_tools.change_marker (conn, SNAPSHOT_TABLES)
+            val = load_params (cache_dir, marker)
+            if (val is not None and val.def_bits is not None and val.explain_matrix is not None
+                    and val.source_matrix is not None and val.certain_bits is not None):
+                return val
+
+        if val is None or val.def_bits is None:
+            # load all attestations into one big numpy array
+            val = CBGM_Params ()
+            create_labez_matrix (dba, {}, val)
+
+        # The mss x passages matrices containing the bitmask of the reading of
+        # each ms. and the bitmask of the reading and all its prior readings.
+        # See: :func:`calculate_mss_similarity_postco`
+        mask_matrix, parent_matrix, ancestor_matrix = build_mask_matrices (
+            conn, {}, val.n_mss, range (1, val.n_passages + 1))
+        val.mask_matrix    = mask_matrix
+        val.explain_matrix = np.bitwise_or (mask_matrix, ancestor_matrix)
+        val.source_matrix  = parent_matrix
+        create_certain_bits (conn, {}, val)
+
+        if cache_dir:
+            save_params (val, cache_dir, marker)
+
+        # we need only the packed def matrix, free the rest
+        val.labez_matrix = None
+        val.def_matrix   = None
+
+    return val
+
+
+def potential_ancestors (conn, parameters, rg_id, n_mss):
+    """Load the potential ancestors of all mss. in a range.
+
+    :return: boolean matrix (mss x mss) that is TRUE if ms. k is a potential
+             ancestor of ms. j
+
+    """
+
+    res = execute (conn, """
+    SELECT ms_id1 - 1, ms_id2 - 1
+    FROM affinity_p_view
+    WHERE rg_id = :rg_id AND common > 0 AND older < newer
+    """, dict (parameters, rg_id = rg_id))
+
+    j, k = fetch_arrays (res, [np.int32, np.int32])
+    candidates = np.zeros ((n_mss, n_mss), dtype = np.bool_)
+    candidates[j, k] = True
+    return candidates
+
+
+CoverStep = collections.namedtuple (
+    'CoverStep', 'n ms_id explains explained equal post unknown open'
+)
+"""One step of a set cover.  ms_id is the numpy index of the chosen ancestor."""
+
+
+def set_cover (val, ms_id, candidates, passages = None, pre_selected = (), max_size = MAX_COVER_SIZE):
+    """Approximate the minimum set cover of a manuscript by its potential ancestors.
+
+    A greedy algorithm: in every step choose the ancestor that agrees with the
+    ms. in most of the still unexplained passages.  The passages explained by
+    the ancestor, either by agreement or by being posterior to it, are then
+    removed.
+
+    See: https://en.wikipedia.org/wiki/Set_cover_problem
+
+    :param int ms_id:      the ms. to explain (numpy index)
+    :param candidates:     boolean array (mss), TRUE for the mss. to choose from
+    :param passages:       the passages to consider packed into bits, or None
+                           for all passages
+    :param pre_selected:   numpy indices of mss. to choose first
+    :param int max_size:   the max. no. of steps
+    :return: list of :class:`CoverStep`
+
+    """
+
+    # All the matrices below are packed into bits.  See: :func:`pack_bits`.
+
+    b_defined = val.def_bits[ms_id]
+    if passages is not None:
+        b_defined = np.bitwise_and (b_defined, passages)
+
+    # Only the rows of the candidates.  The matrix that is TRUE whenever the
+    # inspected ms. and the source ms. are both defined.
+    rows = np.flatnonzero (candidates)
+    b_common = np.bitwise_and (val.def_bits[rows], b_defined)
+
+    mask_matrix          = val.mask_matrix[rows]
+    explain_matrix       = val.explain_matrix[ms_id]
+    explain_equal_matrix = val.mask_matrix[ms_id]
+
+    # The matrix that is TRUE whenever the inspected ms. agrees with the
+    # potential source ms.
+    b_equal = pack_bits (np.bitwise_and (mask_matrix, explain_equal_matrix) > 0)
+    b_equal = np.bitwise_and (b_equal, b_common)
+
+    # The matrix that is TRUE whenever the inspected ms. agrees with the
+    # potential source ms. or is posterior to it.
+    b_post = pack_bits (np.bitwise_and (mask_matrix, explain_matrix) > 0)
+    b_post = np.bitwise_and (b_post, b_common)
+
+    # The passages that are still unexplained.
+    b_open = np.copy (b_defined)
+
+    # The passages where the source of the reading in the inspected ms. is
+    # unknown.
+    b_unknown = pack_bits (np.bitwise_and (explain_matrix, 0x1) > 0)
+    b_unknown = np.bitwise_and (b_unknown, b_open)
+
+    steps = []
+    n_explained = 0
+
+    for n in range (0, max_size):
+        if n < len (pre_selected):
+            # use manuscript pre-selected by user
+            found = np.flatnonzero (rows == pre_selected[n])
+            if len (found) == 0:
+                break
+            i = int (found[0])
+        elif len (rows) > 0:
+            # find manuscript that explains the most passages by agreement
+            counts = popcount (b_equal)
+            if counts.max () == 0:
+                # No candidate agrees anywhere.  Fall back to 'A' if it is a
+                # candidate, else stop.
+                found = np.flatnonzero (rows == 0)
+                if len (found) == 0:
+                    break
+                i = int (found[0])
+            else:
+                i = int (np.argmax (counts))
+        else:
+            break
+
+        b_explained = np.copy (b_post[i])
+        n_explains = int (popcount (b_explained))
+        # exit if no passages could be explained
+        if n_explains == 0:
+            break
+
+        n_equal = int (popcount (b_equal[i]))
+
+        # remove "explained" readings, so they will not be matched again
+        b_unexplained = np.invert (b_explained)
+        b_post    &= b_unexplained
+        b_equal   &= b_unexplained
+        b_unknown &= b_unexplained
+        b_open    &= b_unexplained
+
+        n_explained += n_explains
+        n_unknown = int (popcount (b_unknown))
+        n_open    = int (popcount (b_open))
+
+        steps.append (CoverStep (n + 1, int (rows[i]), n_explains, n_explained,
+                                 n_equal, n_explains - n_equal, n_unknown, n_open - n_unknown))
+
+    return steps
+
+
+def _cover_worker (row_start, row_end, max_size):
+    arrays = _worker_shared.arrays
+    steps  = arrays['steps']
+    for ms_id in range (row_start, row_end):
+        if arrays['selected'][ms_id]:
+            for step in set_cover (_worker_val, ms_id, arrays['candidates'][ms_id],
+                                   arrays['passages'], (), max_size):
+                steps[ms_id, step.n - 1] = step
+
+
+def set_covers (val, ms_ids, candidates, passages = None, max_size = MAX_COVER_SIZE, jobs = 1):
+    """Calculate the set covers of many manuscripts.
+
+    :param ms_ids:     the mss. to explain (numpy indices)
+    :param candidates: boolean matrix (mss x mss) that is TRUE if ms. k may be
+                       used to explain ms. j.  See :func:`potential_ancestors`.
+    :param passages:   the passages to consider packed into bits, or None
+                       for all passages
+    :param int jobs:   the no. of worker processes to use.  See :func:`run_sharded`.
+    :return: iterator over tuples (ms_id, list of :class:`CoverStep`)
+
+    """
+
+    if jobs <= 1:
+        for ms_id in ms_ids:
+            yield ms_id, set_cover (val, ms_id, candidates[ms_id], passages, (), max_size)
+        return
+
+    if passages is None:
+        passages = pack_bits (np.ones (val.n_passages, dtype = np.bool_))
+    selected = np.zeros (val.n_mss, dtype = np.bool_)
+    selected[ms_ids] = True
+    steps = np.zeros ((val.n_mss, max_size, len (CoverStep._fields)), dtype = np.int32)
+
+    run_sharded (
+        val, jobs, _cover_worker,
+        dict (def_bits = val.def_bits, mask_matrix = val.mask_matrix,
+              explain_matrix = val.explain_matrix, candidates = candidates,
+              selected = selected, passages = passages),
+        dict (steps = steps),
+        max_size)
+
+    for ms_id in ms_ids:
+        yield ms_id, [CoverStep._make (int (x) for x in step) for step in steps[ms_id] if step[0] > 0]
@@ -5,7 +5,7 @@ we need for doing the CBGM and running the application server.
 
 """
 
-from sqlalchemy import String, Integer, Float, Boolean, DateTime, Column, Index, ForeignKey
+from sqlalchemy import String, Integer, BigInteger, Float, Boolean, DateTime, Column, Index, ForeignKey
 from sqlalchemy import UniqueConstraint, CheckConstraint, ForeignKeyConstraint, PrimaryKeyConstraint
 from sqlalchemy.dialects.postgresql import TSTZRANGE
 from sqlalchemy.ext import compiler
@@ -929,6 +929,76 @@ class MsCliques_TTS (MsCliques_Mixin, Base2):
     )
 
 
+class ApparatusCliquesMat (Base2):
+    """A materialized copy of the view :ref:`apparatus_cliques_view
+    <apparatus_cliques_view>`.
+
+    The API server reads this table instead of the view.  It is kept up to date
+    by statement triggers on the :class:`Apparatus` and :class:`MsCliques`
+    tables, that refresh the rows of all changed manuscripts at the changed
+    passages, and on the :class:`Readings`, :class:`Passages`, and
+    :class:`Manuscripts` tables, that refresh all rows of the changed passages
+    or manuscripts.  See: :func:`apparatus_mat_refresh`.  On databases without
+    this table the server reads the view.
+
+    """
+
+    __tablename__ = 'apparatus_cliques_mat'
+
+    pass_id      = Column (Integer,       nullable = False)
+    begadr       = Column (Integer,       nullable = False)
+    endadr       = Column (Integer,       nullable = False)
+    passage      = Column (IntRangeType,  nullable = False)
+    spanning     = Column (Boolean,       nullable = False)
+    spanned      = Column (Boolean,       nullable = False)
+    fehlvers     = Column (Boolean,       nullable = False)
+    ms_id        = Column (Integer,       nullable = False)
+    hs           = Column (String (32),   nullable = False)
+    hsnr         = Column (Integer,       nullable = False)
+    labez        = Column (String (64),   nullable = False)
+    cbgm         = Column (Boolean,       nullable = False)
+    labezsuf     = Column (String (64),   nullable = False)
+    certainty    = Column (Float (16),    nullable = False)
+    origin       = Column (String (64),   nullable = False)
+    lesart       = Column (String (1024), nullable = True)
+    clique       = Column (String (2),    nullable = True)
+    labez_clique = Column (String (66),   nullable = True)
+
+    __table_args__ = (
+        PrimaryKeyConstraint (pass_id, ms_id, labez),
+        Index ('ix_apparatus_cliques_mat_ms_id_pass_id', ms_id, pass_id),
+    )
+
+
+class ApparatusAggMat (Base2):
+    """A materialized copy of the view :ref:`apparatus_view_agg
+    <apparatus_view_agg>`.
+
+    Like :class:`ApparatusCliquesMat`, of which it is an aggregate.
+
+    """
+
+    __tablename__ = 'apparatus_agg_mat'
+
+    pass_id               = Column (Integer,     nullable = False)
+    ms_id                 = Column (Integer,     nullable = False)
+    hs                    = Column (String (32), nullable = False)
+    hsnr                  = Column (Integer,     nullable = False)
+    lesart                = Column (String,      nullable = True)
+    labez                 = Column (String,      nullable = False)
+    clique                = Column (String,      nullable = False)
+    labezsuf              = Column (String,      nullable = False)
+    labez_clique          = Column (String,      nullable = False)
+    labez_labezsuf        = Column (String,      nullable = False)
+    labez_labezsuf_clique = Column (String,      nullable = False)
+    certainty             = Column (Float (16),  nullable = False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint (pass_id, ms_id),
+        Index ('ix_apparatus_agg_mat_ms_id_pass_id', ms_id, pass_id),
+    )
+
+
 class LocStem_Mixin (TTS_Mixin):
     pass_id       = Column (Integer,    nullable = False)
     labez         = Column (String (64), nullable = False)
@@ -1373,8 +1443,8 @@ view ('apparatus_cliques_view', Base2.metadata, '''
     LEFT JOIN ms_cliques q USING (ms_id, pass_id, labez)
     ''')
 
-view ('apparatus_view_agg', Base2.metadata, '''
-   SELECT pass_id, ms_id, hs, hsnr,
+APPARATUS_AGG_COLUMNS = '''
+          pass_id, ms_id, hs, hsnr,
           MODE () WITHIN GROUP (ORDER BY lesart) AS lesart,
           labez_agg (labez    ORDER BY labez)    AS labez,
           labez_agg (clique   ORDER BY clique)   AS clique,
@@ -1383,9 +1453,14 @@ view ('apparatus_view_agg', Base2.metadata, '''
           labez_agg (labez || labezsuf           ORDER BY labez, labezsuf)         AS labez_labezsuf,
           labez_agg (labez || labezsuf || clique ORDER BY labez, labezsuf, clique) AS labez_labezsuf_clique,
           MAX (certainty) AS certainty
+'''
+""" The columns of apparatus_view_agg and apparatus_agg_mat. """
+
+view ('apparatus_view_agg', Base2.metadata, '''
+   SELECT {columns}
    FROM apparatus_cliques_view
    GROUP BY pass_id, ms_id, hs, hsnr
-   ''')
+   '''.format (columns = APPARATUS_AGG_COLUMNS))
 
 view ('affinity_view', Base2.metadata, '''
     SELECT ch.bk_id, ch.rg_id, ch.range, ms_id1, ms_id2, common, equal,
@@ -1648,6 +1723,289 @@ generic (Base2.metadata, '''
 '''
 )
 
+# keep apparatus_cliques_mat and apparatus_agg_mat up to date
+#
+# The trigger functions refresh all (pass_id, ms_id) pairs touched by a
+# statement at once.  If both arrays are NULL everything is refreshed.  If
+# only ms_ids is NULL all mss. of the passages are refreshed, if only pass_ids
+# is NULL all passages of the mss.  The triggers on readings, passages, and
+# manuscripts refresh only if a column shown in the apparatus changed.
+#
+# N.B. Writes through apparatus_cliques_view are row by row: its INSTEAD OF
+# trigger runs one statement per row on apparatus and ms_cliques, and every
+# one of them refreshes.  Bulk loaders should disable the triggers, see
+# apparatus_mat_triggers ().
+
+function ('apparatus_mat_refresh', Base2.metadata, 'pass_ids INTEGER[], ms_ids INTEGER[]', 'VOID', '''
+   BEGIN
+      IF pass_ids IS NULL AND ms_ids IS NULL THEN
+        TRUNCATE apparatus_cliques_mat, apparatus_agg_mat;
+
+        INSERT INTO apparatus_cliques_mat (pass_id, begadr, endadr, passage, spanning, spanned, fehlvers,
+                                           ms_id, hs, hsnr, labez, cbgm, labezsuf, certainty, origin,
+                                           lesart, clique, labez_clique)
+        SELECT pass_id, begadr, endadr, passage, spanning, spanned, fehlvers,
+               ms_id, hs, hsnr, labez, cbgm, labezsuf, certainty, origin,
+               lesart, clique, labez_clique
+        FROM apparatus_cliques_view;
+
+        INSERT INTO apparatus_agg_mat
+        SELECT {columns}
+        FROM apparatus_cliques_mat
+        GROUP BY pass_id, ms_id, hs, hsnr;
+
+        RETURN;
+      END IF;
+
+      IF cardinality (COALESCE (pass_ids, ms_ids)) = 0 THEN
+        RETURN;
+      END IF;
+
+      CREATE TEMPORARY TABLE IF NOT EXISTS apparatus_mat_keys (
+        pass_id INTEGER,
+        ms_id   INTEGER,
+        PRIMARY KEY (pass_id, ms_id)
+      ) ON COMMIT DROP;
+      TRUNCATE apparatus_mat_keys;
+
+      IF ms_ids IS NULL THEN
+        INSERT INTO apparatus_mat_keys
+        SELECT pass_id, ms_id FROM apparatus         WHERE pass_id = ANY (pass_ids)
+        UNION
+        SELECT pass_id, ms_id FROM apparatus_agg_mat WHERE pass_id = ANY (pass_ids);
+      ELSIF pass_ids IS NULL THEN
+        INSERT INTO apparatus_mat_keys
+        SELECT pass_id, ms_id FROM apparatus         WHERE ms_id = ANY (ms_ids)
+        UNION
+        SELECT pass_id, ms_id FROM apparatus_agg_mat WHERE ms_id = ANY (ms_ids);
+      ELSE
+        INSERT INTO apparatus_mat_keys
+        SELECT DISTINCT * FROM unnest (pass_ids, ms_ids);
+      END IF;
+
+      DELETE FROM apparatus_cliques_mat m
+      USING apparatus_mat_keys k
+      WHERE (m.pass_id, m.ms_id) = (k.pass_id, k.ms_id);
+
+      DELETE FROM apparatus_agg_mat m
+      USING apparatus_mat_keys k
+      WHERE (m.pass_id, m.ms_id) = (k.pass_id, k.ms_id);
+
+      INSERT INTO apparatus_cliques_mat (pass_id, begadr, endadr, passage, spanning, spanned, fehlvers,
+                                         ms_id, hs, hsnr, labez, cbgm, labezsuf, certainty, origin,
+                                         lesart, clique, labez_clique)
+      SELECT v.pass_id, v.begadr, v.endadr, v.passage, v.spanning, v.spanned, v.fehlvers,
+             v.ms_id, v.hs, v.hsnr, v.labez, v.cbgm, v.labezsuf, v.certainty, v.origin,
+             v.lesart, v.clique, v.labez_clique
+      FROM apparatus_cliques_view v
+      JOIN apparatus_mat_keys k USING (pass_id, ms_id);
+
+      INSERT INTO apparatus_agg_mat
+      SELECT {columns}
+      FROM apparatus_cliques_mat
+      JOIN apparatus_mat_keys k USING (pass_id, ms_id)
+      GROUP BY pass_id, ms_id, hs, hsnr;
+   END;
+'''.format (columns = APPARATUS_AGG_COLUMNS), language = 'plpgsql', volatility = 'VOLATILE')
+
+function ('apparatus_mat_insert_f', Base2.metadata, '', 'TRIGGER', '''
+   BEGIN
+      PERFORM apparatus_mat_refresh (ARRAY (SELECT pass_id FROM new_rows),
+                                     ARRAY (SELECT ms_id   FROM new_rows));
+      RETURN NULL;
+   END;
+''', language = 'plpgsql', volatility = 'VOLATILE')
+
+function ('apparatus_mat_update_f', Base2.metadata, '', 'TRIGGER', '''
+   BEGIN
+      PERFORM apparatus_mat_refresh (ARRAY (SELECT pass_id FROM old_rows UNION ALL SELECT pass_id FROM new_rows),
+                                     ARRAY (SELECT ms_id   FROM old_rows UNION ALL SELECT ms_id   FROM new_rows));
+      RETURN NULL;
+   END;
+''', language = 'plpgsql', volatility = 'VOLATILE')
+
+function ('apparatus_mat_delete_f', Base2.metadata, '', 'TRIGGER', '''
+   BEGIN
+      PERFORM apparatus_mat_refresh (ARRAY (SELECT pass_id FROM old_rows),
+                                     ARRAY (SELECT ms_id   FROM old_rows));
+      RETURN NULL;
+   END;
+''', language = 'plpgsql', volatility = 'VOLATILE')
+
+function ('apparatus_mat_truncate_f', Base2.metadata, '', 'TRIGGER', '''
+   BEGIN
+      PERFORM apparatus_mat_refresh (NULL, NULL);
+      RETURN NULL;
+   END;
+''', language = 'plpgsql', volatility = 'VOLATILE')
+
+for table in ('apparatus', 'ms_cliques'):
+    generic (Base2.metadata, '''
+    CREATE TRIGGER {table}_mat_insert_trigger
+    AFTER INSERT ON {table}
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE apparatus_mat_insert_f ();
+
+    CREATE TRIGGER {table}_mat_update_trigger
+    AFTER UPDATE ON {table}
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE apparatus_mat_update_f ();
+
+    CREATE TRIGGER {table}_mat_delete_trigger
+    AFTER DELETE ON {table}
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE apparatus_mat_delete_f ();
+
+    CREATE TRIGGER {table}_mat_truncate_trigger
+    AFTER TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE PROCEDURE apparatus_mat_truncate_f ();
+'''.format (table = table), '''
+    DROP TRIGGER IF EXISTS {table}_mat_insert_trigger   ON {table};
+    DROP TRIGGER IF EXISTS {table}_mat_update_trigger   ON {table};
+    DROP TRIGGER IF EXISTS {table}_mat_delete_trigger   ON {table};
+    DROP TRIGGER IF EXISTS {table}_mat_truncate_trigger ON {table};
+'''.format (table = table)
+    )
+
+# (table, key, columns shown in the apparatus)
+APPARATUS_MAT_SOURCES = (
+    ('readings',    'pass_id', ('labez', 'lesart')),
+    ('passages',    'pass_id', ('begadr', 'endadr', 'passage', 'spanning', 'spanned', 'fehlvers')),
+    ('manuscripts', 'ms_id',   ('hs', 'hsnr')),
+)
+
+for table, key, columns in APPARATUS_MAT_SOURCES:
+    refresh = ('apparatus_mat_refresh (ARRAY (%s), NULL)' if key == 'pass_id' else
+               'apparatus_mat_refresh (NULL, ARRAY (%s))')
+    function ('apparatus_mat_{table}_f'.format (table = table), Base2.metadata, '', 'TRIGGER', '''
+   BEGIN
+      IF TG_OP = 'UPDATE' THEN
+        PERFORM {changed};
+      ELSIF TG_OP = 'DELETE' THEN
+        PERFORM {deleted};
+      ELSIF TG_OP = 'TRUNCATE' THEN
+        PERFORM apparatus_mat_refresh (NULL, NULL);
+      END IF;
+      RETURN NULL;
+   END;
+'''.format (
+    changed = refresh % '''
+          SELECT DISTINCT {key}
+          FROM old_rows o FULL JOIN new_rows n USING ({using})
+          WHERE ({o}) IS DISTINCT FROM ({n})'''.format (
+              key   = key,
+              using = 'pass_id, labez' if table == 'readings' else key,
+              o    = ', '.join (['o.' + c for c in columns]),
+              n    = ', '.join (['n.' + c for c in columns])),
+    deleted = refresh % 'SELECT DISTINCT %s FROM old_rows' % key,
+), language = 'plpgsql', volatility = 'VOLATILE')
+
+    generic (Base2.metadata, '''
+    CREATE TRIGGER {table}_mat_update_trigger
+    AFTER UPDATE ON {table}
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE apparatus_mat_{table}_f ();
+
+    CREATE TRIGGER {table}_mat_delete_trigger
+    AFTER DELETE ON {table}
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE apparatus_mat_{table}_f ();
+
+    CREATE TRIGGER {table}_mat_truncate_trigger
+    AFTER TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE PROCEDURE apparatus_mat_{table}_f ();
+'''.format (table = table), '''
+    DROP TRIGGER IF EXISTS {table}_mat_update_trigger   ON {table};
+    DROP TRIGGER IF EXISTS {table}_mat_delete_trigger   ON {table};
+    DROP TRIGGER IF EXISTS {table}_mat_truncate_trigger ON {table};
+'''.format (table = table)
+    )
+
+
+def apparatus_mat_triggers (action):
+    """Return SQL that disables or enables the triggers of the materialized apparatus.
+
+    Bulk loaders disable the triggers, write, enable the triggers again in
+    the same transaction and then refresh everything at once with::
+
+      SELECT apparatus_mat_refresh (NULL, NULL)
+
+    :param str action: 'DISABLE' or 'ENABLE'
+
+    """
+
+    triggers = [(table, op)
+                for table in ('apparatus', 'ms_cliques')
+                for op in ('insert', 'update', 'delete', 'truncate')]
+    triggers += [(table, op)
+                 for table, dummy_key, dummy_columns in APPARATUS_MAT_SOURCES
+                 for op in ('update', 'delete', 'truncate')]
+
+    return '\n'.join ([
+        'ALTER TABLE {table} {action} TRIGGER {table}_mat_{op}_trigger;'.format (
+            table = table, action = action, op = op)
+        for table, op in triggers
+    ])
+
+
+
+class TableVersions (Base2):
+    """A table that records the last change to the tables the CBGM depends on.
+
+    The statement triggers on the tables in :data:`VERSIONED_TABLES` bump the
+    version of a table whenever a statement changes it.  Unlike the statistics
+    counters the versions are transactional and persistent: they survive a
+    restart, a crash, and a reset of the statistics.  See
+    :func:`ntg_common.db_tools.change_marker`.
+
+    .. attribute:: relname
+
+        The name of the table.
+
+    .. attribute:: version
+
+        The id of the last transaction that changed the table.
+
+    .. attribute:: prev_version
+
+        The version before that transaction.  A transaction can thus tell the
+        version it started from, see :meth:`set_cover.ParamsCache.update_passage`.
+
+    """
+
+    __tablename__ = 'table_versions'
+
+    relname      = Column (String,     primary_key = True)
+    version      = Column (BigInteger, nullable = False)
+    prev_version = Column (BigInteger)
+
+
+VERSIONED_TABLES = ('manuscripts', 'passages', 'readings', 'ranges', 'apparatus', 'cliques',
+                    'ms_cliques', 'locstem', 'ms_ranges', 'affinity')
+""" The tables whose changes are recorded in :class:`TableVersions`. """
+
+function ('table_version_f', Base2.metadata, '', 'TRIGGER', '''
+   BEGIN
+      INSERT INTO table_versions (relname, version)
+      VALUES (TG_TABLE_NAME, txid_current ())
+      ON CONFLICT (relname) DO UPDATE
+      SET prev_version = CASE WHEN table_versions.version = EXCLUDED.version
+                              THEN table_versions.prev_version
+                              ELSE table_versions.version END,
+          version      = EXCLUDED.version;
+      RETURN NULL;
+   END;
+''', language = 'plpgsql', volatility = 'VOLATILE')
+
+for table in VERSIONED_TABLES:
+    generic (Base2.metadata, '''
+    CREATE TRIGGER {table}_version_trigger
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE PROCEDURE table_version_f ();
+'''.format (table = table), '''
+    DROP TRIGGER IF EXISTS {table}_version_trigger ON {table};
+'''.format (table = table)
+    )
 
 Base4 = declarative_base ()
 Base4.metadata.schema = 'ntg'
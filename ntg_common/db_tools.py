@@ -11,10 +11,13 @@ import itertools
 import logging
 import os
 import os.path
+import struct
 import textwrap
 import time
+import uuid
 
 import networkx as nx
+import numpy as np
 import sqlalchemy
 from sqlalchemy.sql import text
 
@@ -51,6 +54,18 @@ def executemany_raw (conn, sql, parameters, param_array, debug_level = logging.D
     return result
 
 
+def execute_raw (conn, sql, debug_level = logging.DEBUG):
+    """Execute sql without formatting and without bind parameters.
+
+    Use this for sql obtained from the database, eg. view definitions.
+
+    """
+    start_time = datetime.datetime.now ()
+    result = conn.execute (sql)
+    log (debug_level, '%d rows in %.3fs', result.rowcount, (datetime.datetime.now () - start_time).total_seconds ())
+    return result
+
+
 def rollback (conn, debug_level = logging.DEBUG):
     start_time = datetime.datetime.now ()
     result = conn.execute ('ROLLBACK')
@@ -58,6 +73,322 @@ def rollback (conn, debug_level = logging.DEBUG):
     return result
 
 
+def fetch_arrays (result, dtypes, batch_size = 65536):
+    """Fetch all rows of a result into numpy arrays.
+
+    Fetches the rows in batches and converts every batch into a numpy array in
+    one go.  Use this to load big result sets and then scatter them into a
+    matrix with fancy indexing.
+
+    :param list dtypes: the numpy types of the columns
+    :return: list of arrays, one for each column
+
+    """
+
+    dtype = np.dtype ([('f%d' % i, t) for i, t in enumerate (dtypes)])
+    batches = []
+    while True:
+        rows = result.fetchmany (batch_size)
+        if not rows:
+            break
+        batches.append (np.array ([tuple (row) for row in rows], dtype = dtype))
+
+    a = np.concatenate (batches) if batches else np.zeros (0, dtype = dtype)
+    return [a['f%d' % i] for i in range (len (dtypes))]
+
+
+def change_marker (conn, tables, before_own_changes = False):
+    """Return a string that changes whenever the contents of the tables change.
+
+    The marker is built from the versions in the table_versions table, which
+    are bumped by statement triggers on every change, see
+    :class:`ntg_common.db.TableVersions`, and from the file nodes of the tables
+    (which change on TRUNCATE, VACUUM FULL, or a restore).  It is cheap to get,
+    no table is scanned.  The versions are transactional, so get the marker in
+    the same transaction that reads the data you want to key on it.
+
+    Tables without a version trigger, eg. in databases created before the
+    triggers were added, fall back to the statistics counters of inserted,
+    updated, and deleted tuples.  The counters are not transactional and get
+    lost on a crash or a reset of the statistics.  To never match a marker
+    taken before a reset, the fallback adds the time of the last reset and the
+    start time of the server to the marker.  If the counters are switched off
+    (track_counts) the marker is unique on every call, ie. it never matches.
+
+    With before_own_changes the marker is the one before the changes made by
+    the current transaction.  This works only if all tables have a version
+    trigger, else None is returned.
+
+    :param list tables: the names of the tables to watch
+    :param bool before_own_changes: return the marker before our own changes
+    :return: the marker
+
+    """
+
+    res = execute (conn, """
+    SELECT c.relname, c.relfilenode, t.oid IS NOT NULL AS versioned,
+           s.n_tup_ins, s.n_tup_upd, s.n_tup_del
+    FROM pg_class c
+      JOIN pg_stat_user_tables s ON s.relid = c.oid
+      LEFT JOIN pg_trigger t ON t.tgrelid = c.oid
+                            AND t.tgname = c.relname || '_version_trigger'
+                            AND t.tgenabled != 'D'
+    WHERE c.oid = ANY (CAST (:tables AS regclass[]))
+    ORDER BY c.relname
+    """, dict (tables = list (tables)))
+    rows = res.fetchall ()
+
+    if before_own_changes and not all (row.versioned for row in rows):
+        return None
+
+    versions = {}
+    if any (row.versioned for row in rows):
+        res = execute (conn, """
+        SELECT relname,
+               CASE WHEN :before AND version = txid_current_if_assigned ()
+                    THEN prev_version
+                    ELSE version END
+        FROM table_versions
+        WHERE relname = ANY (:relnames)
+        """, dict (relnames = [row.relname for row in rows if row.versioned],
+                   before = before_own_changes))
+        versions = dict (res.fetchall ())
+
+    res = execute (conn, """
+    SELECT current_database (), stats_reset, pg_postmaster_start_time (), current_setting ('track_counts')
+    FROM pg_stat_database
+    WHERE datname = current_database ()
+    """, {})
+    database, stats_reset, start_time, track_counts = res.fetchone ()
+
+    marker = [database]
+    for row in rows:
+        if row.versioned:
+            marker.append ('%s:%s:v%s' % (row.relname, row.relfilenode, versions.get (row.relname)))
+        else:
+            marker.append ('%s:%s:%s:%s:%s' % (row.relname, row.relfilenode,
+                                               row.n_tup_ins, row.n_tup_upd, row.n_tup_del))
+    if not all (row.versioned for row in rows):
+        if track_counts != 'on':
+            marker.append (uuid.uuid4 ().hex)
+        marker.append ('%s:%s' % (stats_reset, start_time))
+
+    return ';'.join (marker)
+
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\0' + struct.pack ('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack ('>h', -1)
+
+
+class _ChunkReader (io.RawIOBase):
+    """A read-only file object that reads from an iterator of bytes."""
+
+    def __init__ (self, chunks):
+        self.chunks = iter (chunks)
+        self.buf = memoryview (b'')
+
+    def readable (self):
+        return True
+
+    def readinto (self, b):
+        while not self.buf:
+            try:
+                self.buf = memoryview (next (self.chunks)).cast ('B')
+            except StopIteration:
+                return 0
+        n = min (len (b), len (self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+
+def copy_from_arrays (conn, table, columns, batches, debug_level = logging.DEBUG):
+    """Bulk load numpy arrays into a table.
+
+    Uses COPY FROM STDIN in the binary format.  Every batch is converted into
+    the binary format in one go by numpy and streamed to the server, so no
+    Python object is created for any row.  NULL values are not supported.
+
+    :param str table:    the table name
+    :param list columns: list of tuples (column name, big-endian numpy type)
+                         eg. ('rg_id', '>i4') for an INTEGER or
+                         ('affinity', '>f8') for a FLOAT column.
+    :param batches:      iterator of batches.  A batch is a list of
+                         equal-length arrays, one for each column.
+    :return: the no. of rows copied
+
+    """
+
+    names = [name for name, dummy_type in columns]
+    dtype = [('n_fields', '>i2')]
+    for name, type_ in columns:
+        dtype.append ((name + '_length', '>i4'))
+        dtype.append ((name, type_))
+    dtype = np.dtype (dtype)
+
+    n_rows = 0
+
+    def chunks ():
+        nonlocal n_rows
+        yield PGCOPY_HEADER
+        for batch in batches:
+            rows = np.empty (len (batch[0]), dtype)
+            rows['n_fields'] = len (columns)
+            for name, a in zip (names, batch):
+                rows[name + '_length'] = dtype[name].itemsize
+                rows[name] = a
+            n_rows += len (rows)
+            yield rows.tobytes ()
+        yield PGCOPY_TRAILER
+
+    start_time = datetime.datetime.now ()
+    sql = 'COPY %s (%s) FROM STDIN (FORMAT binary)' % (table, ', '.join (names))
+    conn.connection.cursor ().copy_expert (sql, _ChunkReader (chunks ()))
+    log (debug_level, '%d rows in %.3fs', n_rows, (datetime.datetime.now () - start_time).total_seconds ())
+    return n_rows
+
+
+def swap_table (conn, table, new_table, parameters):
+    """Atomically replace a table with a freshly filled copy.
+
+    The new table must have been created with: CREATE TABLE new_table (LIKE
+    table INCLUDING DEFAULTS), ie. without indices and constraints, so that it
+    can be filled fast.  This function then:
+
+    - builds the indices and constraints of the old table on the new table,
+    - renames the old table out of the way and the new table into its place,
+    - points the views that depend on the table to the new table with CREATE
+      OR REPLACE VIEW, which keeps their options, comments, and privileges,
+    - drops the old table, and
+    - carries over the comments, options, privileges (grant options included),
+      and triggers of the old table to the new table.
+
+    Must be called inside a transaction.  Other connections will see either the
+    old or the new table, never a half-filled one.  The old table and the views
+    are locked only for the final swap, not while the indices are built.
+
+    Queries that name the table get the new table after the swap.  But queries
+    through a view that were already waiting for the lock on the old table when
+    the swap commits fail with: "could not open relation with OID nnn".  They
+    must be retried.
+
+    The table must not be referenced by foreign keys.
+
+    """
+
+    params = dict (parameters, table = table, new_table = new_table)
+    old_table = table + '_swap_old'
+
+    # views that depend on the table, directly or through other views
+    res = execute (conn, """
+    WITH RECURSIVE deps (oid, depth) AS (
+      SELECT :table ::regclass::oid, 0
+    UNION
+      SELECT r.ev_class, deps.depth + 1
+      FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN deps ON d.refobjid = deps.oid
+      WHERE d.classid = 'pg_rewrite'::regclass AND r.ev_class != deps.oid
+    )
+    SELECT deps.oid::regclass::text, pg_get_viewdef (deps.oid), array_to_string (c.reloptions, ', ')
+    FROM deps
+      JOIN pg_class c ON c.oid = deps.oid
+    WHERE depth > 0
+    GROUP BY deps.oid, c.reloptions
+    ORDER BY MAX (depth), deps.oid
+    """, params)
+    views = res.fetchall ()
+
+    # privileges, comments, and options of the table
+    res = execute (conn, """
+    SELECT a.privilege_type, a.is_grantable,
+           CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident (pg_get_userbyid (a.grantee)) END
+    FROM pg_class c, aclexplode (c.relacl) a
+    WHERE c.oid = :table ::regclass
+    """, params)
+    grants = res.fetchall ()
+
+    res = execute (conn, """
+    SELECT c.relacl IS NOT NULL, obj_description (c.oid, 'pg_class'),
+           array_to_string (c.reloptions, ', ')
+    FROM pg_class c
+    WHERE c.oid = :table ::regclass
+    """, params)
+    has_acl, comment, reloptions = res.fetchone ()
+
+    res = execute (conn, """
+    SELECT quote_ident (attname), col_description (attrelid, attnum)
+    FROM pg_attribute
+    WHERE attrelid = :table ::regclass AND attnum > 0 AND NOT attisdropped
+      AND col_description (attrelid, attnum) IS NOT NULL
+    """, params)
+    column_comments = res.fetchall ()
+
+    res = execute (conn, """
+    SELECT pg_get_triggerdef (oid)
+    FROM pg_trigger
+    WHERE tgrelid = :table ::regclass AND NOT tgisinternal
+    ORDER BY tgname
+    """, params)
+    triggers = [row[0] for row in res]
+
+    # constraints and indices not backing a constraint
+    res = execute (conn, """
+    SELECT conname, pg_get_constraintdef (oid)
+    FROM pg_constraint
+    WHERE conrelid = :table ::regclass
+    ORDER BY contype DESC, conname
+    """, params)
+    constraints = res.fetchall ()
+
+    res = execute (conn, """
+    SELECT c.relname, pg_get_indexdef (i.indexrelid)
+    FROM pg_index i
+      JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = :table ::regclass
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+    """, params)
+    indices = res.fetchall ()
+
+    # pg_get_indexdef: CREATE [UNIQUE] INDEX name ON table USING method (...)
+    for name, indexdef in indices:
+        create, using = indexdef.split (' USING ', 1)
+        unique = 'UNIQUE ' if create.startswith ('CREATE UNIQUE') else ''
+        execute_raw (conn, 'CREATE %sINDEX %s_swap ON %s USING %s' % (unique, name, new_table, using))
+    for name, condef in constraints:
+        execute_raw (conn, 'ALTER TABLE %s ADD CONSTRAINT %s_swap %s' % (new_table, name, condef))
+
+    # the swap: lock in the same order as a reader does: outer views first
+    execute_raw (conn, 'LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % ', '.join (
+        [name for name, dummy_sql, dummy_options in reversed (views)] + [table]))
+    execute_raw (conn, 'ALTER TABLE %s RENAME TO %s' % (table, old_table))
+    execute_raw (conn, 'ALTER TABLE %s RENAME TO %s' % (new_table, table))
+    for name, sql, options in views:
+        with_options = ' WITH (%s)' % options if options else ''
+        execute_raw (conn, 'CREATE OR REPLACE VIEW %s%s AS %s' % (name, with_options, sql))
+    execute_raw (conn, 'DROP TABLE %s' % old_table)
+
+    for name, dummy_indexdef in indices:
+        execute_raw (conn, 'ALTER INDEX %s_swap RENAME TO %s' % (name, name))
+    for name, dummy_condef in constraints:
+        execute_raw (conn, 'ALTER TABLE %s RENAME CONSTRAINT %s_swap TO %s' % (table, name, name))
+
+    if has_acl:
+        execute_raw (conn, 'REVOKE ALL ON %s FROM PUBLIC' % table)
+        for privilege, grantable, grantee in grants:
+            grant_option = ' WITH GRANT OPTION' if grantable else ''
+            execute_raw (conn, 'GRANT %s ON %s TO %s%s' % (privilege, table, grantee, grant_option))
+    if comment is not None:
+        execute (conn, 'COMMENT ON TABLE {table} IS :comment', dict (params, comment = comment))
+    for column, column_comment in column_comments:
+        execute (conn, 'COMMENT ON COLUMN {table}.%s IS :comment' % column,
+                 dict (params, comment = column_comment))
+    if reloptions:
+        execute_raw (conn, 'ALTER TABLE %s SET (%s)' % (table, reloptions))
+    for triggerdef in triggers:
+        execute_raw (conn, triggerdef)
+
+
 # def execute_pandas (conn, sql, parameters, debug_level = logging.DEBUG):
 #     sql = sql.format (**parameters)
 #     log (debug_level, sql.rstrip () + ';')
@@ -24,3 +24,9 @@ class EditError (EditException):
 
 class PrivilegeError (EditException):
     pass
+
+
+class LayoutError (EditException):
+    """ GraphViz could not lay out a graph in time or is too busy. """
+
+    default_status_code = 503
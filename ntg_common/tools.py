@@ -2,8 +2,15 @@
 
 """ This module contains some useful functions. """
 
+import collections
+import concurrent.futures
+import hashlib
 import logging
 import subprocess
+import threading
+import time
+
+from ntg_common.exceptions import LayoutError
 
 BOOKS = [
     # id, siglum, name,            no. of chapters
@@ -111,31 +118,129 @@ def get_book_by_id (id_):
     return None
 
 
-def graphviz_layout (dot, format = 'dot'):
-    """Call the GraphViz dot program to generate an image but mostly to precompute
-    the graph layout.
+class LayoutService ():
+    """Run the GraphViz dot program with a bounded number of processes.
+
+    dot has no server mode, so every layout starts a new dot process.  The
+    service only bounds their number: at most `workers` dot processes run at
+    the same time.  At most `queue` more jobs wait for a free slot, further
+    jobs are refused at once.  A job gets `timeout` seconds in all, the wait
+    for a slot included.  If it takes longer it is aborted and its dot process
+    is killed.  A `timeout` of None means no limit.
+
+    Layouts are cached by the hash of the dot source.  Identical jobs submitted
+    while the first one is still running wait for its result instead of
+    starting another process.
 
     """
 
-    cmdline = ['dot', '-T%s' % format]
+    def __init__ (self, workers = 4, queue = 16, timeout = 15, cache_size = 256):
+        self.slots      = threading.BoundedSemaphore (workers)
+        self.admission  = threading.BoundedSemaphore (workers + queue)
+        self.timeout    = timeout
+        self.cache_size = cache_size
+        self.lock       = threading.Lock ()
+        self.cache      = collections.OrderedDict ()
+        self.running    = {}
+
+
+    def layout (self, dot, format = 'dot'):
+        """ Return the output of dot -T<format> for the dot source. """
+
+        key = hashlib.sha1 (('%s\n%s' % (format, dot)).encode ('utf-8')).hexdigest ()
+
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end (key)
+                return self.cache[key]
+            future = self.running.get (key)
+            if future is None:
+                future = concurrent.futures.Future ()
+                self.running[key] = future
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            return future.result ()
+
+        try:
+            outs, ok = self._run (dot, format)
+            future.set_result (outs)
+        except Exception as e:
+            future.set_exception (e)
+            raise
+        finally:
+            with self.lock:
+                del self.running[key]
+
+        if ok:
+            with self.lock:
+                self.cache[key] = outs
+                while len (self.cache) > self.cache_size:
+                    self.cache.popitem (last = False)
+
+        return outs
+
+
+    def _run (self, dot, format):
+        if not self.admission.acquire (blocking = False):
+            raise LayoutError ('The layout engine is busy.  Try again later.')
+        try:
+            # one deadline for the wait and the run
+            start_time = time.monotonic ()
+            deadline = None if self.timeout is None else start_time + self.timeout
+
+            def remaining ():
+                return None if deadline is None else max (0, deadline - time.monotonic ())
+
+            if not self.slots.acquire (timeout = remaining ()):
+                raise LayoutError ('The layout engine is busy.  Try again later.')
+            try:
+                p = subprocess.Popen (
+                    ['dot', '-T%s' % format],
+                    stdin  = subprocess.PIPE,
+                    stdout = subprocess.PIPE,
+                    stderr = subprocess.PIPE)
+
+                try:
+                    outs, errs = p.communicate (dot.encode ('utf-8'), timeout = remaining ())
+                except subprocess.TimeoutExpired:
+                    p.kill ()
+                    p.communicate ()
+                    raise LayoutError ('The layout took longer than %d seconds.' % self.timeout, 504)
+
+                log (logging.DEBUG, 'dot -T%s in %.3fs', format, time.monotonic () - start_time)
+            finally:
+                self.slots.release ()
+        finally:
+            self.admission.release ()
+
+        if errs:
+            log (logging.ERROR, errs)
+
+        # do not cache failed layouts
+        return outs, p.returncode == 0
+
+
+layout_service = LayoutService ()
+""" The layout service used by :func:`graphviz_layout`. """
+
+
+def init_layout_service (**kwargs):
+    """ Replace the layout service with one with different settings. """
+
+    global layout_service
+    layout_service = LayoutService (**kwargs)
 
-    p = subprocess.Popen (
-        cmdline,
-        stdin  = subprocess.PIPE,
-        stdout = subprocess.PIPE,
-        stderr = subprocess.PIPE)
 
-    try:
-        outs, errs = p.communicate (dot.encode ('utf-8'), timeout = 15)
-    except subprocess.TimeoutExpired:
-        p.kill ()
-        outs, errs = p.communicate ()
+def graphviz_layout (dot, format = 'dot'):
+    """Call the GraphViz dot program to generate an image but mostly to precompute
+    the graph layout.
 
-    #if p.returncode != 0:
-    #    raise subprocess.CalledProcessError (
-    #        'Program terminated with status: %d. stderr is: %s' % (
-    #            p.returncode, errs))
-    if errs:
-        log (logging.ERROR, errs)
+    Raises :class:`~ntg_common.exceptions.LayoutError` if the layout service is
+    too busy or the layout takes too long.
+
+    """
 
-    return outs
+    return layout_service.layout (dot, format)
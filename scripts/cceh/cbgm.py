@@ -22,14 +22,15 @@ import numpy as np
 
 from ntg_common import db
 from ntg_common import db_tools
+from ntg_common.db import apparatus_mat_triggers
 from ntg_common.db_tools import execute, executemany, executemany_raw, warn, debug
 from ntg_common.tools import log
 from ntg_common.config import args, init_logging, config_from_pyfile
 
 from ntg_common.cbgm_common import CBGM_Params, create_labez_matrix, \
-    calculate_mss_similarity_preco, calculate_mss_similarity_postco, write_affinity_table
+    calculate_mss_similarity_preco, calculate_mss_similarity_postco, write_affinity_table, \
+    save_params, SNAPSHOT_TABLES, MS_ID_A
 
-MS_ID_A  = 1
 
 def build_A_text (dba, parameters):
     """Build the 'A' text
@@ -46,10 +47,17 @@ def build_A_text (dba, parameters):
 
     The Lesart of 'A' is always NULL, because it is a virtual manuscript.
 
+    The triggers of the materialized apparatus are disabled while writing,
+    instead the materialized apparatus is refreshed once at the end.  This
+    also catches changes to the readings, passages and manuscripts tables,
+    which the triggers do not see.
+
     """
 
     with dba.engine.begin () as conn:
 
+        execute (conn, apparatus_mat_triggers ('DISABLE'), parameters)
+
         execute (conn, """
         DELETE FROM ms_cliques     WHERE ms_id = :ms_id;
         DELETE FROM ms_cliques_tts WHERE ms_id = :ms_id;
@@ -73,6 +81,9 @@ def build_A_text (dba, parameters):
           WHERE p.fehlvers
         """, dict (parameters, ms_id = MS_ID_A))
 
+        execute (conn, apparatus_mat_triggers ('ENABLE'), parameters)
+        execute (conn, "SELECT apparatus_mat_refresh (NULL, NULL)", parameters)
+
 
 def build_parser ():
     parser = argparse.ArgumentParser (description = __doc__)
@@ -81,6 +92,8 @@ def build_parser ():
                          help="a .conf file (required)")
     parser.add_argument ('-v', '--verbose', dest='verbose', action='count',
                          help='increase output verbosity', default=0)
+    parser.add_argument ('-j', '--jobs', dest='jobs', type=int, metavar='N',
+                         help='use N worker processes (default: 1)', default=1)
     return parser
 
 
@@ -106,10 +119,10 @@ if __name__ == '__main__':
     create_labez_matrix (db, parameters, v)
 
     log (logging.INFO, "Calculating mss similarity pre-co ...")
-    calculate_mss_similarity_preco (db, parameters, v)
+    calculate_mss_similarity_preco (db, parameters, v, jobs = args.jobs)
 
     log (logging.INFO, "Calculating mss similarity post-co ...")
-    calculate_mss_similarity_postco (db, parameters, v)
+    calculate_mss_similarity_postco (db, parameters, v, jobs = args.jobs)
 
     log (logging.INFO, "Writing affinity table ...")
     write_affinity_table (db, parameters, v)
@@ -117,4 +130,11 @@ if __name__ == '__main__':
     log (logging.INFO, "Vacuum ...")
     db.vacuum ()
 
+    if config.get ('CBGM_CACHE_DIR'):
+        # after the vacuum, because VACUUM FULL changes the change marker
+        log (logging.INFO, "Saving snapshot ...")
+        with db.engine.begin () as conn:
+            marker = db_tools.change_marker (conn, SNAPSHOT_TABLES)
+        save_params (v, config['CBGM_CACHE_DIR'], marker)
+
     log (logging.INFO, "Done")
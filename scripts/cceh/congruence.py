@@ -0,0 +1,123 @@
+# -*- encoding: utf-8 -*-
+
+"""Check the congruence of many ranges.
+
+This script runs the congruence checks of the API server over many ranges, eg.
+all chapters of a book, and writes the incongruent attestations in CSV or JSON
+format.  It also stores the results in the congruence cache of the API server,
+so that the server can serve them at once.  Run it after the :mod:`cbgm.py
+<scripts.cceh.cbgm>` script.
+
+The cache lives in the :file:`congruence` subdirectory of the CBGM_CACHE_DIR
+configured in the .conf file.
+
+"""
+
+import argparse
+import csv
+import json
+import logging
+import sys
+
+import flask
+
+from ntg_common import db_tools
+from ntg_common.db_tools import execute
+from ntg_common.tools import log
+from ntg_common.config import args, init_logging, config_from_pyfile
+
+import server # adds the server directory to sys.path
+import helpers
+import set_cover
+import checks
+
+FIELDS = 'range pass_id hr ms_id1 hs1 ms_id2 hs2 labez1 labez2 rank'.split ()
+
+
+def build_parser ():
+    parser = argparse.ArgumentParser (description = __doc__)
+
+    parser.add_argument ('profile', metavar='path/to/file.conf',
+                         help="a .conf file (required)")
+    parser.add_argument ('-v', '--verbose', dest='verbose', action='count',
+                         help='increase output verbosity', default=0)
+    parser.add_argument ('-j', '--jobs', dest='jobs', type=int, metavar='N',
+                         help='check N ranges at once (default: 1)', default=1)
+    parser.add_argument ('-r', '--range', dest='ranges', action='append', metavar='RANGE',
+                         help="a range to check, eg. a chapter, may be repeated (default: all but 'All')",
+                         default=[])
+    parser.add_argument ('-f', '--format', dest='format', choices=['csv', 'json'],
+                         help='the output format (default: csv)', default='csv')
+    parser.add_argument ('-o', '--output', metavar='path/to/output',
+                         help="the output file (default: stdout)", default='-')
+    return parser
+
+
+if __name__ == '__main__':
+
+    build_parser ().parse_args (namespace = args)
+    config = config_from_pyfile (args.profile)
+
+    init_logging (
+        args,
+        logging.StreamHandler (), # stderr
+        logging.FileHandler ('congruence.log')
+    )
+
+    app = flask.Flask (__name__)
+    app.config.update (config)
+    app.config['CONGRUENCE_WORKERS'] = args.jobs
+    app.config.dba = db_tools.PostgreSQLEngine (**config)
+    helpers.init_app (app)
+    set_cover.init_app (app)
+    checks.init_app (app)
+
+    with app.config.dba.engine.begin () as conn:
+        if args.ranges:
+            res = execute (conn, """
+            SELECT rg_id, range
+            FROM ranges
+            WHERE range IN :ranges
+            ORDER BY lower (passage), upper (passage) DESC
+            """, dict (ranges = tuple (args.ranges)))
+        else:
+            res = execute (conn, """
+            SELECT rg_id, range
+            FROM ranges
+            WHERE range != 'All'
+            ORDER BY lower (passage), upper (passage) DESC
+            """, {})
+        ranges = dict (res.fetchall ())
+
+    log (logging.INFO, "Loading the CBGM params ...")
+    app.config.cbgm_cache.get ()
+
+    log (logging.INFO, "Checking %d ranges ..." % len (ranges))
+    job = app.config.congruence_jobs.submit (ranges.keys ())
+    while not job.event.wait (10):
+        log (logging.INFO, "  %d of %d ranges checked" % (len (job.results), len (job.rg_ids)))
+
+    if job.status != 'done':
+        log (logging.ERROR, "Congruence check failed: %s" % job.error)
+        sys.exit (1)
+
+    if args.output == '-':
+        fp = sys.stdout
+    else:
+        fp = open (args.output, 'w', encoding='utf-8', newline='')
+
+    if args.format == 'csv':
+        writer = csv.writer (fp, dialect='excel')
+        writer.writerow (FIELDS)
+        for rg_id in job.rg_ids:
+            for r in job.results[rg_id]:
+                writer.writerow ([ranges[rg_id], r['pass_id'], r['hr'], r['ms_id1'], r['ms1'],
+                                  r['ms_id2'], r['ms2'], r['labez1'], r['labez2'], r['rank']])
+    else:
+        json.dump ([ { 'range' : ranges[rg_id], 'rg_id' : rg_id, 'ranks' : job.results[rg_id] }
+                     for rg_id in job.rg_ids ], fp)
+
+    if fp is not sys.stdout:
+        fp.close ()
+
+    log (logging.INFO, "Done")
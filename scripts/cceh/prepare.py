@@ -59,6 +59,7 @@ import sqlalchemy
 from ntg_common import db
 from ntg_common import tools
 from ntg_common import db_tools
+from ntg_common.db import apparatus_mat_triggers
 from ntg_common.db_tools import execute, executemany, executemany_raw, warn, debug, fix
 from ntg_common.tools import log
 from ntg_common.config import args, init_logging, config_from_pyfile
@@ -1492,6 +1493,8 @@ def fill_apparatus_table (dba, parameters):
 
     with dba.engine.begin () as conn:
 
+        execute (conn, apparatus_mat_triggers ('DISABLE'), parameters)
+
         execute (conn, """
         TRUNCATE apparatus RESTART IDENTITY CASCADE
         """, parameters)
@@ -1508,12 +1511,16 @@ def fill_apparatus_table (dba, parameters):
           CROSS JOIN manuscripts ms
         """, parameters)
 
+        execute (conn, apparatus_mat_triggers ('ENABLE'), parameters)
+
     with dba.engine.begin () as conn:
 
         # 3. Unroll the :class:`~ntg_common.db.Lac` table.
 
         log (logging.INFO, "          Unrolling lacunae ...")
 
+        execute (conn, apparatus_mat_triggers ('DISABLE'), parameters)
+
         execute (conn, """
         UPDATE apparatus app
         SET labez = 'zz', cbgm = true, labezsuf = '', certainty = 1.0, lesart = NULL, origin = 'LAC'
@@ -1526,6 +1533,8 @@ def fill_apparatus_table (dba, parameters):
         WHERE (lacs.pass_id, lacs.ms_id) = (app.pass_id, app.ms_id)
         """, parameters)
 
+        execute (conn, apparatus_mat_triggers ('ENABLE'), parameters)
+
 
     with dba.engine.begin () as conn:
 
@@ -1536,6 +1545,8 @@ def fill_apparatus_table (dba, parameters):
 
         log (logging.INFO, "          Filling in readings from negative apparatus ...")
 
+        execute (conn, apparatus_mat_triggers ('DISABLE'), parameters)
+
         execute (conn, """
         UPDATE apparatus app
         SET labez = a.labez, cbgm = a.certainty = 1.0, labezsuf = COALESCE (a.labezsuf, ''),
@@ -1570,6 +1581,9 @@ def fill_apparatus_table (dba, parameters):
           AND a.certainty < 1.0
         """, parameters)
 
+        execute (conn, apparatus_mat_triggers ('ENABLE'), parameters)
+        execute (conn, "SELECT apparatus_mat_refresh (NULL, NULL)", parameters)
+
 
 def fill_ms_cliques_table (dba, parameters):
     """ Create the ms_cliques table.
@@ -1578,6 +1592,8 @@ def fill_ms_cliques_table (dba, parameters):
 
     with dba.engine.begin () as conn:
 
+        execute (conn, apparatus_mat_triggers ('DISABLE'), parameters)
+
         execute (conn, """
         TRUNCATE ms_cliques_tts RESTART IDENTITY CASCADE;
         TRUNCATE ms_cliques     RESTART IDENTITY CASCADE;
@@ -1645,6 +1661,9 @@ def fill_ms_cliques_table (dba, parameters):
         ALTER TABLE ms_cliques ENABLE TRIGGER ms_cliques_trigger;
         """, parameters)
 
+        execute (conn, apparatus_mat_triggers ('ENABLE'), parameters)
+        execute (conn, "SELECT apparatus_mat_refresh (NULL, NULL)", parameters)
+
 
 def build_MT_text (dba, parameters):
     """Reconstruct the Majority Text
@@ -1672,6 +1691,8 @@ def build_MT_text (dba, parameters):
 
     with dba.engine.begin () as conn:
 
+        execute (conn, apparatus_mat_triggers ('DISABLE'), parameters)
+
         execute (conn, """
         DELETE FROM ms_cliques     WHERE ms_id = :ms_id;
         DELETE FROM ms_cliques_tts WHERE ms_id = :ms_id;
@@ -1712,6 +1733,9 @@ def build_MT_text (dba, parameters):
         )
         """, dict (parameters, ms_id = MS_ID_MT))
 
+        execute (conn, apparatus_mat_triggers ('ENABLE'), parameters)
+        execute (conn, "SELECT apparatus_mat_refresh (NULL, NULL)", parameters)
+
 
 def print_stats (dba, parameters):
 
@@ -0,0 +1,136 @@
+# -*- encoding: utf-8 -*-
+
+"""Calculate the set covers of many manuscripts.
+
+This script approximates the minimum set cover of every manuscript in a range
+by its potential ancestors, like the set cover page of the API server does for
+one manuscript.  It writes one row per manuscript and ancestor in CSV format or
+one object per manuscript in JSON lines format.
+
+The CBGM must be up to date, ie. run the :mod:`cbgm.py <scripts.cceh.cbgm>`
+script first.
+
+"""
+
+import argparse
+import csv
+import json
+import logging
+import sys
+
+import numpy as np
+
+from ntg_common import db_tools
+from ntg_common.db_tools import execute
+from ntg_common.tools import log
+from ntg_common.config import args, init_logging, config_from_pyfile
+
+from ntg_common.cbgm_common import create_set_cover_params, potential_ancestors, set_covers, \
+    pack_bits, popcount, MAX_COVER_SIZE
+
+FIELDS = 'ms_id hs n anc_ms_id anc_hs explains explained equal post unknown open'.split ()
+
+
+def build_parser ():
+    parser = argparse.ArgumentParser (description = __doc__)
+
+    parser.add_argument ('profile', metavar='path/to/file.conf',
+                         help="a .conf file (required)")
+    parser.add_argument ('-v', '--verbose', dest='verbose', action='count',
+                         help='increase output verbosity', default=0)
+    parser.add_argument ('-j', '--jobs', dest='jobs', type=int, metavar='N',
+                         help='use N worker processes (default: 1)', default=1)
+    parser.add_argument ('-r', '--range', dest='range', metavar='RANGE',
+                         help='the range, eg. a chapter (default: All)', default='All')
+    parser.add_argument ('-i', '--include', dest='include', action='append', choices=['A', 'MT'],
+                         help="also use 'A' resp. 'MT' to explain other mss.", default=[])
+    parser.add_argument ('-n', '--size', dest='size', type=int, metavar='N',
+                         help='max. no. of ancestors in a cover (default: %d)' % MAX_COVER_SIZE,
+                         default=MAX_COVER_SIZE)
+    parser.add_argument ('-f', '--format', dest='format', choices=['csv', 'jsonl'],
+                         help='the output format (default: csv)', default='csv')
+    parser.add_argument ('-o', '--output', metavar='path/to/output',
+                         help="the output file (default: stdout)", default='-')
+    return parser
+
+
+if __name__ == '__main__':
+
+    build_parser ().parse_args (namespace = args)
+    config = config_from_pyfile (args.profile)
+
+    init_logging (
+        args,
+        logging.StreamHandler (), # stderr
+        logging.FileHandler ('set_cover.log')
+    )
+
+    db = db_tools.PostgreSQLEngine (**config)
+
+    log (logging.INFO, "Loading the CBGM params ...")
+    val = create_set_cover_params (db, config.get ('CBGM_CACHE_DIR'))
+
+    rg = next ((r for r in val.ranges if r.range == args.range), None)
+    if rg is None:
+        log (logging.ERROR, "Unknown range: %s" % args.range)
+        sys.exit (1)
+
+    passages = np.zeros (val.n_passages, dtype = np.bool_)
+    passages[rg.start:rg.end] = True
+    passages = pack_bits (passages)
+
+    # all mss. defined in the range
+    ms_ids = np.flatnonzero (popcount (val.def_bits & passages)).tolist ()
+
+    with db.engine.begin () as conn:
+        log (logging.INFO, "Loading the potential ancestors ...")
+        candidates = potential_ancestors (conn, {}, rg.rg_id, val.n_mss)
+
+        res = execute (conn, """
+        SELECT ms_id - 1, hs
+        FROM manuscripts
+        """, {})
+        hs = dict (res.fetchall ())
+
+    # Remove mss. we don't want to compare
+    np.fill_diagonal (candidates, False)
+    if 'A' not in args.include:
+        candidates[:, 0] = False
+    if 'MT' not in args.include:
+        candidates[:, 1] = False
+
+    log (logging.INFO, "Calculating the set covers of %d mss. ..." % len (ms_ids))
+
+    if args.output == '-':
+        fp = sys.stdout
+    else:
+        fp = open (args.output, 'w', encoding='utf-8', newline='')
+
+    if args.format == 'csv':
+        writer = csv.writer (fp, dialect='excel')
+        writer.writerow (FIELDS)
+
+    for ms_id, steps in set_covers (val, ms_ids, candidates, passages, args.size, args.jobs):
+        if args.format == 'csv':
+            for step in steps:
+                writer.writerow ([ms_id + 1, hs.get (ms_id), step.n, step.ms_id + 1, hs.get (step.ms_id),
+                                  step.explains, step.explained, step.equal, step.post,
+                                  step.unknown, step.open])
+        else:
+            cover = []
+            for step in steps:
+                d = step._asdict ()
+                d['ms_id'] = step.ms_id + 1
+                d['hs']    = hs.get (step.ms_id)
+                cover.append (d)
+            fp.write (json.dumps ({
+                'ms_id' : ms_id + 1,
+                'hs'    : hs.get (ms_id),
+                'open'  : int (popcount (val.def_bits[ms_id] & passages)),
+                'cover' : cover,
+            }) + '\n')
+
+    if fp is not sys.stdout:
+        fp.close ()
+
+    log (logging.INFO, "Done")
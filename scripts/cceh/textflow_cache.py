@@ -0,0 +1,131 @@
+# -*- encoding: utf-8 -*-
+
+"""Pre-render the global textflow diagrams.
+
+This script renders the global textflow diagram of every passage in the
+requested ranges into the textflow cache of the API server, so that the server
+need not build them on first request.  Run it after the :mod:`cbgm.py
+<scripts.cceh.cbgm>` script.
+
+The cache lives in the :file:`textflow` subdirectory of the CBGM_CACHE_DIR
+configured in the .conf file.  The server serves a cached diagram only if all
+its parameters match, so set the width and font size to those of the client.
+
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import sys
+
+import flask
+
+from ntg_common import db_tools
+from ntg_common import tools
+from ntg_common.db_tools import execute
+from ntg_common.exceptions import LayoutError
+from ntg_common.tools import log
+from ntg_common.config import args, init_logging, config_from_pyfile
+
+import server # adds the server directory to sys.path
+import helpers
+import textflow
+
+
+def build_parser ():
+    parser = argparse.ArgumentParser (description = __doc__)
+
+    parser.add_argument ('profile', metavar='path/to/file.conf',
+                         help="a .conf file (required)")
+    parser.add_argument ('-v', '--verbose', dest='verbose', action='count',
+                         help='increase output verbosity', default=0)
+    parser.add_argument ('-j', '--jobs', dest='jobs', type=int, metavar='N',
+                         help='render N diagrams at once (default: 1)', default=1)
+    parser.add_argument ('-r', '--range', dest='ranges', action='append', metavar='RANGE',
+                         help='a range to render, eg. a chapter, may be repeated (default: All)',
+                         default=[])
+    parser.add_argument ('-f', '--format', dest='formats', action='append', choices=['dot', 'png'],
+                         help='the format to render, may be repeated (default: dot)', default=[])
+    parser.add_argument ('--width', dest='width', type=float, metavar='PX',
+                         help='the width of the diagram in px. (default: 0 = unconstrained)',
+                         default=0.0)
+    parser.add_argument ('--fontsize', dest='fontsize', type=float, metavar='PX',
+                         help='the font size in px. (default: 10)', default=10.0)
+    parser.add_argument ('--timeout', dest='timeout', type=float, metavar='SECONDS',
+                         help='abort the layout of a diagram after SECONDS (default: no limit)',
+                         default=None)
+    return parser
+
+
+def render (app, pass_id, rg_id, format):
+    """ Render one global textflow diagram into the cache. """
+
+    query = {
+        'rg_id'    : rg_id,
+        'mode'     : 'sim',
+        'width'    : args.width,
+        'fontsize' : args.fontsize,
+    }
+    with app.test_request_context ('/textflow.%s/%d' % (format, pass_id), query_string = query):
+        textflow.render_textflow (pass_id, format)
+
+
+if __name__ == '__main__':
+
+    build_parser ().parse_args (namespace = args)
+    config = config_from_pyfile (args.profile)
+
+    init_logging (
+        args,
+        logging.StreamHandler (), # stderr
+        logging.FileHandler ('textflow_cache.log')
+    )
+
+    if not config.get ('CBGM_CACHE_DIR'):
+        log (logging.ERROR, "CBGM_CACHE_DIR is not configured in %s" % args.profile)
+        sys.exit (1)
+
+    ranges  = args.ranges  or ['All']
+    formats = args.formats or ['dot']
+
+    app = flask.Flask (__name__)
+    app.config.update (config)
+    app.config.dba = db_tools.PostgreSQLEngine (**config)
+    helpers.init_app (app)
+    textflow.init_app (app)
+
+    # one dot process per job, and no server defaults for queue and timeout
+    tools.init_layout_service (workers = args.jobs, queue = args.jobs, timeout = args.timeout)
+
+    with app.config.dba.engine.begin () as conn:
+        res = execute (conn, """
+        SELECT p.pass_id, rg.rg_id
+        FROM passages p
+        JOIN ranges rg
+          ON (rg.passage @> p.passage)
+        WHERE rg.range IN :ranges
+        ORDER BY rg.rg_id, p.pass_id
+        """, dict (ranges = tuple (ranges)))
+        jobs = [ (pass_id, rg_id, format) for pass_id, rg_id in res for format in formats ]
+
+    log (logging.INFO, "Rendering %d diagrams ..." % len (jobs))
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor (max_workers = args.jobs) as executor:
+        futures = { executor.submit (render, app, *job) : job for job in jobs }
+        for n, future in enumerate (concurrent.futures.as_completed (futures), 1):
+            try:
+                future.result ()
+            except LayoutError as e:
+                pass_id, rg_id, format = futures[future]
+                log (logging.WARNING, "Could not render pass_id=%d rg_id=%d format=%s: %s" %
+                     (pass_id, rg_id, format, e.message))
+                failed.append (futures[future])
+            if n % 100 == 0:
+                log (logging.INFO, "  %d diagrams rendered" % n)
+
+    if failed:
+        log (logging.ERROR, "%d of %d diagrams could not be rendered" % (len (failed), len (jobs)))
+        sys.exit (1)
+
+    log (logging.INFO, "Done")
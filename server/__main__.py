@@ -33,9 +33,11 @@ from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
 from ntg_common.config import args, init_logging
 from ntg_common import db_tools
+from ntg_common import tools
 from ntg_common.exceptions import EditException
 
 import login
+import helpers
 import main
 import info
 import static
@@ -72,6 +74,10 @@ class Config ():
     WRITE_ACCESS = 'none'
     CORS_ALLOW_ORIGIN = '*'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    GRAPHVIZ_WORKERS = 4
+    GRAPHVIZ_QUEUE = 16
+    GRAPHVIZ_TIMEOUT = 15
+    CONGRUENCE_WORKERS = 2
 
 
 def build_parser(default_config_file=Config.CONFIG_FILE):
@@ -141,6 +147,12 @@ def create_app(Config):
     app.logger.setLevel(Config.LOG_LEVEL)
     app.logger.info("Instance path: {ip}".format(ip=instance_path))
 
+    tools.init_layout_service(
+        workers=app.config['GRAPHVIZ_WORKERS'],
+        queue=app.config['GRAPHVIZ_QUEUE'],
+        timeout=app.config['GRAPHVIZ_TIMEOUT'],
+    )
+
     app.register_blueprint(static.bp)
     app.register_blueprint(login.bp)
 
@@ -181,6 +193,7 @@ def create_app(Config):
         sub_app.config['SQLALCHEMY_DATABASE_URI'] = user_db_url
 
         do_init_app(sub_app)
+        helpers.init_app(sub_app)
         main.init_app(sub_app)
         textflow.init_app(sub_app)
         comparison.init_app(sub_app)
@@ -5,28 +5,52 @@
 """
 
 import collections
+import concurrent.futures
 import itertools
+import json
 import logging
+import os.path
+import threading
+import time
+import uuid
 
 import flask
 from flask import request, current_app
 
 import numpy as np
 
-from ntg_common.db_tools import execute
-from ntg_common.cbgm_common import CBGM_Params, create_labez_matrix
+from ntg_common.db_tools import execute, change_marker
+from ntg_common.cbgm_common import CBGM_Params, create_labez_matrix, unpack_bits, SNAPSHOT_TABLES
+from ntg_common.exceptions import EditError
 from ntg_common import tools
 
-from helpers import Passage, Manuscript, make_json_response, csvify
+from helpers import Passage, Manuscript, RenderCache, make_json_response, csvify, \
+    apparatus_tables
 
 
 bp = flask.Blueprint('checks', __name__)
 
+CONGRUENCE_CHUNK_SIZE = 256
+"""No. of passages the congruence check processes at once."""
+
+CONGRUENCE_CACHE_SIZE = 64
+"""Keep the congruence lists of this many ranges in memory."""
+
+CONGRUENCE_TABLES = ('affinity', 'ms_ranges') + SNAPSHOT_TABLES
+"""The congruence lists change when these tables change."""
+
+MAX_JOBS = 32
+"""Remember this many congruence jobs."""
+
 
 def init_app(app):
     """ Init the Flask app. """
 
-    pass
+    cache_dir = app.config.get('CBGM_CACHE_DIR')
+    if cache_dir:
+        cache_dir = os.path.join(cache_dir, 'congruence')
+    app.config.congruence_cache = RenderCache(CONGRUENCE_CACHE_SIZE, cache_dir)
+    app.config.congruence_jobs = CongruenceJobs(app, app.config.get('CONGRUENCE_WORKERS', 2))
 
 
 def congruence(conn, passage):
@@ -71,8 +95,8 @@ def congruence(conn, passage):
       FROM affinity_p_view aff
         JOIN manuscripts ms1 ON ms1.ms_id = aff.ms_id1
         JOIN manuscripts ms2 ON ms2.ms_id = aff.ms_id2
-        JOIN apparatus_cliques_view q1 ON q1.ms_id = aff.ms_id1 AND q1.pass_id = :pass_id
-        JOIN apparatus_cliques_view q2 ON q2.ms_id = aff.ms_id2 AND q2.pass_id = :pass_id
+        JOIN {apparatus_cliques} q1 ON q1.ms_id = aff.ms_id1 AND q1.pass_id = :pass_id
+        JOIN {apparatus_cliques} q2 ON q2.ms_id = aff.ms_id2 AND q2.pass_id = :pass_id
         JOIN locstem l ON (l.pass_id, l.labez, l.clique) = (q2.pass_id, q2.labez, q2.clique)
       WHERE ms_id1 NOT IN :exclude
         AND ms_id2 NOT IN :exclude
@@ -112,6 +136,7 @@ def congruence(conn, passage):
         pass_id=passage.pass_id,
         connectivity=5,
         exclude=(2,),
+        **apparatus_tables(conn)
     ))
 
     Ranks = collections.namedtuple(
@@ -123,6 +148,75 @@ def congruence(conn, passage):
     return ranks
 
 
+def find_incongruences(val, ms_ids, anc, start, end, connectivity):
+    """Find the manuscripts that fail both congruence rules.
+
+    Checks every manuscript in every passage of a range against its closest
+    potential ancestors.  Readings are compared by the bitmasks of their nodes
+    in the local stemma, see :attr:`CBGM_Params.mask_matrix`, the sources are
+    taken from :attr:`CBGM_Params.source_matrix`.  The passages are processed in
+    chunks of CONGRUENCE_CHUNK_SIZE.
+
+    If a reading has more than one source, rule 2 holds if the highest potential
+    ancestor reads any one of them.  Readings whose only source is '?' are not
+    checked.
+
+    :param CBGM_Params val: the params of the set cover
+    :param ms_ids: the ms_ids of the descendants
+    :param anc: the ms_ids of their ancestors, see :meth:`helpers.Ranking.top`
+    :param int start: the numpy index of the first passage
+    :param int end: the numpy index of the passage after the last
+    :param int connectivity: the connectivity of rule 1
+    :return: tuple of arrays: pass_ids, ms_ids of the ancestors, ms_ids of the
+             descendants, ranks of the ancestors
+
+    """
+
+    desc = np.asarray(ms_ids, dtype=np.int32) - 1
+    valid = anc > 0
+    anc_idx = np.where(valid, anc - 1, 0)
+    certain = unpack_bits(val.certain_bits, val.n_passages)
+    unclear = np.uint64(1)
+
+    results = []
+    for j0 in range(start, end, CONGRUENCE_CHUNK_SIZE):
+        j1 = min(j0 + CONGRUENCE_CHUNK_SIZE, end)
+
+        mask = val.mask_matrix[:, j0:j1]
+        cert = certain[:, j0:j1]
+
+        # the descendants (ms x pass)
+        mask2 = mask[desc]
+        source2 = val.source_matrix[:, j0:j1][desc]
+        # their ancestors (ms x rank x pass), only rows where both are certain
+        mask1 = mask[anc_idx]
+        cert1 = cert[anc_idx] & valid[:, :, None] & cert[desc][:, None, :]
+        nonz1 = cert1 & (mask1 != 0)
+
+        row_no = np.cumsum(cert1, axis=1)
+        first = cert1.argmax(axis=1)
+        lq1 = np.take_along_axis(mask1, first[:, None, :], axis=1)[:, 0, :]
+        top = np.take_along_axis(mask1, nonz1.argmax(axis=1)[:, None, :], axis=1)[:, 0, :]
+
+        # rule 1: a pV(conn) has the reading x
+        rule1 = (cert1 & (row_no <= connectivity) & (mask1 == mask2[:, None, :])).any(axis=1)
+        # rule 2: the highest pV(!= zz) has the reading y, for any source y != ?
+        rule2 = nonz1.any(axis=1) & ((source2 & ~unclear & top) != 0)
+
+        failed = (cert1.any(axis=1)
+                  & (mask2 != 0) & (lq1 != 0) & (lq1 != mask2)
+                  & (source2 != unclear)
+                  & ~rule1 & ~rule2)
+
+        i, j = np.nonzero(failed)
+        rank = first[i, j]
+        results.append((j0 + j + 1, anc[i, rank], desc[i] + 1, rank + 1))
+
+    if not results:
+        return tuple(np.zeros(0, dtype=np.int32) for n in range(4))
+    return tuple(np.concatenate(a) for a in zip(*results))
+
+
 def congruence_list(conn, passage, range_id):
     """Check the congruence.
 
@@ -142,97 +236,50 @@ def congruence_list(conn, passage, range_id):
     Wenn Lesart x im lokalen Stemma von ? abhängt, ist keine Aussage möglich.
 
     Weitere Regel:
-    Wo A definiert ist, soll A wie jeder andere pV in die Kongruenzprüfung einbezogen werden.
+    Wo A definiert ist, soll A wie jeder andere pV in die Kongruenzprüfung einbezogen werden.
     -- email K. Wachtel 05.02.2021
+
+    The check runs in memory, see :func:`find_incongruences`.  Only the
+    readings and sigla of the failed manuscripts are read from the database.
     """
 
-    res = execute(conn, """
-    -- get the closest ancestors ms1 for every manuscript ms2
-    WITH ranked AS (
-      SELECT
-        ms_id1,
-        ms_id2,
-        rank () OVER (PARTITION BY ms_id2 ORDER BY affinity DESC, common, older, newer DESC, ms_id1) AS rank,
-        affinity
-      FROM affinity_p_view aff
-      WHERE ms_id1 NOT IN :exclude
-        AND ms_id2 NOT IN :exclude
-        AND aff.rg_id = :rg_id
-        AND aff.newer < aff.older
-        AND aff.common > aff.ms2_length / 2
-      ORDER BY ms_id2, affinity DESC
-    ),
+    connectivity = 5
+    exclude = (2,)
 
-    -- get readings
-    readings AS (
-      SELECT
-        p.pass_id,
-        p.begadr,
-        p.endadr,
-        r.ms_id1,
-        r.ms_id2,
-        r.rank,
-        q1.labez AS labez1,
-        q2.labez AS labez2,
-        q1.clique AS clique1,
-        q2.clique AS clique2,
-        labez_clique (q1.labez, q1.clique) as lq1,
-        labez_clique (q2.labez, q2.clique) as lq2,
-        l.source_labez  as source_l2,
-        l.source_clique as source_q2,
-        labez_clique (l.source_labez, l.source_clique) as source_lq2,
-        row_number () OVER (PARTITION BY p.pass_id, r.ms_id2 ORDER BY r.rank) as row_no,
-        count (*) FILTER (WHERE q1.labez !~ '^z') OVER (
-           PARTITION BY p.pass_id, r.ms_id2
-           ORDER BY r.rank
-           ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) as row_no_no_zz
-      FROM passages p
-        JOIN ranges rg ON (rg.rg_id = :range_id AND rg.passage @> p.passage)
-      CROSS JOIN ranked r
-        JOIN apparatus_cliques_view q1 ON q1.ms_id = r.ms_id1 AND q1.pass_id = p.pass_id
-        JOIN apparatus_cliques_view q2 ON q2.ms_id = r.ms_id2 AND q2.pass_id = p.pass_id
-        JOIN locstem l ON (l.pass_id, l.labez, l.clique) = (q2.pass_id, q2.labez, q2.clique)
-      WHERE q1.certainty = 1.0
-        AND q2.certainty = 1.0
-        AND r.rank <= 2 * :connectivity -- speed things up
-      ORDER BY pass_id, ms_id2, rank
-    )
+    val = current_app.config.cbgm_cache.get()
+    rg = next((r for r in val.ranges if str(r.rg_id) == str(range_id)), None)
+    if rg is None:
+        return []
 
-    -- output mss that fail both rules
+    # the closest ancestors of every manuscript
+    ranking = current_app.config.affinity_ranks.get(conn, passage.range_id('All'), 'sim', 'ms2')
+    ms_ids, anc = ranking.top(2 * connectivity, exclude, False)
+
+    pass_ids, ms_ids1, ms_ids2, ranks = find_incongruences(
+        val, ms_ids, anc, rg.start, rg.end, connectivity)
+
+    res = execute(conn, """
     SELECT
-      r.pass_id, r.begadr, r.endadr, ms1.hs AS hs1, ms2.hs AS hs2, r.ms_id1, r.ms_id2, r.lq1, r.lq2, r.rank
-    FROM readings r
+      r.pass_id, p.begadr, p.endadr, ms1.hs AS hs1, ms2.hs AS hs2, r.ms_id1, r.ms_id2,
+      q1.labez_clique AS lq1, q2.labez_clique AS lq2, r.rank
+    FROM unnest (CAST (:pass_ids AS INTEGER[]),
+                 CAST (:ms_ids1  AS INTEGER[]),
+                 CAST (:ms_ids2  AS INTEGER[]),
+                 CAST (:ranks    AS INTEGER[])) AS r (pass_id, ms_id1, ms_id2, rank)
+      JOIN passages p USING (pass_id)
       JOIN manuscripts ms1 ON ms1.ms_id = r.ms_id1
       JOIN manuscripts ms2 ON ms2.ms_id = r.ms_id2
-    WHERE r.lq2       != lq1
-      AND r.labez1    !~ '^z'
-      AND r.labez2    !~ '^z'
-      AND r.source_l2 != '?'
-      AND r.row_no    = 1
-      -- ancestor ms1 reads different from descendant ms2
-      AND -- ms2 fails rule 1 (muß einen pV(conn=5) der Lesart x haben)
-        NOT EXISTS (
-          SELECT 1 FROM readings c
-          WHERE c.ms_id2  = r.ms_id2
-            AND c.pass_id = r.pass_id
-            AND c.lq1     = r.lq2
-            AND c.row_no <= :connectivity
-        )
-      AND -- ms2 fails rule 2 (der höchste pV(!= zz) muß die Lesart y haben)
-        NOT EXISTS (
-          SELECT 1 FROM readings c
-          WHERE c.ms_id2  = r.ms_id2
-            AND c.pass_id = r.pass_id
-            AND c.lq1     = r.source_lq2
-            AND c.row_no_no_zz = 1
-        )
-
+      JOIN {apparatus_cliques} q1 ON (q1.pass_id, q1.ms_id) = (r.pass_id, r.ms_id1)
+      JOIN {apparatus_cliques} q2 ON (q2.pass_id, q2.ms_id) = (r.pass_id, r.ms_id2)
+    WHERE q1.certainty = 1.0
+      AND q2.certainty = 1.0
     ORDER BY pass_id, ms1.hsnr
     """, dict(
-        rg_id=passage.range_id('All'),
-        range_id=range_id,
-        connectivity=5,
-        exclude=(2,),
+        pass_ids=pass_ids.tolist(),
+        ms_ids1=ms_ids1.tolist(),
+        ms_ids2=ms_ids2.tolist(),
+        ranks=ranks.tolist(),
+        **apparatus_tables(conn)
     ))
 
     Ranks = collections.namedtuple(
@@ -246,6 +293,129 @@ def congruence_list(conn, passage, range_id):
     return ranks
 
 
+def cached_congruence_list(conn, range_id):
+    """Return the congruence list of a range.
+
+    The lists are cached by range and database version.  A list is only
+    stored if the CBGM params used to build it are up to date, see
+    :meth:`set_cover.ParamsCache.is_current`.
+
+    """
+
+    cache = current_app.config.congruence_cache
+    key = cache.make_key('congruence', change_marker(conn, CONGRUENCE_TABLES), str(range_id))
+
+    data = cache.get(key)
+    if data is not None:
+        return json.loads(data.decode('utf-8'))
+
+    ranks = congruence_list(conn, Passage(conn, 1), range_id)
+    if current_app.config.cbgm_cache.is_current(conn):
+        cache.put(key, json.dumps(ranks).encode('utf-8'))
+    return ranks
+
+
+class CongruenceJob():
+    """The congruence check of many ranges running in the background."""
+
+    def __init__(self, rg_ids):
+        self.job_id   = uuid.uuid4().hex
+        self.rg_ids   = list(rg_ids)
+        self.status   = 'queued'
+        self.results  = {}
+        self.error    = None
+        self.started  = time.time()
+        self.finished = None
+        self.event    = threading.Event()
+
+    def to_json(self, results=False):
+        d = {
+            'job_id'   : self.job_id,
+            'status'   : self.status,
+            'rg_ids'   : self.rg_ids,
+            'done'     : len(self.results),
+            'total'    : len(self.rg_ids),
+            'error'    : self.error,
+            'started'  : self.started,
+            'finished' : self.finished,
+        }
+        if results and self.status == 'done':
+            d['results'] = [ { 'rg_id' : rg_id, 'ranks' : self.results[rg_id] } for rg_id in self.rg_ids ]
+        return d
+
+
+class CongruenceJobs():
+    """Run congruence checks of many ranges in a pool of worker threads.
+
+    Every range is one task in the pool.  Ranges already in the cache are
+    served from there, see :func:`cached_congruence_list`.  A job for the
+    same ranges as a job still running returns the running job.
+
+    """
+
+    def __init__(self, app, workers=2):
+        self.app      = app
+        self.lock     = threading.Lock()
+        self.jobs     = collections.OrderedDict()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='congruence')
+
+    def submit(self, rg_ids):
+        """ Start a job.  Return the :class:`CongruenceJob`. """
+
+        rg_ids = list(rg_ids)
+        with self.lock:
+            for job in self.jobs.values():
+                if job.rg_ids == rg_ids and job.status in ('queued', 'running'):
+                    return job
+
+            job = CongruenceJob(rg_ids)
+            self.jobs[job.job_id] = job
+            while len(self.jobs) > MAX_JOBS:
+                self.jobs.popitem(last=False)
+
+        if not rg_ids:
+            self._finish(job, 'done')
+        for rg_id in rg_ids:
+            self.executor.submit(self._run, job, rg_id)
+        return job
+
+    def get(self, job_id):
+        """ Return the job or None. """
+
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _finish(self, job, status, error=None):
+        job.status   = status
+        job.error    = error
+        job.finished = time.time()
+        job.event.set()
+
+    def _run(self, job, rg_id):
+        with self.lock:
+            if job.status == 'failed':
+                return
+            job.status = 'running'
+
+        try:
+            with self.app.app_context():
+                with self.app.config.dba.engine.begin() as conn:
+                    ranks = cached_congruence_list(conn, rg_id)
+        except Exception as e:  # pylint: disable=broad-except
+            tools.log(logging.ERROR, 'Congruence check of range %s failed: %s' % (rg_id, e))
+            with self.lock:
+                self._finish(job, 'failed', str(e))
+            return
+
+        with self.lock:
+            if job.status == 'failed':
+                return
+            job.results[rg_id] = ranks
+            if len(job.results) == len(job.rg_ids):
+                self._finish(job, 'done')
+
+
 @bp.route('/checks/congruence.json/<passage_or_id>')
 def congruence_json(passage_or_id):
     """ Endpoint: check the congruence """
@@ -260,5 +430,37 @@ def congruence_list_json(range_id):
     """ Endpoint: check the congruence """
 
     with current_app.config.dba.engine.begin() as conn:
-        passage = Passage(conn, 1)
-        return make_json_response(congruence_list(conn, passage, range_id))
+        return make_json_response(cached_congruence_list(conn, range_id))
+
+
+@bp.route('/checks/congruence_jobs.json', methods=['POST'])
+def congruence_jobs_json():
+    """Endpoint: start a congruence check of many ranges
+
+    The ranges are given as rg_id[].  Default is all ranges except 'All'.
+    Poll the returned job for progress.
+    """
+
+    rg_ids = [int(rg_id) for rg_id in request.values.getlist('rg_id[]')]
+    if not rg_ids:
+        with current_app.config.dba.engine.begin() as conn:
+            res = execute(conn, """
+            SELECT rg_id
+            FROM ranges
+            WHERE range != 'All'
+            ORDER BY lower (passage), upper (passage) DESC
+            """, {})
+            rg_ids = [r[0] for r in res]
+
+    job = current_app.config.congruence_jobs.submit(rg_ids)
+    return make_json_response(job.to_json(), 202)
+
+
+@bp.route('/checks/congruence_jobs.json/<job_id>')
+def congruence_job_json(job_id):
+    """Endpoint: the progress of a congruence job, and the results when done """
+
+    job = current_app.config.congruence_jobs.get(job_id)
+    if job is None:
+        raise EditError('Unknown job: %s' % job_id, 404)
+    return make_json_response(job.to_json(True))
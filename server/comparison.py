@@ -7,15 +7,23 @@ import collections
 import flask
 from flask import request, current_app
 
+import numpy as np
+
 from ntg_common.db_tools import execute
+from ntg_common.exceptions import EditError
 
 from login import auth
-from helpers import csvify, parameters, Passage, Manuscript
+from helpers import csvify, parameters, Passage, Manuscript, make_json_response, \
+     apparatus_tables
 
 
 bp = flask.Blueprint ('comparison', __name__)
 
 
+MAX_COMPARISONS = 100
+""" The max. no. of witnesses to compare with one witness in one request. """
+
+
 def init_app (_app):
     """ Initialize the flask app. """
 
@@ -98,6 +106,82 @@ def comparison_summary ():
         return list (map (_ComparisonRowCalcFields._make, res))
 
 
+_MultiComparisonRow = collections.namedtuple (
+    'MultiComparisonRow',
+    ('ms_id2', 'hs2') + _ComparisonRow._fields
+)
+
+
+class _MultiComparisonRowCalcFields (_MultiComparisonRow):
+    __slots__ = ()
+
+    _fields = _MultiComparisonRow._fields + ('norel', )
+
+    @property
+    def norel (self):
+        return self.common - self.equal - self.older - self.newer - self.unclear
+
+    def _asdict (self):
+        return collections.OrderedDict (zip (self._fields, self + (self.norel, )))
+
+
+def comparison_summary_multi ():
+    """Output comparison of 1 witness with many witnesses, chapter summary.
+
+    Like :func:`comparison_summary` for ms1 and every one of ms2[], but ranks
+    all pairs in one query.  If ms2 is an ancestor of ms1 the rank is that of
+    ms2 among the ancestors of ms1, else that of ms1 among the ancestors of
+    ms2.
+
+    :return: tuple of ms1, the list of ms2 and the rows ordered by range and
+             ms2
+
+    """
+
+    with current_app.config.dba.engine.begin () as conn:
+        ms1  = Manuscript (conn, request.args.get ('ms1') or 'A')
+        mss2 = collections.OrderedDict ()
+        for hs_hsnr_id in request.args.getlist ('ms2[]'):
+            ms = Manuscript (conn, hs_hsnr_id)
+            mss2[ms.ms_id] = ms
+        mss2 = list (mss2.values ())
+
+        if len (mss2) > MAX_COMPARISONS:
+            raise EditError ('Too many witnesses selected.  The maximum is %d.' % MAX_COMPARISONS)
+
+        res = execute (conn, """
+        WITH ranks AS (
+          SELECT rg_id, ms_id1, ms_id2,
+                 rank () OVER (PARTITION BY rg_id ORDER BY affinity DESC) AS rank
+          FROM affinity
+          WHERE ms_id1 = :ms_id1
+            AND {prefix}newer > {prefix}older
+
+          UNION ALL
+
+          SELECT rg_id, ms_id1, ms_id2,
+                 rank () OVER (PARTITION BY rg_id, ms_id2 ORDER BY affinity DESC) AS rank
+          FROM affinity
+          WHERE ms_id2 = ANY (:ms_ids2)
+            AND {prefix}newer < {prefix}older
+        )
+
+        SELECT a.ms_id2, a.rg_id, a.range, a.common, a.equal,
+               a.older, a.newer, a.unclear, a.affinity, r.rank, ms1_length, ms2_length
+        FROM {view} a
+        LEFT JOIN ranks r USING (rg_id, ms_id1, ms_id2)
+        WHERE a.ms_id1 = :ms_id1 AND a.ms_id2 = ANY (:ms_ids2)
+        """, dict (parameters, ms_id1 = ms1.ms_id, ms_ids2 = [ms.ms_id for ms in mss2],
+                   view = 'affinity_p_view', prefix = 'p_'))
+
+        columns = { ms.ms_id : i for i, ms in enumerate (mss2) }
+        rows = [ _MultiComparisonRowCalcFields._make ((r[0], mss2[columns[r[0]]].hs) + tuple (r[1:]))
+                 for r in res ]
+        rows.sort (key = lambda row: (row.rg_id, columns[row.ms_id2]))
+
+        return ms1, mss2, rows
+
+
 _ComparisonDetailRow = collections.namedtuple (
     'ComparisonDetailRow',
     'pass_id begadr endadr labez_clique1 lesart1 labez_clique2 lesart2 older newer unclear'
@@ -124,31 +208,57 @@ def comparison_detail ():
     """Output comparison of 2 witnesses, chapter detail.
 
     Outputs a detail of the differences between 2 manuscripts in one chapter.
+
+    The relationships of the readings are computed from the bitmasks of the
+    local stemmata, see :attr:`CBGM_Params.mask_matrix` and
+    :attr:`CBGM_Params.source_matrix`.  Only the readings of the differing
+    passages are read from the database.
     """
 
+    val = current_app.config.cbgm_cache.get ()
+
     with current_app.config.dba.engine.begin () as conn:
         ms1 = Manuscript (conn, request.args.get ('ms1') or 'A')
         ms2 = Manuscript (conn, request.args.get ('ms2') or 'A')
         range_ = request.args.get ('range') or 'All'
 
+        rg = next ((r for r in val.ranges if r.range == range_), None)
+        if rg is None:
+            return []
+
+        mask1   = val.mask_matrix[ms1.ms_id - 1, rg.start:rg.end]
+        mask2   = val.mask_matrix[ms2.ms_id - 1, rg.start:rg.end]
+        source1 = val.source_matrix[ms1.ms_id - 1, rg.start:rg.end]
+        source2 = val.source_matrix[ms2.ms_id - 1, rg.start:rg.end]
+
+        # mask == 0 for lacunae and readings not used in the CBGM
+        differ  = np.flatnonzero ((mask1 != 0) & (mask2 != 0) & (mask1 != mask2))
+        older   = (mask1 & source2) != 0
+        newer   = (mask2 & source1) != 0
+        unclear = ((source1 | source2) & np.uint64 (1)) != 0
+
+        # rows with different cliques of the same labez drop out here
         res = execute (conn, """
         SELECT p.pass_id, p.begadr, p.endadr, v1.labez_clique, v1.lesart,
-                                              v2.labez_clique, v2.lesart,
-          is_p_older (p.pass_id, v1.labez, v1.clique, v2.labez, v2.clique) AS older,
-          is_p_older (p.pass_id, v2.labez, v2.clique, v1.labez, v1.clique) AS newer,
-          is_p_unclear (p.pass_id, v1.labez, v1.clique) OR
-          is_p_unclear (p.pass_id, v2.labez, v2.clique) AS unclear
-        FROM (SELECT * FROM ranges WHERE range = :range_) r
-          JOIN passages p ON (r.passage @> p.passage )
-          JOIN apparatus_cliques_view v1 USING (pass_id)
-          JOIN apparatus_cliques_view v2 USING (pass_id)
-        WHERE v1.ms_id = :ms1 AND v2.ms_id = :ms2
-          AND v1.labez != v2.labez AND v1.labez !~ '^z' AND v2.labez !~ '^z'
+                                              v2.labez_clique, v2.lesart
+        FROM passages p
+          JOIN {apparatus_cliques} v1 USING (pass_id)
+          JOIN {apparatus_cliques} v2 USING (pass_id)
+        WHERE p.pass_id = ANY (:pass_ids)
+          AND v1.ms_id = :ms1 AND v2.ms_id = :ms2
+          AND v1.labez != v2.labez
           AND v1.cbgm AND v2.cbgm
         ORDER BY p.pass_id
-        """, dict (parameters, ms1 = ms1.ms_id, ms2 = ms2.ms_id, range_ = range_))
+        """, dict (parameters, ms1 = ms1.ms_id, ms2 = ms2.ms_id,
+                   pass_ids = (differ + rg.start + 1).tolist (),
+                   **apparatus_tables (conn)))
 
-        return list (map (_ComparisonDetailRowCalcFields._make, res))
+        rows = []
+        for row in res:
+            j = row[0] - rg.start - 1
+            rows.append (_ComparisonDetailRowCalcFields._make (
+                tuple (row) + (bool (older[j]), bool (newer[j]), bool (unclear[j]))))
+        return rows
 
 
 @bp.route ('/comparison-summary.csv')
@@ -160,6 +270,47 @@ def comparison_summary_csv ():
     return csvify (_ComparisonRowCalcFields._fields, comparison_summary ())
 
 
+@bp.route ('/comparison-summary-multi.csv')
+def comparison_summary_multi_csv ():
+    """Endpoint. Serve a CSV table. (see also :func:`comparison_summary_multi`)"""
+
+    auth ()
+
+    _ms1, _mss2, rows = comparison_summary_multi ()
+    return csvify (_MultiComparisonRowCalcFields._fields, rows)
+
+
+@bp.route ('/comparison-summary-multi.json')
+def comparison_summary_multi_json ():
+    """Endpoint. Serve a matrix of ranges x ms2.
+
+    Every cell is one row of :func:`comparison_summary_multi` or null if the
+    affinity table has no row for the two witnesses in the range.
+
+    """
+
+    auth ()
+
+    ms1, mss2, rows = comparison_summary_multi ()
+
+    columns = { ms.ms_id : i for i, ms in enumerate (mss2) }
+    ranges  = collections.OrderedDict ()
+    for row in rows:
+        if row.rg_id not in ranges:
+            ranges[row.rg_id] = {
+                'rg_id' : row.rg_id,
+                'range' : row.range,
+                'cells' : [None] * len (mss2),
+            }
+        ranges[row.rg_id]['cells'][columns[row.ms_id2]] = row._asdict ()
+
+    return make_json_response ({
+        'ms1'    : ms1.to_json (),
+        'mss2'   : [ms.to_json () for ms in mss2],
+        'ranges' : list (ranges.values ()),
+    })
+
+
 @bp.route ('/comparison-detail.csv')
 def comparison_detail_csv ():
     """Endpoint. Serve a CSV table. (see also :func:`comparison_detail`)"""
@@ -14,6 +14,7 @@ import sqlalchemy
 
 from ntg_common import tools
 from ntg_common import db_tools
+from ntg_common import cbgm_common
 from ntg_common.exceptions import EditError, PrivilegeError
 from ntg_common.db_tools import execute
 
@@ -88,6 +89,9 @@ def stemma_edit (passage_or_id):
         SET LOCAL ntg.user_id = :user_id;
         """, dict (parameters, **params))
 
+        # the pre- and post-coherence counts before the edit
+        counts_old = cbgm_common.calculate_passage_counts (conn, parameters, passage.pass_id)
+
         if action == 'move':
             # reassign a source reading
             # there may be multiple existent assignments, there'll be only one left
@@ -226,6 +230,20 @@ def stemma_edit (passage_or_id):
 
             tools.log (logging.INFO, 'Moved ms_ids: ' + str (ms_ids))
 
+        # the edit may have changed the original reading
+        cbgm_common.update_A_text (conn, parameters, passage.pass_id)
+
+        # update the affinity table with the new counts
+        counts_new = cbgm_common.calculate_passage_counts (conn, parameters, passage.pass_id)
+        cbgm_common.update_affinity_table (conn, parameters, passage.pass_id, counts_old, counts_new)
+
+        # update the cached masks of the set cover
+        current_app.config.cbgm_cache.update_passage (conn, parameters, passage.pass_id)
+
+        # drop the cached affinity rankings and global textflow diagrams
+        current_app.config.affinity_ranks.invalidate ()
+        current_app.config.textflow_cache.clear ()
+
         # return the changed passage
         passage = Passage (conn, passage_or_id)
         return make_json_response (passage.to_json ())
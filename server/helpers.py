@@ -4,16 +4,25 @@
 """ An application server for CBGM.  Helper classes. """
 
 import collections
+import concurrent.futures
+import csv
+import hashlib
+import io
 import itertools
+import logging
 import re
 import os
 import os.path
+import threading
+import time
 
 import flask
+from flask import current_app
 import flask_login
+import numpy as np
 
 from ntg_common import tools
-from ntg_common.db_tools import execute, to_csv
+from ntg_common.db_tools import execute, to_csv, change_marker, fetch_arrays
 
 
 parameters = dict ()
@@ -71,6 +80,463 @@ class Bag ():
     """ Class to stick values in. """
 
 
+LOOKUP_CHECK_INTERVAL = 10
+""" Check the lookup tables for changes at most this often (in seconds). """
+
+
+class LookupTables ():
+    """In-memory index of the manuscripts, passages, and ranges of one app.
+
+    :class:`Manuscript` and :class:`Passage` look themselves up in this index
+    instead of querying the database every time.  The index is loaded on first
+    use and reloaded when the underlying tables change.  Lookups that miss the
+    index fall back to the database.
+
+    """
+
+    TABLES = ('manuscripts', 'passages', 'ranges')
+
+    def __init__ (self):
+        self.lock        = threading.Lock ()
+        self.marker      = None
+        self.checked     = 0.0
+        self.manuscripts = {}
+        """ (where, param) -> (ms_id, hs, hsnr) with where in ms_id, hs, hsnr """
+        self.passages    = {}
+        """ pass_id or (begadr, endadr) -> (pass_id, begadr, endadr, bk_id, chapter) """
+        self.ranges      = {}
+        """ (bk_id, range) -> rg_id """
+
+
+    def refresh (self, conn):
+        """Reload the index if the tables have changed.
+
+        Asks the database at most every :data:`LOOKUP_CHECK_INTERVAL` seconds.
+
+        """
+
+        if self.marker is not None and time.monotonic () - self.checked < LOOKUP_CHECK_INTERVAL:
+            return
+
+        with self.lock:
+            if self.marker is not None and time.monotonic () - self.checked < LOOKUP_CHECK_INTERVAL:
+                return
+            self.checked = time.monotonic ()
+
+            marker = change_marker (conn, self.TABLES)
+            if marker == self.marker:
+                return
+
+            manuscripts = {}
+            res = execute (conn, """
+            SELECT ms_id, hs, hsnr
+            FROM manuscripts
+            """, dict (parameters))
+            for row in res:
+                row = tuple (row)
+                manuscripts[('ms_id', row[0])] = row
+                manuscripts[('hs',    row[1])] = row
+                manuscripts[('hsnr',  row[2])] = row
+
+            passages = {}
+            res = execute (conn, """
+            SELECT pass_id, begadr, endadr, adr2bk_id (begadr), adr2chapter (begadr)
+            FROM passages
+            """, dict (parameters))
+            for row in res:
+                row = tuple (row)
+                passages[row[0]] = row
+                passages[(row[1], row[2])] = row
+
+            res = execute (conn, """
+            SELECT bk_id, range, rg_id
+            FROM ranges_view
+            """, dict (parameters))
+            ranges = { (bk_id, range_) : rg_id for bk_id, range_, rg_id in res }
+
+            self.manuscripts, self.passages, self.ranges = manuscripts, passages, ranges
+            self.marker = marker
+
+            tools.log (logging.INFO, "Loaded lookup tables: %d mss., %d passages, %d ranges" %
+                       (len (manuscripts) // 3, len (passages) // 2, len (ranges)))
+
+
+    def manuscript (self, conn, where, param):
+        self.refresh (conn)
+        return self.manuscripts.get ((where, param))
+
+
+    def passage (self, conn, key):
+        self.refresh (conn)
+        return self.passages.get (key)
+
+
+    def range_id (self, conn, bk_id, range_):
+        self.refresh (conn)
+        return self.ranges.get ((bk_id, range_))
+
+
+RANKS_CHECK_INTERVAL = 10
+""" Check the affinity table for changes at most this often (in seconds). """
+
+MAX_RANKINGS = 16
+""" Keep at most this many rankings in memory. """
+
+
+class Ranking ():
+    """The potential ancestors of every manuscript in one range, in rank order.
+
+    Only the order is stored.  The rank of an ancestor depends on which other
+    ancestors the request excludes, so it is assigned at request time.
+
+    """
+
+    def __init__ (self, ms_id1, ms_id2, full):
+        # rows are sorted by ms_id1, then by rank
+        self.ms_id2 = ms_id2
+        self.full   = full
+        self.ms_ids = np.unique (ms_id1)
+        self.starts = np.append (np.searchsorted (ms_id1, self.ms_ids), len (ms_id1))
+        self.tops   = dict ()
+
+
+    def ancestors (self, ms_id, exclude = (), fragments = True, limit = None):
+        """Return the potential ancestors of a manuscript in rank order.
+
+        :param int ms_id: the descendant
+        :param exclude: ms_ids of ancestors to skip.  They do not take a rank.
+        :param bool fragments: if False skip ancestors that share no more than
+                               half of the passages of the descendant
+        :param int limit: return at most this many ancestors
+        :return: list of ms_ids, the first has rank 1
+
+        """
+
+        i = np.searchsorted (self.ms_ids, ms_id)
+        if i == len (self.ms_ids) or self.ms_ids[i] != ms_id:
+            return []
+
+        seg  = slice (self.starts[i], self.starts[i + 1])
+        anc  = self.ms_id2[seg]
+        keep = ~np.isin (anc, list (exclude))
+        if not fragments:
+            keep &= self.full[seg]
+        return anc[keep][:limit].tolist ()
+
+
+    def top (self, k, exclude = (), fragments = True):
+        """Return the k closest potential ancestors of all manuscripts.
+
+        The index is built on first use and kept with the ranking.
+
+        :param int k: the no. of ancestors
+        :return: tuple of the descendants' ms_ids and an int32 matrix (len
+                 (ms_ids) x k) with the ms_ids of their ancestors in rank order,
+                 padded with 0
+
+        """
+
+        key = (k, tuple (sorted (exclude)), fragments)
+        if key not in self.tops:
+            ms_ids = self.ms_ids[~np.isin (self.ms_ids, list (exclude))]
+            anc = np.zeros ((len (ms_ids), k), dtype = np.int32)
+            for i, ms_id in enumerate (ms_ids.tolist ()):
+                ancestors = self.ancestors (ms_id, exclude, fragments, k)
+                anc[i, :len (ancestors)] = ancestors
+            self.tops[key] = (ms_ids, anc)
+        return self.tops[key]
+
+
+class AffinityRanks ():
+    """Cache of the ranked potential ancestors of all manuscripts.
+
+    Ranking the affinity table with a window function on every request is
+    slow.  This cache sorts the table once per range and mode and keeps the
+    result in memory until the affinity table changes.
+
+    Two orders are known: 'ms1' is the order of the textflow and relatives
+    queries, which rank the rows of the descendant.  'ms2' is the order of the
+    congruence checks, which rank the rows of the ancestor.  They differ only
+    in how they break ties.
+
+    """
+
+    VIEWS = {
+        'sim' : 'affinity_p_view',
+        'rec' : 'affinity_view',
+    }
+
+    ORDERS = {
+        'ms1' : 'affinity DESC, common, older, newer DESC, ms_id2',
+        'ms2' : 'affinity DESC, common, newer, older DESC, ms_id2',
+    }
+
+    TABLES = ('affinity', 'ms_ranges')
+
+    def __init__ (self):
+        self.lock       = threading.Lock ()
+        self.marker     = None
+        self.checked    = 0.0
+        self.generation = 0
+        self.rankings   = collections.OrderedDict ()
+        self.loading    = {}
+
+
+    def invalidate (self):
+        """ Drop all rankings, eg. after an edit changed the affinity table. """
+
+        with self.lock:
+            self._clear ()
+            self.marker = None
+
+
+    def _clear (self):
+        # rankings still loading are not stored when they are done
+        self.rankings.clear ()
+        self.loading.clear ()
+        self.generation += 1
+
+
+    def get (self, conn, rg_id, mode = 'sim', order = 'ms1'):
+        """Return the :class:`Ranking` of a range.
+
+        :param int rg_id: the range
+        :param str mode: 'sim' or 'rec'
+        :param str order: 'ms1' or 'ms2'
+
+        """
+
+        mode = 'rec' if mode == 'rec' else 'sim'
+        key  = (rg_id, mode, order)
+
+        # hold the lock only for the bookkeeping, not while loading
+        with self.lock:
+            if self.marker is None or time.monotonic () - self.checked >= RANKS_CHECK_INTERVAL:
+                self.checked = time.monotonic ()
+                marker = change_marker (conn, self.TABLES)
+                if marker != self.marker:
+                    self._clear ()
+                    self.marker = marker
+
+            if key in self.rankings:
+                self.rankings.move_to_end (key)
+                return self.rankings[key]
+
+            # concurrent requests for the same ranking wait for the first one
+            future = self.loading.get (key)
+            owner  = future is None
+            if owner:
+                future = concurrent.futures.Future ()
+                self.loading[key] = future
+            generation = self.generation
+
+        if not owner:
+            return future.result ()
+
+        try:
+            res = execute (conn, """
+            SELECT ms_id1, ms_id2, common > ms1_length / 2
+            FROM {view}
+            WHERE rg_id = :rg_id AND newer > older
+            ORDER BY ms_id1, {order}
+            """, dict (parameters, rg_id = rg_id,
+                       view = self.VIEWS[mode], order = self.ORDERS[order]))
+
+            ranking = Ranking (*fetch_arrays (res, [np.int32, np.int32, np.bool_]))
+        except Exception as e:
+            with self.lock:
+                if self.loading.get (key) is future:
+                    del self.loading[key]
+            future.set_exception (e)
+            raise
+
+        with self.lock:
+            if self.generation == generation:
+                self.rankings[key] = ranking
+                while len (self.rankings) > MAX_RANKINGS:
+                    self.rankings.popitem (last = False)
+            if self.loading.get (key) is future:
+                del self.loading[key]
+
+        future.set_result (ranking)
+        return ranking
+
+
+class RenderCache ():
+    """An LRU cache of rendered diagrams.
+
+    Keeps the most recently used entries in memory.  If a directory is given,
+    also stores all entries there, so that all server processes and the
+    commandline scripts can share them.  The directory is pruned to
+    `max_files` entries, least recently used first.
+
+    """
+
+    PRUNE_INTERVAL = 100
+    """ Prune the directory after this many writes. """
+
+    def __init__ (self, max_entries, cache_dir = None, max_files = 10000):
+        self.lock        = threading.Lock ()
+        self.max_entries = max_entries
+        self.cache_dir   = cache_dir
+        self.max_files   = max_files
+        self.entries     = collections.OrderedDict ()
+        self.writes      = 0
+
+        if cache_dir:
+            os.makedirs (cache_dir, exist_ok = True)
+
+
+    @staticmethod
+    def make_key (*args):
+        """ Make a key from any number of hashable arguments. """
+
+        return hashlib.sha1 (repr (args).encode ('utf-8')).hexdigest ()
+
+
+    def _filename (self, key):
+        return os.path.join (self.cache_dir, key)
+
+
+    def get (self, key):
+        """ Return the cached data or None. """
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end (key)
+                return self.entries[key]
+
+        if self.cache_dir:
+            try:
+                with open (self._filename (key), 'rb') as fp:
+                    data = fp.read ()
+                os.utime (self._filename (key)) # mark as recently used
+            except OSError:
+                return None
+            self._put_memory (key, data)
+            return data
+
+        return None
+
+
+    def put (self, key, data):
+        """ Store data under key. """
+
+        self._put_memory (key, data)
+
+        if self.cache_dir:
+            filename = self._filename (key)
+            tmp_filename = '%s.%d.tmp' % (filename, os.getpid ())
+            try:
+                with open (tmp_filename, 'wb') as fp:
+                    fp.write (data)
+                os.replace (tmp_filename, filename)
+            except OSError as e:
+                tools.log (logging.WARNING, "Could not write render cache: %s" % e)
+                return
+
+            with self.lock:
+                self.writes += 1
+                prune = self.writes % self.PRUNE_INTERVAL == 0
+            if prune:
+                self.prune ()
+
+
+    def _put_memory (self, key, data):
+        with self.lock:
+            self.entries[key] = data
+            self.entries.move_to_end (key)
+            while len (self.entries) > self.max_entries:
+                self.entries.popitem (last = False)
+
+
+    def prune (self):
+        """ Remove the oldest files if the directory holds too many. """
+
+        try:
+            files = [e for e in os.scandir (self.cache_dir) if e.is_file ()]
+        except OSError:
+            return
+        if len (files) <= self.max_files:
+            return
+        files.sort (key = lambda e: e.stat ().st_mtime)
+        for e in files[:len (files) - self.max_files]:
+            try:
+                os.unlink (e.path)
+            except OSError:
+                pass
+
+
+    def clear (self):
+        """ Remove all entries. """
+
+        with self.lock:
+            self.entries.clear ()
+
+        if self.cache_dir:
+            try:
+                files = [e for e in os.scandir (self.cache_dir) if e.is_file ()]
+            except OSError:
+                return
+            for e in files:
+                try:
+                    os.unlink (e.path)
+                except OSError:
+                    pass
+
+
+def get_lookup_tables ():
+    """ Return the lookup tables of the current app or None. """
+
+    if flask.has_app_context ():
+        return getattr (current_app.config, 'lookup_tables', None)
+    return None
+
+
+APPARATUS_MAT_TABLES = {
+    'apparatus_cliques' : 'apparatus_cliques_mat',
+    'apparatus_agg'     : 'apparatus_agg_mat',
+}
+""" The materialized apparatus tables. """
+
+APPARATUS_VIEWS = {
+    'apparatus_cliques' : 'apparatus_cliques_view',
+    'apparatus_agg'     : 'apparatus_view_agg',
+}
+""" The views the materialized apparatus tables are built from. """
+
+
+def apparatus_tables (conn):
+    """Return the names of the apparatus tables to read from.
+
+    Use them as {apparatus_cliques} and {apparatus_agg} in the sql.  Databases
+    built before the materialized apparatus tables were added have only the
+    views, so fall back to the views there.  The database is checked once per
+    app.
+
+    """
+
+    tables = getattr (current_app.config, 'apparatus_tables', None)
+    if tables is None:
+        res = execute (conn, """
+        SELECT to_regclass ('apparatus_agg_mat') IS NOT NULL
+        """, {})
+        if res.fetchone ()[0]:
+            tables = APPARATUS_MAT_TABLES
+        else:
+            tools.log (logging.WARNING, "No materialized apparatus tables found.  Reading from the views.")
+            tables = APPARATUS_VIEWS
+        current_app.config.apparatus_tables = tables
+    return tables
+
+
+def init_app (app):
+    """ Initialize the flask app. """
+
+    app.config.lookup_tables  = LookupTables ()
+    app.config.affinity_ranks = AffinityRanks ()
+
+
 class Manuscript ():
     """ Represent one manuscript. """
 
@@ -96,13 +562,19 @@ class Manuscript ():
         else:
             return
 
-        res = execute (conn, """
-        SELECT ms_id, hs, hsnr
-        FROM manuscripts
-        WHERE {where} = :param
-        """, dict (parameters, where = where, param = param))
+        row = None
+        lookup = get_lookup_tables ()
+        if lookup is not None:
+            row = lookup.manuscript (conn, where, param)
+
+        if row is None:
+            res = execute (conn, """
+            SELECT ms_id, hs, hsnr
+            FROM manuscripts
+            WHERE {where} = :param
+            """, dict (parameters, where = where, param = param))
+            row = res.fetchone ()
 
-        row = res.fetchone ()
         if row is not None:
             self.ms_id, self.hs, self.hsnr = row
 
@@ -193,19 +665,30 @@ class Passage ():
         start, end =  self.fix (str (passage_or_id))
 
         if int (start) > 10000000:
-            res = execute (conn, """
-            SELECT pass_id, begadr, endadr, adr2bk_id (begadr), adr2chapter (begadr)
-            FROM passages
-            WHERE begadr = :begadr AND endadr = :endadr
-            """, dict (parameters, begadr = start, endadr = end))
+            key = (int (start), int (end))
         else:
-            res = execute (conn, """
-            SELECT pass_id, begadr, endadr, adr2bk_id (begadr), adr2chapter (begadr)
-            FROM passages
-            WHERE pass_id = :pass_id
-            """, dict (parameters, pass_id = start))
+            key = int (start)
+
+        row = None
+        lookup = get_lookup_tables ()
+        if lookup is not None:
+            row = lookup.passage (conn, key)
+
+        if row is None:
+            if int (start) > 10000000:
+                res = execute (conn, """
+                SELECT pass_id, begadr, endadr, adr2bk_id (begadr), adr2chapter (begadr)
+                FROM passages
+                WHERE begadr = :begadr AND endadr = :endadr
+                """, dict (parameters, begadr = start, endadr = end))
+            else:
+                res = execute (conn, """
+                SELECT pass_id, begadr, endadr, adr2bk_id (begadr), adr2chapter (begadr)
+                FROM passages
+                WHERE pass_id = :pass_id
+                """, dict (parameters, pass_id = start))
+            row = res.fetchone ()
 
-        row = res.fetchone ()
         if row is not None:
             self.pass_id, self.start, self.end, self.bk_id, self.chapter = row
 
@@ -277,6 +760,12 @@ class Passage ():
 
         range_ = range_ or str (self.chapter)
 
+        lookup = get_lookup_tables ()
+        if lookup is not None:
+            rg_id = lookup.range_id (self.conn, self.bk_id, range_)
+            if rg_id is not None:
+                return rg_id
+
         res = execute (self.conn, """
         SELECT rg_id
         FROM ranges_view
@@ -405,6 +894,56 @@ def csvify (fields, rows):
     return make_csv_response (to_csv (fields, rows))
 
 
+def csvify_stream (fields, rows, batch_size = 1000):
+    """ Send a HTTP response in CSV format.
+
+    Like :func:`csvify` but streams the rows as they are generated.  The rows
+    iterator runs after the view function has returned, so it must not use the
+    database connection.
+
+    """
+
+    def generate ():
+        fp = io.StringIO ()
+        writer = csv.DictWriter (fp, fields, restval='', extrasaction='raise', dialect='excel')
+        writer.writeheader ()
+        for n, r in enumerate (rows, 1):
+            writer.writerow (r._asdict ())
+            if n % batch_size == 0:
+                yield fp.getvalue ()
+                fp.seek (0)
+                fp.truncate ()
+        yield fp.getvalue ()
+
+    return flask.Response (generate (), 200, {
+        'content-type' : 'text/csv;charset=utf-8',
+        'Access-Control-Allow-Origin' : '*',
+    })
+
+
+def jsonlify_stream (objects, batch_size = 100):
+    """ Send a HTTP response in JSON lines format.
+
+    Streams one JSON object per line as they are generated.  The same caveat
+    as for :func:`csvify_stream` applies.
+
+    """
+
+    def generate ():
+        lines = []
+        for n, o in enumerate (objects, 1):
+            lines.append (flask.json.dumps (o) + '\n')
+            if n % batch_size == 0:
+                yield ''.join (lines)
+                lines = []
+        yield ''.join (lines)
+
+    return flask.Response (generate (), 200, {
+        'content-type' : 'application/x-ndjson;charset=utf-8',
+        'Access-Control-Allow-Origin' : '*',
+    })
+
+
 DOT_SKELETON = """
 strict digraph G {{
         graph [nodesep={nodesep},
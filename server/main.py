@@ -15,7 +15,7 @@ from ntg_common import tools
 
 from login import auth
 from helpers import parameters, Passage, Manuscript, cache, csvify, get_excluded_ms_ids, \
-     make_json_response
+     make_json_response, apparatus_tables
 
 bp = flask.Blueprint ('main', __name__)
 
@@ -333,9 +333,10 @@ def manuscript_full_json (passage_or_id, hs_hsnr_id):
         # Get the attestation(s) of the manuscript (may be uncertain eg. a/b/c)
         res = execute (conn, """
         SELECT labez, clique, labez_clique, certainty
-        FROM apparatus_view_agg
+        FROM {apparatus_agg}
         WHERE ms_id = :ms_id AND pass_id = :pass_id
-        """, dict (parameters, ms_id = ms.ms_id, pass_id = passage.pass_id))
+        """, dict (parameters, ms_id = ms.ms_id, pass_id = passage.pass_id,
+                   **apparatus_tables (conn)))
 
         row = res.fetchone ()
         if row is not None:
@@ -424,17 +425,14 @@ def relatives_csv (passage_or_id, hs_hsnr_id):
 
         exclude = get_excluded_ms_ids (conn, include)
 
+        # the ranks of the ancestors of this node
+        ranking   = current_app.config.affinity_ranks.get (conn, rg_id, mode)
+        ancestors = ranking.ancestors (ms.ms_id, exclude, 'fragments' in fragments)
+
         # Get the X most similar manuscripts and their attestations
         res = execute (conn, """
-        /* get the LIMIT closest ancestors for this node */
-        WITH ranks AS (
-          SELECT ms_id1, ms_id2,
-            rank () OVER (ORDER BY affinity DESC, common, older, newer DESC, ms_id2) AS rank,
-            affinity
-          FROM {view} aff
-          WHERE ms_id1 = :ms_id1 AND aff.rg_id = :rg_id AND ms_id2 NOT IN :exclude
-            AND newer > older {frag_where}
-          ORDER BY affinity DESC
+        WITH ranks (ms_id2, rank) AS (
+          SELECT * FROM unnest (CAST (:anc_ms_ids AS INTEGER[]), CAST (:anc_ranks AS INTEGER[]))
         )
 
         SELECT r.rank,
@@ -457,7 +455,7 @@ def relatives_csv (passage_or_id, hs_hsnr_id):
                a.certainty
         FROM
           {view} aff
-        JOIN apparatus_view_agg a
+        JOIN {apparatus_agg} a
           ON aff.ms_id2 = a.ms_id
         JOIN manuscripts ms
           ON aff.ms_id2 = ms.ms_id
@@ -471,7 +469,9 @@ def relatives_csv (passage_or_id, hs_hsnr_id):
         """, dict (parameters, where = where, frag_where = frag_where,
                    ms_id1 = ms.ms_id, hsnr = ms.hsnr,
                    pass_id = passage.pass_id, rg_id = rg_id, limit = limit,
-                   view = view, exclude = exclude))
+                   view = view, exclude = exclude, anc_ms_ids = ancestors,
+                   anc_ranks = list (range (1, len (ancestors) + 1)),
+                   **apparatus_tables (conn)))
 
         Relatives = collections.namedtuple (
             'Relatives',
@@ -503,10 +503,10 @@ def apparatus_json (passage_or_id):
         # list of labez_clique => manuscripts
         res = execute (conn, """
         SELECT labez, clique, labez_clique, labezsuf, reading (labez, lesart), ms_id, hs, hsnr, certainty
-        FROM apparatus_view_agg
+        FROM {apparatus_agg}
         WHERE pass_id = :pass_id
         ORDER BY hsnr, labez, clique
-        """, dict (parameters, pass_id = passage.pass_id))
+        """, dict (parameters, pass_id = passage.pass_id, **apparatus_tables (conn)))
 
         Manuscripts = collections.namedtuple (
             'Manuscripts',
@@ -7,20 +7,41 @@ See: CBGM_Pres.pdf p. 490ff.
 """
 
 import collections
+import copy
+import heapq
 import itertools
+import logging
+import threading
+import time
 
 import flask
 from flask import request, current_app
 
 import numpy as np
 
-from ntg_common.db_tools import execute
-from ntg_common.cbgm_common import CBGM_Params, create_labez_matrix
+from ntg_common.db_tools import execute, change_marker
+from ntg_common.cbgm_common import create_set_cover_params, update_passage_masks, \
+     potential_ancestors, set_cover, set_covers, pack_bits, unpack_bits, popcount, \
+     SNAPSHOT_TABLES
+from ntg_common.tools import log
+from ntg_common.exceptions import EditError
 
-from helpers import Passage, Manuscript, make_json_response, csvify
+from helpers import Passage, Manuscript, make_json_response, csvify, csvify_stream, \
+     jsonlify_stream, apparatus_tables
 
+MAX_SUBSTEMMA_SIZE = 20
+"""Max. no. of ancestors for which the optimal substemma search returns all
+2**n combinations."""
 
-MAX_COVER_SIZE = 12
+MAX_SUBSTEMMA_SEARCH_SIZE = 32
+"""Max. no. of ancestors the optimal substemma search accepts.  Above
+MAX_SUBSTEMMA_SIZE only the best combinations of each size are returned."""
+
+SUBSTEMMA_TOP_K = 10
+"""Default no. of combinations of each size returned by the top-k search."""
+
+CACHE_CHECK_INTERVAL = 10
+"""Min. no. of seconds between two checks of the database for changes."""
 
 
 bp = flask.Blueprint ('set_cover', __name__)
@@ -53,119 +74,138 @@ def powerset (iterable):
         itertools.combinations (s, r) for r in range (len (s) + 1))
 
 
-WITH_SELECT = """
-  SELECT pass_id, labez, clique,
-         (1 << (ROW_NUMBER () OVER (PARTITION BY pass_id ORDER BY labez, clique)::integer)) AS rn
-  FROM cliques
-  WHERE labez !~ '^z'
-"""
-
-def init (db):
-    """ Do some preparative calculations and cache the results. """
-
-    val = CBGM_Params ()
-
-    with db.engine.begin () as conn:
-        # get max number of different cliques in any one passage
-        res = execute (conn, """
-        SELECT MAX (c)
-        FROM (
-          SELECT COUNT ((labez, clique)) AS c
-          FROM locstem
-          WHERE labez !~ '^z'
-          GROUP BY pass_id
-        ) AS foo
-        """, {})
-        n_cliques = res.fetchone ()[0]
-        # see that the bitmask fits into uint64
-        # one bit is reserved for 'unknown' derivation
-        assert n_cliques < 64
-
-        # load all attestations into one big numpy array
-        create_labez_matrix (db, {}, val)
-
-        # build a mask of all readings of all mss.
-        # every labez_clique gets an id (in the range 1..63)
-
-        # Matrix mss x passages containing the bitmask of all manuscripts readings
-        val.mask_matrix = np.zeros ((val.n_mss, val.n_passages), dtype = np.uint64)
-
-        res = execute (conn, """
-        WITH rn AS (
-          {with}
-        )
-        SELECT msq.ms_id, msq.pass_id, rn1.rn
-        FROM ms_cliques AS msq
-        JOIN (select * from rn) as rn1
-          USING (pass_id, labez, clique)
-        """, { 'with' : WITH_SELECT })
-
-        mask_row = collections.namedtuple ('Mask_Row', 'ms_id, pass_id, shift')
-        for r in res:
-            mask = mask_row._make (r)
-            val.mask_matrix[mask.ms_id - 1, mask.pass_id - 1] = np.uint64 (mask.shift)
-
-    return val
-
+class ParamsCache ():
+    """A thread-safe cache of the :class:`CBGM_Params` of one application.
 
-def build_explain_matrix (conn, val, ms_id):
-    """Build the explain matrix.
-
-    A matrix of 1 x n_passages containing the bitmask of all those readings that
-    would explain the reading in the manuscript under scrutiny.
-
-    Bit 1 means: the reading stems from an unknown source.
-    Bit 2..64 are the bitmask of all cliques.
+    The first call to :meth:`get` builds the params.  Concurrent callers wait
+    for that one build.  After that :meth:`get` checks at most every
+    CACHE_CHECK_INTERVAL seconds if the database has changed, eg. by an edit in
+    another server process.  If so, it rebuilds the params in a background
+    thread and keeps returning the old params until the new ones are swapped
+    in.
 
     """
 
-    explain_matrix = np.zeros (val.n_passages, dtype = np.uint64)
-
-    res = execute (conn, """
-    WITH RECURSIVE
-    rn AS (
-      {with}
-    ),
-    lsrn AS (
-      SELECT ls.pass_id, ls.labez, ls.clique,
-        -- set 1 as flag for unknown derivation
-        CASE WHEN ls.source_labez = '?' THEN rn1.rn | 1 ELSE rn1.rn END AS rn1,
-        rn2.rn AS rn2
-      FROM locstem ls
-      JOIN rn as rn1
-        USING (pass_id, labez, clique)
-      LEFT JOIN rn as rn2
-        ON (ls.pass_id, ls.source_labez, ls.source_clique) = (rn2.pass_id, rn2.labez, rn2.clique)
-    ),
-    lsrec (pass_id, rn1, rn2) AS (
-      SELECT lsrn.pass_id, lsrn.rn1, lsrn.rn2
-      FROM ms_cliques AS msq
-        JOIN lsrn USING (pass_id, labez, clique)
-      WHERE ms_id = :ms_id
-    UNION
-      SELECT lsrn.pass_id, lsrn.rn1, lsrn.rn2
-      FROM lsrec
-      JOIN lsrn
-        ON (lsrn.pass_id = lsrec.pass_id AND (lsrn.rn1 & ~B'1'::integer) = lsrec.rn2)
-    )
-    SELECT pass_id, BIT_OR (rn1) AS rn
-    FROM lsrec
-    GROUP BY pass_id
-    ORDER BY pass_id;
-    """, { 'with' : WITH_SELECT, 'ms_id' : ms_id })
-
-    explain_row = collections.namedtuple ('Explain_Row', 'pass_id, mask')
-    for r in res:
-        mask = explain_row._make (r)
-        explain_matrix[mask.pass_id - 1] = np.uint64 (mask.mask)
-
-    return explain_matrix
+    def __init__ (self, dba, cache_dir = None):
+        self.dba        = dba
+        self.cache_dir  = cache_dir
+        self.lock       = threading.Lock ()
+        self.edit_lock  = threading.Lock ()
+        self.val        = None
+        self.marker     = None
+        self.checked    = 0.0
+        self.rebuilding = False
+        self.pending    = set ()
+
+    def _build (self):
+        """ Build the params.  Read the marker first, so we err on the safe side. """
+
+        with self.dba.engine.begin () as conn:
+            marker = change_marker (conn, SNAPSHOT_TABLES)
+        return create_set_cover_params (self.dba, self.cache_dir), marker
+
+    def get (self):
+        """ Return the current params. """
+
+        val = self.val
+        if val is None:
+            with self.lock:
+                if self.val is None:
+                    self.val, self.marker = self._build ()
+                    self.checked = time.monotonic ()
+                return self.val
+
+        if time.monotonic () - self.checked > CACHE_CHECK_INTERVAL:
+            self.check ()
+        return val
+
+    def check (self):
+        """ Start a rebuild if the database has changed. """
+
+        with self.lock:
+            now = time.monotonic ()
+            if self.rebuilding or now - self.checked <= CACHE_CHECK_INTERVAL:
+                return
+            self.checked = now
+
+        with self.dba.engine.begin () as conn:
+            marker = change_marker (conn, SNAPSHOT_TABLES)
+
+        with self.lock:
+            if self.rebuilding or marker == self.marker:
+                return
+            self.rebuilding = True
+
+        log (logging.INFO, "Database changed.  Rebuilding the CBGM params.")
+        threading.Thread (target = self._rebuild, daemon = True).start ()
+
+    def _rebuild (self):
+        """ Build new params in the background and swap them in. """
+
+        try:
+            val, marker = self._build ()
+            # apply the edits made during the rebuild
+            with self.lock:
+                pending, self.pending = self.pending, set ()
+            with self.dba.engine.begin () as conn:
+                for pass_id in sorted (pending):
+                    update_passage_masks (conn, {}, val, pass_id)
+            with self.lock:
+                self.val, self.marker = val, marker
+        except Exception as e: # pylint: disable=broad-except
+            log (logging.ERROR, "Rebuilding the CBGM params failed: %s" % e)
+        finally:
+            with self.lock:
+                self.rebuilding = False
+
+    def is_current (self, conn):
+        """ Return True if the params were built from the current database. """
+
+        marker = change_marker (conn, SNAPSHOT_TABLES)
+        with self.lock:
+            return self.val is not None and marker == self.marker
+
+    def update_passage (self, conn, parameters, pass_id):
+        """ Update the cached masks of a passage after an edit of its local stemma.
+
+        Call this in the transaction of the edit.  The masks are patched in a
+        copy of the params that is then swapped in, so readers never see a
+        half-patched passage.  If the params were current before the edit they
+        are current after it, so we take over the marker of the edit and do not
+        rebuild for our own edits.
+
+        """
+
+        with self.edit_lock:
+            with self.lock:
+                val = self.val
+                if self.rebuilding:
+                    self.pending.add (pass_id)
+            if val is None:
+                return
+
+            before = change_marker (conn, SNAPSHOT_TABLES, before_own_changes = True)
+
+            new_val = copy.copy (val)
+            for name in ('mask_matrix', 'explain_matrix', 'source_matrix', 'def_bits'):
+                a = getattr (val, name)
+                if a is not None:
+                    setattr (new_val, name, np.array (a))
+            update_passage_masks (conn, parameters, new_val, pass_id)
+
+            after = change_marker (conn, SNAPSHOT_TABLES)
+
+            with self.lock:
+                if self.val is val:
+                    self.val = new_val
+                    if before is not None and before == self.marker:
+                        self.marker = after
 
 
 def init_app (app):
     """ Init the Flask app. """
 
-    app.config.val = None
+    app.config.cbgm_cache = ParamsCache (app.config.dba, app.config.get ('CBGM_CACHE_DIR'))
 
 
 @bp.route ('/set-cover.json/<hs_hsnr_id>')
@@ -180,11 +220,7 @@ def set_cover_json (hs_hsnr_id):
     response   = {}
 
     with current_app.config.dba.engine.begin () as conn:
-        if current_app.config.val is None:
-            current_app.config.val = init (current_app.config.dba)
-        val = current_app.config.val
-
-        cover = []
+        val = current_app.config.cbgm_cache.get ()
 
         ms = Manuscript (conn, hs_hsnr_id)
         response['ms'] = ms.to_json ()
@@ -194,89 +230,25 @@ def set_cover_json (hs_hsnr_id):
         pre_selected = [ Manuscript (conn, anc_id) for anc_id in pre_select ]
         response['mss'] = [s.to_json () for s in pre_selected]
 
-        np.set_printoptions (edgeitems = 8, linewidth = 100)
-
-        # The mss x passages boolean matrix that is TRUE whenever the inspected
-        # ms. and the source ms. are both defined.
-        b_common = np.logical_and (val.def_matrix, val.def_matrix[ms_id])
+        # only ancestors are candidates
+        candidates = np.zeros (val.n_mss, dtype = np.bool_)
+        ancestors = get_ancestors (conn, current_app.config.rg_id_all, ms.ms_id)
+        candidates[[i - 1 for i in ancestors]] = True
 
         # Remove mss. we don't want to compare
-        b_common[ms_id] = False  # don't find original ms.
+        candidates[ms_id] = False  # don't find original ms.
         if 'A' not in include and 'A' not in pre_select:
-            b_common[0] = False
+            candidates[0] = False
         if 'MT' not in include and 'MT' not in pre_select:
-            b_common[1] = False
-        # also eliminate all descendants
-        ancestors = get_ancestors (conn, current_app.config.rg_id_all, ms.ms_id)
-        for i in range (0, val.n_mss):
-            if (i + 1) not in ancestors:
-                b_common[i] = False
+            candidates[1] = False
 
-        n_defined = np.count_nonzero (val.def_matrix[ms_id])
+        n_defined = int (popcount (val.def_bits[ms_id]))
         response['ms']['open'] = n_defined
 
-        # mask_matrix ist the mss x passages matrix containing the bitmask of
-        # all readings
-        explain_matrix       = build_explain_matrix (conn, val, ms.ms_id)
-        explain_equal_matrix = val.mask_matrix[ms_id]
-
-        # The mss x passages boolean matrix that is TRUE whenever the inspected ms.
-        # agrees with the potential source ms.
-        b_equal = np.bitwise_and (val.mask_matrix, explain_equal_matrix) > 0
-        b_equal = np.logical_and (b_equal, b_common)
-
-        # The mss x passages boolean matrix that is TRUE whenever the inspected ms.
-        # agrees with the potential source ms. or is posterior to it.
-        b_post = np.bitwise_and (val.mask_matrix, explain_matrix) > 0
-        b_post = np.logical_and (b_post, b_common)
-
-        # The 1 x passages boolean matrix that is TRUE whenever the passage is
-        # still unexplained.
-        b_open = np.copy (val.def_matrix[ms_id])
-
-        # The 1 x passages boolean matrix that is TRUE whenever the source of
-        # the reading in the inspected ms. is unknown
-        b_unknown = np.bitwise_and (explain_matrix, 0x1)
-        b_unknown = np.logical_and (b_unknown, b_open)
-
-        n_explained = 0
-
-        for n in range (0, MAX_COVER_SIZE):
-            if n < len (pre_selected):
-                # use manuscript pre-selected by user
-                ms_id_most_similar = pre_selected[n].ms_id - 1
-            else:
-                # find manuscript that explains the most passages by agreement
-                ms_id_most_similar = int (np.argmax (np.sum (b_equal, axis = 1)))
-
-            ms_most_similar = Manuscript (conn, 'id' + str (ms_id_most_similar + 1))
-            d = ms_most_similar.to_json ()
-
-            b_explained = np.copy (b_post[ms_id_most_similar])
-            n_explains = int (np.count_nonzero (b_explained))
-            # exit if no passages could be explained
-            if n_explains == 0:
-                break
-
-            n_equal = int (np.count_nonzero (b_equal[ms_id_most_similar]))
-
-            # remove "explained" readings, so they will not be matched again
-            b_post[:,b_explained] = False
-            b_equal[:,b_explained] = False
-            b_unknown[b_explained] = False
-            b_open[b_explained]    = False
-
-            n_explained += n_explains
-            n_unknown = int (np.count_nonzero (b_unknown))
-            n_open    = int (np.count_nonzero (b_open))
-
-            d['explains']  = n_explains
-            d['explained'] = n_explained
-            d['equal']     = n_equal
-            d['post']      = n_explains - n_equal
-            d['unknown']   = n_unknown
-            d['open']      = n_open - n_unknown
-            d['n']         = n + 1
+        cover = []
+        for step in set_cover (val, ms_id, candidates, None, [s.ms_id - 1 for s in pre_selected]):
+            d = step._asdict ()
+            d.update (Manuscript (conn, 'id' + str (step.ms_id + 1)).to_json ())
             cover.append (d)
 
         # output list
@@ -284,6 +256,101 @@ def set_cover_json (hs_hsnr_id):
         return make_json_response (response)
 
 
+_SetCoverRow = collections.namedtuple (
+    'SetCoverRow',
+    'ms_id hs n anc_ms_id anc_hs explains explained equal post unknown open'
+)
+
+def _set_covers (fmt):
+    """Calculate the set covers of all manuscripts in a range.
+
+    Parameters:
+
+    - range:     the range, default: All
+    - mss:       an optional list of mss. to explain, default: all mss.
+                 defined in the range
+    - include[]: 'A' and 'MT' may be used to explain other mss.
+
+    """
+
+    include  = request.args.getlist ('include[]') or []
+    rg_range = request.args.get ('range') or 'All'
+    mss      = (request.args.get ('mss') or '').split ()
+
+    val = current_app.config.cbgm_cache.get ()
+
+    rg = next ((r for r in val.ranges if r.range == rg_range), None)
+    if rg is None:
+        raise EditError ('Unknown range: %s' % rg_range)
+
+    passages = np.zeros (val.n_passages, dtype = np.bool_)
+    passages[rg.start:rg.end] = True
+    passages = pack_bits (passages)
+
+    with current_app.config.dba.engine.begin () as conn:
+        if mss:
+            ms_ids = [Manuscript (conn, ms).ms_id - 1 for ms in mss]
+        else:
+            ms_ids = np.flatnonzero (popcount (val.def_bits & passages)).tolist ()
+
+        candidates = potential_ancestors (conn, {}, rg.rg_id, val.n_mss)
+
+        res = execute (conn, """
+        SELECT ms_id - 1, hs
+        FROM manuscripts
+        """, {})
+        hs = dict (res.fetchall ())
+
+    # Remove mss. we don't want to compare
+    np.fill_diagonal (candidates, False)
+    if 'A' not in include:
+        candidates[:, 0] = False
+    if 'MT' not in include:
+        candidates[:, 1] = False
+
+    covers = set_covers (val, ms_ids, candidates, passages)
+
+    if fmt == 'csv':
+        rows = (
+            _SetCoverRow (ms_id + 1, hs.get (ms_id), step.n, step.ms_id + 1, hs.get (step.ms_id),
+                          step.explains, step.explained, step.equal, step.post,
+                          step.unknown, step.open)
+            for ms_id, steps in covers for step in steps
+        )
+        return csvify_stream (_SetCoverRow._fields, rows)
+
+    def objects ():
+        for ms_id, steps in covers:
+            cover = []
+            for step in steps:
+                d = step._asdict ()
+                d['ms_id'] = step.ms_id + 1
+                d['hs']    = hs.get (step.ms_id)
+                cover.append (d)
+            yield {
+                'ms_id' : ms_id + 1,
+                'hs'    : hs.get (ms_id),
+                'open'  : int (popcount (val.def_bits[ms_id] & passages)),
+                'cover' : cover,
+            }
+
+    return jsonlify_stream (objects ())
+
+
+@bp.route ('/set-covers.csv')
+def set_covers_csv ():
+    """ Output the set covers of many manuscripts in CSV format.  See :func:`_set_covers`. """
+
+    return _set_covers ('csv')
+
+
+@bp.route ('/set-covers.jsonl')
+def set_covers_jsonl ():
+    """ Output the set covers of many manuscripts in JSON lines format.  See :func:`_set_covers`. """
+
+    return _set_covers ('jsonl')
+
+
 class Combination ():
     """ Represents a combination of manuscripts. """
 
@@ -293,7 +360,7 @@ class Combination ():
         self.mss   = list (iterator)
         self.index = index
         self.len   = len (self.mss)
-        self.vec   = np.array ([ ms.ms_id - 1 for ms in self.mss ])
+        self.vec   = np.array ([ ms.ms_id - 1 for ms in self.mss ], dtype = np.int64)
         self.n_explained_equal = 0
         self.n_explained_post  = 0
         self.n_unknown         = 0
@@ -341,66 +408,229 @@ class Combination ():
         ]
 
 
-def _optimal_substemma (ms_id, explain_matrix, combinations, mode):
-    """Do an exhaustive search for the combination among a given set of ancestors
-    that best explains a given manuscript.
+def _explain_bits (val, ms_id, explain_matrix, vec):
+    """Build the packed bitsets needed to explain a manuscript by its potential ancestors.
 
-    """
+    :param int ms_id:    the ms. to explain (numpy index)
+    :param vec:          the numpy indices of the potential ancestors
+    :return: tuple of b_equal, b_post (len (vec) x passages), b_source_unknown,
+             b_source_known (passages), all packed into bits
 
-    ms_id = ms_id - 1  # numpy indices start at 0
-    val = current_app.config.val
+    """
 
-    b_defined = val.def_matrix[ms_id]
+    b_defined = val.def_bits[ms_id]
     # remove variants where the inspected ms is undefined
-    b_common = np.logical_and (val.def_matrix, b_defined)
+    b_common = np.bitwise_and (val.def_bits[vec], b_defined)
 
     explain_equal_matrix = val.mask_matrix[ms_id]
+    mask_matrix = val.mask_matrix[vec]
 
-    # The mss x passages boolean matrix that is TRUE whenever the inspected ms.
+    # The boolean matrix that is TRUE whenever the inspected ms.
     # agrees with the potential source ms.
-    b_equal = np.bitwise_and (val.mask_matrix, explain_equal_matrix) > 0
-    b_equal = np.logical_and (b_equal, b_common)
+    b_equal = pack_bits (np.bitwise_and (mask_matrix, explain_equal_matrix) > 0)
+    b_equal = np.bitwise_and (b_equal, b_common)
 
-    # The mss x passages boolean matrix that is TRUE whenever the inspected ms.
+    # The boolean matrix that is TRUE whenever the inspected ms.
     # agrees with the potential source ms. or is posterior to it.
-    b_post = np.bitwise_and (val.mask_matrix, explain_matrix) > 0
-    b_post = np.logical_and (b_post, b_common)
+    b_post = pack_bits (np.bitwise_and (mask_matrix, explain_matrix) > 0)
+    b_post = np.bitwise_and (b_post, b_common)
+
+    # The 1 x passages boolean matrices that are TRUE whenever the source of
+    # the reading in the inspected ms. is unknown resp. known
+    b_source_unknown = np.bitwise_and (explain_matrix, 0x1) > 0
+    b_source_known   = np.logical_and (explain_matrix > 0, np.logical_not (b_source_unknown))
+    b_source_unknown = np.bitwise_and (pack_bits (b_source_unknown), b_defined)
+    b_source_known   = np.bitwise_and (pack_bits (b_source_known),   b_defined)
+
+    return b_equal, b_post, b_source_unknown, b_source_known
+
+
+def _optimal_substemma (val, ms_id, explain_matrix, comb):
+    """Calculate how well a combination of ancestors explains a given manuscript.
+
+    Fills in the counts and the indices of the open and unknown passages of the
+    combination.
+
+    """
+
+    # All the boolean matrices below are packed into bits.
+    b_equal, b_post, b_source_unknown, b_source_known = \
+        _explain_bits (val, ms_id - 1, explain_matrix, comb.vec)
+
+    # how many passages does this combination explain?
+    # pylint: disable=no-member
+    b_explained_equal = np.bitwise_or.reduce (b_equal)
+    b_explained_post  = np.bitwise_or.reduce (b_post)
+    b_explained_post  = np.bitwise_and (b_explained_post, np.invert (b_explained_equal))
+    b_unexplained     = np.invert (np.bitwise_or (b_explained_equal, b_explained_post))
+
+    comb.n_explained_equal = int (popcount (b_explained_equal))
+    comb.n_explained_post  = int (popcount (b_explained_post))
+
+    b_unknown = np.bitwise_and (b_source_unknown, b_unexplained)
+    b_open    = np.bitwise_and (b_source_known,   b_unexplained)
+
+    comb.n_unknown = int (popcount (b_unknown))
+    comb.n_open    = int (popcount (b_open))
+
+    b_open    = unpack_bits (b_open,    val.n_passages)
+    b_unknown = unpack_bits (b_unknown, val.n_passages)
+    comb.open_indices    = tuple (int (n + 1) for n in np.nonzero (b_open)[0])
+    comb.unknown_indices = tuple (int (n + 1) for n in np.nonzero (b_unknown)[0])
+
+
+def _subset_sums (keys, weights, n):
+    """Sum the weights of the keys over all subsets.
+
+    Returns an array f of length 2**n where f[T] is the sum of the weights of
+    all keys that are subsets of T.  The keys are bitmasks of n bits.  This is
+    the zeta transform over the subset lattice, done in n vectorized passes.
+
+    """
+
+    f = np.zeros (1 << n, dtype = np.int32)
+    np.add.at (f, keys, weights)
+    for i in range (n):
+        bit = 1 << i
+        f2 = f.reshape (-1, 2, bit)  # f2[h, b, l] = f[h * 2 * bit + b * bit + l]
+        f2[:, 1, :] += f2[:, 0, :]
+    return f
+
 
-    for comb in combinations:
-        # how many passages does this combination explain?
-        # pylint: disable=no-member
-        b_explained_equal = np.logical_or.reduce (b_equal[comb.vec])
-        b_explained_post  = np.logical_or.reduce (b_post[comb.vec])
-        b_explained_post  = np.logical_and (b_explained_post, np.logical_not (b_explained_equal))
-        b_explained       = np.logical_or (b_explained_equal, b_explained_post)
+def _subset_counts (val, ms_id, explain_matrix, vec):
+    """Calculate the counts of all combinations of the given potential ancestors.
 
-        comb.n_explained_equal = np.count_nonzero (b_explained_equal)
-        comb.n_explained_post  = np.count_nonzero (b_explained_post)
+    Instead of or-ing the bitsets of every combination, we turn things around:
+    for every passage we build the bitmask of the ancestors (bit i = vec[i])
+    that explain it by being equal resp. equal or prior.  A combination S then
+    explains a passage iff (mask & S) != 0.  Passages with the same masks are
+    counted together.  The counts for all 2**n combinations at once follow from
+    the sum over all masks that are subsets of the complement of S, see
+    :func:`_subset_sums`.
 
-        unexplained_matrix = np.copy (explain_matrix)
-        unexplained_matrix[np.logical_not (b_defined)] = 0
-        unexplained_matrix[b_explained] = 0
-        b_unknown = np.bitwise_and (unexplained_matrix, 0x1) > 0
-        unexplained_matrix[b_unknown] = 0
-        b_open = unexplained_matrix > 0
+    :return: four int32 arrays of length 2**n indexed by the bitmask of the
+             combination: n_explained_equal, n_explained_post, n_unknown, n_open
 
-        comb.n_unknown = np.count_nonzero (b_unknown)
-        comb.n_open = np.count_nonzero (b_open)
+    """
+
+    n = len (vec)
+
+    b_equal, b_post, b_source_unknown, b_source_known = _explain_bits (val, ms_id - 1, explain_matrix, vec)
+
+    # the masks of the ancestors explaining each passage
+    shifts = np.arange (n, dtype = np.uint64)[:, None]
+    eq   = np.bitwise_or.reduce (unpack_bits (b_equal, val.n_passages).astype (np.uint64) << shifts)
+    post = np.bitwise_or.reduce (unpack_bits (b_post,  val.n_passages).astype (np.uint64) << shifts)
+    any_ = np.bitwise_or (eq, post)
+
+    # 0 = don't care, 1 = source unknown, 2 = source known
+    source = unpack_bits (b_source_unknown, val.n_passages).astype (np.int64)
+    source += 2 * unpack_bits (b_source_known, val.n_passages)
+
+    # count passages with the same masks together
+    keys, weights = np.unique (np.stack ((eq, any_, source.astype (np.uint64))), axis = 1, return_counts = True)
+    eq, any_, source = keys.astype (np.int64)
+    total = int (weights.sum ())
+
+    # s[::-1][S] == s[~S]
+    n_explained_equal = total - _subset_sums (eq,   weights, n)[::-1]
+    n_explained_any   = total - _subset_sums (any_, weights, n)[::-1]
+    n_unknown = _subset_sums (any_[source == 1], weights[source == 1], n)[::-1]
+    n_open    = _subset_sums (any_[source == 2], weights[source == 2], n)[::-1]
 
-        if mode == 'detail':
-            comb.open_indices    = tuple (int (n + 1) for n in np.nonzero (b_open)[0])
-            comb.unknown_indices = tuple (int (n + 1) for n in np.nonzero (b_unknown)[0])
+    return n_explained_equal, n_explained_any - n_explained_equal, n_unknown, n_open
 
-    if mode == 'search':
-        # add the 'hint' column
-        def key_len (c):
-            return c.len
 
-        def key_explained (c):
-            return -c.explained ()
+def _top_combinations (b_any, k):
+    """Find the k combinations of each size that explain the most passages.
 
-        for _k, g in itertools.groupby (sorted (combinations, key = key_len), key = key_len):
-            sorted (g, key = key_explained)[0].hint = True
+    A branch-and-bound search over the combinations in lexicographic order.  A
+    branch is pruned if no combination in it can enter the top k of any size.
+    The upper bound for adding m more ancestors to a combination is the lesser
+    of: the passages explained by the combination together with all later
+    ancestors, and the passages explained by the combination plus the m biggest
+    gains of the other later ancestors.
+
+    Ties are resolved in favour of the combination that comes first in
+    lexicographic order, so the best combination of each size is the same as
+    the one the exhaustive search marks as hint.
+
+    :param b_any: the packed len (ancestors) x passages matrix that is TRUE
+                  whenever the ancestor explains the passage
+    :param int k: the no. of combinations to keep for each size
+    :return: list of lists of the bitmasks (bit i = ancestor i) of the best
+             combinations by size, ordered best first
+
+    """
+
+    n = len (b_any)
+
+    # Passages explained by all or by none of the ancestors add the same to
+    # every combination of a size and don't change the ranking.  Drop them.
+    # pylint: disable=no-member
+    b_some = np.bitwise_or.reduce (b_any) & ~np.bitwise_and.reduce (b_any)
+    n_bits = b_any.shape[-1] * 8
+    b_any = pack_bits (unpack_bits (b_any, n_bits)[:, unpack_bits (b_some, n_bits)])
+
+    # suffix[i] = union of the ancestors i..n-1
+    suffix = np.zeros ((n + 1, b_any.shape[1]), dtype = b_any.dtype)
+    for i in range (n - 1, -1, -1):
+        suffix[i] = suffix[i + 1] | b_any[i]
+
+    # one min-heap of (explained, -order, mask) for each size
+    heaps = [[] for l in range (n + 1)]
+    order = itertools.count ()
+    # the explained count a combination must beat to get into the heap
+    kth = np.full (2 * n + 2, n_bits, dtype = np.int64)
+    kth[:n + 1] = -1
+
+    def push (size, explained, mask):
+        heap = heaps[size]
+        item = (explained, -next (order), mask)
+        if len (heap) < k:
+            heapq.heappush (heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace (heap, item)
+        else:
+            return
+        if len (heap) == k:
+            kth[size] = heap[0][0]
+
+    def visit (mask, size, covered, explained, i):
+        """ Record the children of a combination and search the promising ones. """
+
+        r = n - i
+        gains = popcount (b_any[i:] & ~covered)
+        child_explained = explained + gains
+
+        # Upper bounds for adding m = 1..r-1 more ancestors to child j: the
+        # union of child j and all ancestors after it, and the sum of the m
+        # biggest gains of the ancestors other than j.
+        rank = np.empty (r, dtype = np.int64)
+        rank[np.argsort (-gains, kind = 'stable')] = np.arange (r)
+        cum = np.concatenate (([0], np.cumsum (np.sort (gains)[::-1])))
+        m = np.arange (1, r)
+        top = np.where (rank[:, None] < m, cum[m + 1] - gains[:, None], cum[m])
+        bounds = np.minimum (popcount (covered | suffix[i:n])[:, None],
+                             child_explained[:, None] + top)
+
+        # children come before their descendants in lexicographic order
+        for j in np.flatnonzero (child_explained > kth[size + 1]).tolist ():
+            push (size + 1, int (child_explained[j]), mask | (1 << (i + j)))
+
+        # child j can add at most r - j - 1 more ancestors
+        window = kth[size + 2 + np.arange (r - 1)]
+        valid  = m <= (r - 1 - np.arange (r))[:, None]
+        for j in np.flatnonzero (((bounds > window) & valid).any (axis = 1)).tolist ():
+            # the heaps may have filled up meanwhile
+            if (bounds[j, :r - j - 1] > kth[size + 2:size + r - j + 1]).any ():
+                visit (mask | (1 << (i + j)), size + 1, covered | b_any[i + j],
+                       int (child_explained[j]), i + j + 1)
+
+    if n > 0:
+        visit (0, 0, np.zeros_like (suffix[n]), 0, 0)
+
+    return [[item[2] for item in sorted (heap, reverse = True)] for heap in heaps[1:]]
 
 
 @bp.route ('/optimal-substemma.json')
@@ -408,9 +638,7 @@ def optimal_substemma_json ():
     """Normalize parameters only and add some general info.
     """
 
-    if current_app.config.val is None:
-        current_app.config.val = init (current_app.config.dba)
-    val = current_app.config.val
+    val = current_app.config.cbgm_cache.get ()
 
     with current_app.config.dba.engine.begin () as conn:
         # the manuscript to explain
@@ -423,7 +651,7 @@ def optimal_substemma_json ():
             'ms'  : ms.to_json (),
             'mss' : [s.to_json () for s in selected],
         }
-        n_defined = np.count_nonzero (val.def_matrix[ms.ms_id - 1])
+        n_defined = int (popcount (val.def_bits[ms.ms_id - 1]))
         response['ms']['open'] = n_defined
 
         return make_json_response (response)
@@ -436,36 +664,83 @@ _OptimalSubstemmaRow = collections.namedtuple (
 
 @bp.route ('/optimal-substemma.csv')
 def optimal_substemma_csv ():
-    """Do an exhaustive search for the combination among a given set of ancestors
-    that best explains a given manuscript.
+    """Search for the combination among a given set of ancestors that best
+    explains a given manuscript.
+
+    Up to MAX_SUBSTEMMA_SIZE ancestors all combinations are returned, unless a
+    limit is given.  With a limit or with more ancestors only the best `limit`
+    combinations of each size are returned.
 
     """
 
-    if current_app.config.val is None:
-        current_app.config.val = init (current_app.config.dba)
-    val = current_app.config.val
+    val = current_app.config.cbgm_cache.get ()
+
+    limit = request.args.get ('limit', type = int)
 
     with current_app.config.dba.engine.begin () as conn:
         # the manuscript to explain
         ms = Manuscript (conn, request.args.get ('ms'))
 
-        # get the selected set of ancestors and build all combinations of that set
+        # get the selected set of ancestors
         selected = [ Manuscript (conn, anc_id)
                      for anc_id in (request.args.get ('selection') or '').split () ]
-        combinations = []
-        i = 0
-        for l in range (len (selected)):
-            for c in itertools.combinations (selected, l + 1):
-                combinations.append (Combination (c, i))
-                i += 1
+        if len (selected) > MAX_SUBSTEMMA_SEARCH_SIZE:
+            raise EditError ('Too many ancestors selected.  The maximum is %d.' % MAX_SUBSTEMMA_SEARCH_SIZE)
+
+    explain_matrix = val.explain_matrix[ms.ms_id - 1]
+
+    if limit is None and len (selected) > MAX_SUBSTEMMA_SIZE:
+        limit = SUBSTEMMA_TOP_K
+
+    vec = np.array ([s.ms_id - 1 for s in selected], dtype = np.int64)
+    hs = [s.hs for s in selected]
+
+    def mss (mask):
+        return [h for i, h in enumerate (hs) if mask & (1 << i)]
+
+    if limit is None:
+        equal, post, unknown, open_ = _subset_counts (val, ms.ms_id, explain_matrix, vec)
+        explained = equal + post
+
+        # all combinations, ordered by size, as bitmasks
+        sizes = [np.array ([sum (1 << i for i in c) for c in itertools.combinations (range (len (selected)), l)],
+                           dtype = np.int64)
+                 for l in range (1, len (selected) + 1)]
+
+        # the 'hint' column marks the first combination of each size that explains most
+        hints = set (int (s[np.argmax (explained[s])]) for s in sizes)
+
+        def rows ():
+            for s in sizes:
+                for mask in s.tolist ():
+                    m = mss (mask)
+                    yield _OptimalSubstemmaRow (' '.join (m), len (m),
+                                                int (equal[mask]), int (post[mask]),
+                                                int (unknown[mask]), int (open_[mask]),
+                                                mask in hints)
+
+        return csvify_stream (_OptimalSubstemmaRow._fields, rows ())
 
-        explain_matrix = build_explain_matrix (conn, val, ms.ms_id)
-        _optimal_substemma (ms.ms_id, explain_matrix, combinations, mode = 'search')
+    b_equal, b_post, b_source_unknown, b_source_known = \
+        _explain_bits (val, ms.ms_id - 1, explain_matrix, vec)
+    sizes = _top_combinations (b_equal | b_post, max (limit, 1))
 
-        res = [c.to_csv () for c in combinations]
+    def rows ():
+        for s in sizes:
+            for mask in s:
+                idx = [i for i in range (len (selected)) if mask & (1 << i)]
+                # pylint: disable=no-member
+                b_explained_equal = np.bitwise_or.reduce (b_equal[idx])
+                b_explained_any   = np.bitwise_or.reduce (b_post[idx]) | b_explained_equal
+                b_unexplained     = np.invert (b_explained_any)
+                n_equal = int (popcount (b_explained_equal))
+                yield _OptimalSubstemmaRow (' '.join (mss (mask)), len (idx),
+                                            n_equal, int (popcount (b_explained_any)) - n_equal,
+                                            int (popcount (b_source_unknown & b_unexplained)),
+                                            int (popcount (b_source_known   & b_unexplained)),
+                                            mask == s[0])
 
-        return csvify (_OptimalSubstemmaRow._fields,
-                       list (map (_OptimalSubstemmaRow._make, res)))
+    return csvify_stream (_OptimalSubstemmaRow._fields, rows ())
 
 
 _OptimalSubstemmaDetailRow = collections.namedtuple (
@@ -492,9 +767,7 @@ def optimal_substemma_detail_csv ():
     """Report details about one combination of ancestors.
     """
 
-    if current_app.config.val is None:
-        current_app.config.val = init (current_app.config.dba)
-    val = current_app.config.val
+    val = current_app.config.cbgm_cache.get ()
 
     with current_app.config.dba.engine.begin () as conn:
         # the manuscript to explain
@@ -505,23 +778,24 @@ def optimal_substemma_detail_csv ():
                      for anc_id in (request.args.get ('selection') or '').split () ]
 
         combinations   = [Combination (selected, 0)]
-        explain_matrix = build_explain_matrix (conn, val, ms.ms_id)
-        _optimal_substemma (ms.ms_id, explain_matrix, combinations, mode = 'detail')
+        explain_matrix = val.explain_matrix[ms.ms_id - 1]
+        _optimal_substemma (val, ms.ms_id, explain_matrix, combinations[0])
 
         res = execute (conn, """
         SELECT 'unknown' as type, p.pass_id, p.begadr, p.endadr, v.labez_clique, v.lesart
         FROM passages p
-          JOIN apparatus_cliques_view v USING (pass_id)
+          JOIN {apparatus_cliques} v USING (pass_id)
         WHERE v.ms_id = :ms_id AND pass_id IN :unknown_pass_ids
         UNION
         SELECT 'open' as type, p.pass_id, p.begadr, p.endadr, v.labez_clique, v.lesart
         FROM passages p
-          JOIN apparatus_cliques_view v USING (pass_id)
+          JOIN {apparatus_cliques} v USING (pass_id)
         WHERE v.ms_id = :ms_id AND pass_id IN :open_pass_ids
         """, dict (
             ms_id = ms.ms_id,
             unknown_pass_ids = combinations[0].unknown_indices or (-1, ),
-            open_pass_ids    = combinations[0].open_indices    or (-1, )
+            open_pass_ids    = combinations[0].open_indices    or (-1, ),
+            **apparatus_tables (conn)
         ))
 
         return csvify (_OptimalSubstemmaDetailRowCalcFields._fields,
@@ -4,29 +4,46 @@
 """The API server for CBGM.  The textflow and stemmata diagrams."""
 
 import collections
+import os.path
 
 import flask
 from flask import request, current_app
 import flask_login
 import networkx as nx
 
-from ntg_common.db_tools import execute
+from ntg_common.db_tools import execute, change_marker
 from ntg_common import tools
 from ntg_common import db_tools
 
 from login import auth, user_can_write
 import helpers
 from helpers import parameters, Passage, get_excluded_ms_ids, \
-     make_dot_response, make_png_response
+     make_dot_response, make_png_response, apparatus_tables
 from checks import congruence
 
 
 bp = flask.Blueprint ('textflow', __name__)
 
 
-def init_app (_app):
+TEXTFLOW_CACHE_SIZE = 256
+""" Keep this many global textflow diagrams in memory. """
+
+STEMMA_CACHE_SIZE = 1024
+""" Keep this many local stemmata in memory. """
+
+TEXTFLOW_TABLES = ('affinity', 'ms_ranges', 'apparatus', 'ms_cliques', 'locstem', 'manuscripts')
+""" The global textflow diagrams change when these tables change. """
+
+
+def init_app (app):
     """ Initialize the flask app. """
 
+    cache_dir = app.config.get ('CBGM_CACHE_DIR')
+    if cache_dir:
+        cache_dir = os.path.join (cache_dir, 'textflow')
+    app.config.textflow_cache = helpers.RenderCache (TEXTFLOW_CACHE_SIZE, cache_dir)
+    app.config.stemma_cache   = helpers.RenderCache (STEMMA_CACHE_SIZE)
+
 
 SHAPES = {
     'a' : 'ellipse',
@@ -82,8 +99,6 @@ def textflow (passage_or_id):
     cliques   = 'cliques'   in cliques    # consider or ignore cliques
     leaf_z    = 'Z'         in include    # show leaf z nodes in global textflow?
 
-    view = 'affinity_view' if mode == 'rec' else 'affinity_p_view'
-
     global_textflow = not ((labez != '') or var_only)
     rank_z = False  # include z nodes in ranking?
 
@@ -94,7 +109,6 @@ def textflow (passage_or_id):
         connectivity = 9999
 
     labez_where = ''
-    frag_where = ''
     z_where = ''
 
     if labez != '':
@@ -102,9 +116,6 @@ def textflow (passage_or_id):
         if hyp_a != 'A':
             labez_where = 'AND app.cbgm AND (app.labez = :labez OR (app.ms_id = 1 AND :hyp_a = :labez))'
 
-    if not fragments:
-        frag_where = 'AND a.common > a.ms1_length / 2'
-
     if not rank_z:
         z_where = "AND app.labez !~ '^z' AND app.certainty = 1.0"
 
@@ -134,29 +145,17 @@ def textflow (passage_or_id):
 
         # rank query
         #
-        # query to get the closest ancestors for every node with rank <= connectivity
-
-        query = """
-        SELECT ms_id1, ms_id2, rank
-        FROM (
-          SELECT ms_id1, ms_id2, rank () OVER (PARTITION BY ms_id1
-             ORDER BY affinity DESC, common, older, newer DESC, ms_id2) AS rank
-          FROM {view} a
-          WHERE ms_id1 IN :nodes AND a.rg_id = :rg_id AND ms_id2 NOT IN :exclude
-            AND newer > older {frag_where}
-        ) AS r
-        WHERE rank <= :connectivity
-        ORDER BY rank
-        """
-
-        res = execute (conn, query,
-                       dict (parameters, nodes = tuple (nodes), exclude = exclude,
-                             rg_id = rg_id, pass_id = passage.pass_id, view = view,
-                             labez = labez, connectivity = connectivity,
-                             frag_where = frag_where, hyp_a = hyp_a))
+        # get the closest ancestors for every node with rank <= connectivity
+
+        ranking = current_app.config.affinity_ranks.get (conn, rg_id, mode)
 
         Ranks = collections.namedtuple ('Ranks', 'ms_id1 ms_id2 rank')
-        ranks = list (map (Ranks._make, res))
+        ranks = []
+        for ms_id1 in nodes:
+            ancestors = ranking.ancestors (ms_id1, exclude, fragments, connectivity)
+            for rank, ms_id2 in enumerate (ancestors, 1):
+                ranks.append (Ranks (ms_id1, ms_id2, rank))
+        ranks.sort (key = lambda r: r.rank)
 
         # Initially build an unconnected graph with one node for each
         # manuscript.  We will connect the nodes later.  Finally we will remove
@@ -169,12 +168,13 @@ def textflow (passage_or_id):
 
         res = execute (conn, """
         SELECT ms.ms_id, ms.hs, ms.hsnr, a.labez, a.clique, a.labez_clique, a.certainty
-        FROM apparatus_view_agg a
+        FROM {apparatus_agg} a
         JOIN manuscripts ms USING (ms_id)
         WHERE pass_id = :pass_id AND ms_id IN :ms_ids
         """, dict (parameters,
                    ms_ids = tuple (src_nodes | dest_nodes | nodes),
-                   pass_id = passage.pass_id))
+                   pass_id = passage.pass_id,
+                   **apparatus_tables (conn)))
 
         Mss = collections.namedtuple ('Mss', 'ms_id hs hsnr labez clique labez_clique certainty')
         mss = list (map (Mss._make, res))
@@ -311,15 +311,67 @@ def textflow (passage_or_id):
     return dot
 
 
+def global_textflow_key (conn, passage, format):
+    """Return the cache key of a global textflow diagram.
+
+    Return None if the request is not for the global textflow.  The key
+    contains the change marker of the tables the diagram is built from, so
+    diagrams built from outdated data are never served.
+
+    """
+
+    args = request.args
+    if (args.get ('labez') or '') != '' or 'var_only' in args.getlist ('var_only[]'):
+        return None
+
+    # N.B. the global textflow always uses connectivity 1
+    return helpers.RenderCache.make_key (
+        passage.pass_id,
+        passage.request_rg_id (request),
+        'rec' if args.get ('mode') == 'rec' else 'sim',
+        sorted (args.getlist ('include[]')),
+        'fragments' in args.getlist ('fragments[]'),
+        'cliques'   in args.getlist ('cliques[]'),
+        'checks'    in args.getlist ('checks[]'),
+        args.get ('hyp_a') or 'A',
+        float (args.get ('width') or 0.0),
+        float (args.get ('fontsize') or 10.0),
+        format,
+        change_marker (conn, TEXTFLOW_TABLES),
+    )
+
+
+def render_textflow (passage_or_id, format = 'dot'):
+    """Build and lay out a textflow diagram.
+
+    The global textflow diagrams are cached.
+
+    """
+
+    cache = current_app.config.textflow_cache
+
+    with current_app.config.dba.engine.begin () as conn:
+        key = global_textflow_key (conn, Passage (conn, passage_or_id), format)
+
+    if key is not None:
+        data = cache.get (key)
+        if data is not None:
+            return data
+
+    data = tools.graphviz_layout (textflow (passage_or_id), format = format)
+
+    if key is not None and data:
+        cache.put (key, data)
+    return data
+
+
 @bp.route ('/textflow.dot/<passage_or_id>')
 def textflow_dot (passage_or_id):
     """ Return a textflow diagram in .dot format. """
 
     auth ()
 
-    dot = textflow (passage_or_id)
-    dot = tools.graphviz_layout (dot)
-    return make_dot_response (dot)
+    return make_dot_response (render_textflow (passage_or_id))
 
 
 @bp.route ('/textflow.png/<passage_or_id>')
@@ -328,13 +380,29 @@ def textflow_png (passage_or_id):
 
     auth ()
 
-    dot = textflow (passage_or_id)
-    png = tools.graphviz_layout (dot, format = 'png')
-    return make_png_response (png)
+    return make_png_response (render_textflow (passage_or_id, format = 'png'))
+
+
+def locstem_revision (conn, pass_id):
+    """Return the revision of the local stemma of a passage.
+
+    The revision is a hash of the contents of the local stemma, so it changes
+    with every edit, whichever way the edit was made.
+
+    """
+
+    res = execute (conn, """
+    SELECT md5 (string_agg (concat_ws (' ', labez, clique, source_labez, source_clique), ','
+                            ORDER BY labez, clique, source_labez, source_clique))
+    FROM locstem
+    WHERE pass_id = :pass_id
+    """, dict (parameters, pass_id = pass_id))
+
+    return res.fetchone ()[0]
 
 
-def stemma (passage_or_id):
-    """Serve a local stemma in dot format.
+def stemma (passage_or_id, format = 'dot'):
+    """Serve a local stemma.
 
     A local stemma is a DAG (directed acyclic graph).  The layout of the DAG is
     precomputed on the server using GraphViz.  GraphViz adds a precomputed
@@ -352,18 +420,49 @@ def stemma (passage_or_id):
     Both libraries have their drawbacks so the easiest way out was to precompute
     the layout on the server.
 
+    The laid out stemmata are cached under a key that contains the revision of
+    the local stemma.  The key doubles as ETag.
+
+    :return: the ETag and the laid out stemma, or None instead of the stemma
+             if the client already has the current version.
+
     """
 
-    width    = float (request.args.get ('width') or 0.0)
-    fontsize = float (request.args.get ('fontsize') or 10.0)
+    width     = float (request.args.get ('width') or 0.0)
+    fontsize  = float (request.args.get ('fontsize') or 10.0)
+    can_write = user_can_write (current_app)
+    cache     = current_app.config.stemma_cache
 
     with current_app.config.dba.engine.begin () as conn:
         passage = Passage (conn, passage_or_id)
-        graph = db_tools.local_stemma_to_nx (
-            conn, passage.pass_id, user_can_write (current_app)
+        etag = helpers.RenderCache.make_key (
+            passage.pass_id, locstem_revision (conn, passage.pass_id),
+            width, fontsize, can_write, format
         )
+        if etag in request.if_none_match:
+            return etag, None
+
+        data = cache.get (etag)
+        if data is not None:
+            return etag, data
+
+        graph = db_tools.local_stemma_to_nx (conn, passage.pass_id, can_write)
         dot = helpers.nx_to_dot (graph, width, fontsize, nodesep = 0.2)
-        return dot
+
+    data = tools.graphviz_layout (dot, format = format)
+    if data:
+        cache.put (etag, data)
+    return etag, data
+
+
+def make_stemma_response (etag, data, make_response):
+    if data is None:
+        response = flask.make_response ('', 304)
+    else:
+        response = make_response (data)
+    response.set_etag (etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @bp.route ('/stemma.dot/<passage_or_id>')
@@ -372,9 +471,8 @@ def stemma_dot (passage_or_id):
 
     auth ()
 
-    dot = stemma (passage_or_id)
-    dot = tools.graphviz_layout (dot)
-    return make_dot_response (dot)
+    etag, dot = stemma (passage_or_id)
+    return make_stemma_response (etag, dot, make_dot_response)
 
 
 @bp.route ('/stemma.png/<passage_or_id>')
@@ -383,6 +481,5 @@ def stemma_png (passage_or_id):
 
     auth ()
 
-    dot = stemma (passage_or_id)
-    png = tools.graphviz_layout (dot, format = 'png')
-    return make_png_response (png)
+    etag, png = stemma (passage_or_id, format = 'png')
+    return make_stemma_response (etag, png, make_png_response)
@@ -0,0 +1,134 @@
+# -*- encoding: utf-8 -*-
+
+""" Tests for ntg_common.cbgm_common. """
+
+import numpy as np
+
+from ntg_common import db_tools
+from ntg_common.cbgm_common import CBGM_Params, set_cover, pack_bits, _local_stemma_masks
+
+
+def make_params (mask_matrix, explain_matrix):
+    """ Build the params of :func:`set_cover` from mask and explain matrices. """
+
+    val = CBGM_Params ()
+    val.mask_matrix    = np.array (mask_matrix, dtype = np.uint64)
+    val.explain_matrix = np.array (explain_matrix, dtype = np.uint64)
+    val.n_mss, val.n_passages = val.mask_matrix.shape
+    val.def_bits = pack_bits (val.mask_matrix > 0)
+    return val
+
+
+def test_set_cover_no_equal_candidate ():
+    """ No candidate agrees with the ms., one is only prior to it. """
+
+    # passage 0: reading b (4) is posterior to reading a (8)
+    # ms. 0 = A, ms. 1 reads a, ms. 2 reads b
+    val = make_params (
+        [[8, 8], [8, 8], [4, 4]],
+        [[8, 8], [8, 8], [12, 12]],
+    )
+
+    candidates = np.array ([False, True, False])
+    assert set_cover (val, 2, candidates) == []
+
+
+def test_set_cover_no_equal_candidate_fall_back_to_A ():
+    """ No candidate agrees with the ms., but 'A' is a candidate. """
+
+    val = make_params (
+        [[8, 8], [8, 8], [4, 4]],
+        [[8, 8], [8, 8], [12, 12]],
+    )
+
+    candidates = np.array ([True, True, False])
+    steps = set_cover (val, 2, candidates)
+    assert [step.ms_id for step in steps] == [0]
+    assert steps[0].equal == 0
+    assert steps[0].post == 2
+
+
+def test_set_cover_equal_candidate ():
+    """ The candidate that agrees most is chosen first. """
+
+    val = make_params (
+        [[8, 8, 8], [8, 4, 8], [4, 4, 8], [4, 4, 4]],
+        [[8, 8, 8], [8, 12, 8], [12, 12, 8], [12, 12, 12]],
+    )
+
+    candidates = np.array ([False, True, True, False])
+    steps = set_cover (val, 3, candidates)
+    assert steps[0].ms_id == 2
+    assert steps[0].equal == 2
+
+
+# a local stemma: labez, clique, source labez, source clique
+LOCSTEM = [
+    ('a', '1', '*', '1'),
+    ('a', '2', 'a', '1'),
+    ('b', '1', 'a', '1'),
+    ('c', '1', 'b', '1'),
+    ('c', '1', '?', '1'),   # two sources, one of them unclear
+    ('d', '1', '?', '1'),
+    ('e', '1', 'd', '1'),
+    ('f', '1', 'a', '2'),
+    ('f', '1', 'c', '1'),
+    ('a', '10', 'f', '1'),  # sorts differently as labez_clique
+]
+
+
+def labez_clique (labez, clique):
+    """ Like the SQL function of the same name. """
+
+    return labez if labez in ('*', '?') else labez + clique
+
+
+def old_explain_masks ():
+    """ The explain masks of the old recursive query in the set cover module.
+
+    Every clique got bit ROW_NUMBER () in the order of labez and clique.  The
+    query walked the local stemma up from the reading and or-ed the bits of all
+    readings on the way.  Bit 0 was set if a reading on the way had an unclear
+    source.
+
+    :return: dict of labez_clique to (set of labez_clique, unclear)
+
+    """
+
+    cliques = sorted (set ((labez, clique) for labez, clique, _sl, _sc in LOCSTEM))
+    rn = { c : 1 << (i + 1) for i, c in enumerate (cliques) }
+
+    result = {}
+    for start in cliques:
+        bits = 0
+        todo, seen = [start], set ()
+        while todo:
+            node = todo.pop ()
+            if node in seen:
+                continue
+            seen.add (node)
+            for labez, clique, source_labez, source_clique in LOCSTEM:
+                if (labez, clique) == node:
+                    bits |= rn[node] | (1 if source_labez == '?' else 0)
+                    if (source_labez, source_clique) in rn:
+                        todo.append ((source_labez, source_clique))
+        result[labez_clique (*start)] = (
+            set (labez_clique (*c) for c in cliques if bits & rn[c]), bool (bits & 1))
+    return result
+
+
+def test_explain_matrix (monkeypatch):
+    """ The explain masks built from the local stemma are those of the old query. """
+
+    rows = [(labez, clique, labez_clique (labez, clique),
+             source_labez, source_clique, labez_clique (source_labez, source_clique))
+            for labez, clique, source_labez, source_clique in LOCSTEM]
+    monkeypatch.setattr (db_tools, 'execute', lambda conn, sql, params: iter (rows))
+
+    G = _local_stemma_masks (None, 1, 0, 0, True)
+    bits = { G.nodes[n]['mask'] : n for n in G if G.nodes[n]['mask'] > 1 }
+
+    for n, (nodes, unclear) in old_explain_masks ().items ():
+        explain = G.nodes[n]['mask'] | G.nodes[n]['ancestors']
+        assert set (n2 for bit, n2 in bits.items () if explain & bit) == nodes
+        assert bool (explain & 1) == unclear
@@ -0,0 +1,191 @@
+# -*- encoding: utf-8 -*-
+
+""" Tests for the congruence check in server/checks.py. """
+
+import numpy as np
+
+import server # adds the server directory to sys.path
+import checks
+import helpers
+from checks import find_incongruences
+from ntg_common.cbgm_common import CBGM_Params, pack_bits
+
+from test_helpers import make_app
+
+
+CONNECTIVITY = 2
+
+# readings of mss. 1-6 in passages 1-5, ms. 1 is 'A'
+READINGS = [
+    ['a', 'a', 'a',  'a', 'a'],
+    ['a', 'b', 'b',  'a', 'c'],
+    ['b', 'c', 'b',  'a', 'b'],
+    ['c', 'a', 'c',  'zz', 'c'],
+    ['c', 'c', 'b',  'c', 'c'],
+    ['a', 'b', 'c',  'c', 'a'],
+]
+
+# uncertain readings (ms. no., passage no.)
+UNCERTAIN = { (3, 4) }
+
+# the local stemmata: the sources of each reading
+LOCSTEM = [
+    { 'a' : ['*'],      'b' : ['a'],      'c' : ['a', 'b'] },  # several sources
+    { 'a' : ['*'],      'b' : ['?'],      'c' : ['a'] },       # a '?' source
+    { 'a' : ['*'],      'b' : ['a'],      'c' : ['b', '?'] },  # a '?' and another source
+    { 'a' : ['?'],      'b' : ['a'],      'c' : ['b'] },
+    { 'a' : ['*'],      'b' : ['*', 'a'], 'c' : ['a'] },       # a '*' and another source
+]
+
+# the closest potential ancestors of each ms. by rank, 0 = none
+MS_IDS = [2, 3, 4, 5, 6]
+ANC = [
+    [1, 0, 0, 0],
+    [2, 1, 0, 0],
+    [3, 2, 1, 0],
+    [4, 3, 6, 1],
+    [5, 1, 3, 2],
+]
+
+
+def bit (labez, passage):
+    """ The bitmask of a node in the local stemma. """
+
+    if labez == '*' or labez.startswith ('z'):
+        return 0
+    if labez == '?':
+        return 1
+    return 2 << sorted (LOCSTEM[passage]).index (labez)
+
+
+def make_params ():
+    """ Build the params of :func:`find_incongruences` from the fixture. """
+
+    n_mss, n_passages = len (READINGS), len (LOCSTEM)
+
+    val = CBGM_Params ()
+    val.n_mss, val.n_passages = n_mss, n_passages
+    val.mask_matrix   = np.zeros ((n_mss, n_passages), dtype = np.uint64)
+    val.source_matrix = np.zeros ((n_mss, n_passages), dtype = np.uint64)
+    certain = np.ones ((n_mss, n_passages), dtype = np.bool_)
+
+    for i, readings in enumerate (READINGS):
+        for j, labez in enumerate (readings):
+            val.mask_matrix[i, j] = bit (labez, j)
+            for source in LOCSTEM[j].get (labez, []):
+                val.source_matrix[i, j] |= bit (source, j)
+            certain[i, j] = (i + 1, j + 1) not in UNCERTAIN
+
+    val.certain_bits = pack_bits (certain)
+    return val
+
+
+def old_incongruences ():
+    """ The congruence check of the old SQL query.
+
+    The query joined the readings to the local stemma, one row per source.  Rule
+    2 was checked against the source of the first row, here it is checked
+    against all sources, as :func:`find_incongruences` does.
+    """
+
+    results = []
+    for j in range (len (LOCSTEM)):
+        for ms_id2, ancestors in zip (MS_IDS, ANC):
+            if (ms_id2, j + 1) in UNCERTAIN:
+                continue
+            lq2 = READINGS[ms_id2 - 1][j]
+            sources = LOCSTEM[j].get (lq2, [])
+            rows = [(rank, ms_id1, READINGS[ms_id1 - 1][j])
+                    for rank, ms_id1 in enumerate (ancestors, 1)
+                    if ms_id1 > 0 and (ms_id1, j + 1) not in UNCERTAIN]
+            if not rows:
+                continue
+            rank, ms_id1, lq1 = rows[0]
+
+            if lq1 == lq2 or lq1.startswith ('z') or lq2.startswith ('z'):
+                continue
+            if sources == ['?']:
+                continue
+            # rule 1
+            if any (c[2] == lq2 for c in rows[:CONNECTIVITY]):
+                continue
+            # rule 2
+            no_zz = [c for c in rows if not c[2].startswith ('z')]
+            if no_zz and no_zz[0][2] in sources:
+                continue
+            results.append ((j + 1, ms_id1, ms_id2, rank))
+    return sorted (results)
+
+
+def test_find_incongruences ():
+    """ The NumPy check finds the same incongruences as the old query. """
+
+    val = make_params ()
+    res = find_incongruences (val, MS_IDS, np.array (ANC, dtype = np.int32),
+                              0, val.n_passages, CONNECTIVITY)
+    found = sorted (zip (*[a.tolist () for a in res]))
+
+    expected = old_incongruences ()
+    assert found == expected
+    assert found == [(2, 2, 3, 1), (2, 3, 4, 1), (5, 2, 3, 1)]
+
+
+def test_find_incongruences_any_source ():
+    """ Rule 2 holds if the highest pV reads any one of the sources. """
+
+    val = make_params ()
+    res = find_incongruences (val, MS_IDS, np.array (ANC, dtype = np.int32),
+                              0, val.n_passages, CONNECTIVITY)
+    found = set (zip (*[a.tolist () for a in res]))
+
+    # ms. 4 reads c in passage 1 with sources a and b, its highest pV reads b
+    assert not any (r[0] == 1 and r[2] == 4 for r in found)
+    # ms. 4 reads c in passage 3 with sources b and ?, its highest pV reads b
+    assert not any (r[0] == 3 and r[2] == 4 for r in found)
+
+
+def test_congruence_jobs (monkeypatch):
+    """ A job yields the congruence lists of the single range check. """
+
+    calls = []
+
+    def congruence_list (_conn, _passage, range_id):
+        calls.append (range_id)
+        if range_id == 99:
+            raise ValueError ('no such range')
+        return [{ 'pass_id' : range_id * 10 + i, 'rank' : i } for i in range (range_id)]
+
+    monkeypatch.setattr (checks, 'congruence_list', congruence_list)
+    monkeypatch.setattr (checks, 'change_marker', lambda conn, tables: 'marker')
+    monkeypatch.setattr (helpers, 'change_marker', lambda conn, tables: 'marker')
+
+    app = make_app ()
+    app.config['CONGRUENCE_WORKERS'] = 1
+    app.config.cbgm_cache = helpers.Bag ()
+    app.config.cbgm_cache.is_current = lambda conn: True
+    checks.init_app (app)
+    jobs = app.config.congruence_jobs
+
+    rg_ids = [3, 1, 2]
+    expected = { rg_id : congruence_list (None, None, rg_id) for rg_id in rg_ids }
+
+    del calls[:]
+    job = jobs.submit (rg_ids)
+    assert job.event.wait (10)
+    assert job.status == 'done'
+    assert job.results == expected
+    assert sorted (calls) == sorted (rg_ids)
+    assert job.to_json (True)['results'] == [{ 'rg_id' : rg_id, 'ranks' : expected[rg_id] } for rg_id in rg_ids]
+    assert jobs.get (job.job_id) is job
+
+    # the second time the lists come from the cache
+    del calls[:]
+    job = jobs.submit ([2, 3])
+    assert job.event.wait (10)
+    assert job.results == { 2 : expected[2], 3 : expected[3] }
+    assert calls == []
+
+    job = jobs.submit ([1, 99])
+    assert job.event.wait (10)
+    assert job.status == 'failed'
+    assert 'no such range' in job.error
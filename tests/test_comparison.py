@@ -0,0 +1,195 @@
+# -*- encoding: utf-8 -*-
+
+""" Tests for server/comparison.py.
+
+The comparison module needs flask_user.  The tests are skipped without it.
+
+"""
+
+import itertools
+
+import numpy as np
+import pytest
+import sqlalchemy
+
+import server # adds the server directory to sys.path
+import helpers
+from ntg_common import db_tools
+from ntg_common.cbgm_common import Range
+from ntg_common.exceptions import EditError
+
+from test_checks import READINGS, LOCSTEM, make_params
+from test_helpers import make_app
+
+comparison = pytest.importorskip ('comparison', reason = 'needs flask_user')
+
+
+def old_comparison_detail (ms_id1, ms_id2):
+    """ The comparison detail of the old query.
+
+    is_p_older (pass_id, labez2, clique2, labez1, clique1) is true if reading 2
+    is a source of reading 1 in the local stemma, is_p_unclear () if '?' is a
+    source of the reading.
+    """
+
+    rows = []
+    for j, sources in enumerate (LOCSTEM):
+        lq1 = READINGS[ms_id1 - 1][j]
+        lq2 = READINGS[ms_id2 - 1][j]
+        if lq1 == lq2 or lq1.startswith ('z') or lq2.startswith ('z'):
+            continue
+        rows.append ((j + 1,
+                      lq1 in sources.get (lq2, []),
+                      lq2 in sources.get (lq1, []),
+                      '?' in sources.get (lq1, []) + sources.get (lq2, [])))
+    return rows
+
+
+def test_comparison_detail (monkeypatch):
+    """ The bitmasks yield the relationships of the old query. """
+
+    def execute (_conn, _sql, params):
+        # the readings of the passages asked for, if the labez differs
+        rows = []
+        for pass_id in params['pass_ids']:
+            lq1 = READINGS[params['ms1'] - 1][pass_id - 1]
+            lq2 = READINGS[params['ms2'] - 1][pass_id - 1]
+            if lq1 != lq2:
+                adr = 50101000 + 2 * pass_id
+                rows.append ((pass_id, adr, adr, lq1, 'lesart ' + lq1, lq2, 'lesart ' + lq2))
+        return rows
+
+    monkeypatch.setattr (comparison, 'execute', execute)
+    monkeypatch.setattr (helpers, 'change_marker', lambda conn, tables: 'marker')
+
+    val = make_params ()
+    val.ranges = [Range (1, 'All', 0, val.n_passages), Range (2, '1', 1, 4)]
+
+    app = make_app ()
+    app.config.cbgm_cache = helpers.Bag ()
+    app.config.cbgm_cache.get = lambda: val
+    app.config.apparatus_tables = helpers.APPARATUS_VIEWS
+
+    # the fixture of the lookup tables knows mss. 1-5
+    for ms_id1 in range (1, 6):
+        for ms_id2 in range (1, 6):
+            url = '/comparison-detail.csv?ms1=id%d&ms2=id%d' % (ms_id1, ms_id2)
+            with app.test_request_context (url):
+                rows = comparison.comparison_detail ()
+            found = [(r.pass_id, r.older, r.newer, r.unclear) for r in rows]
+            assert found == old_comparison_detail (ms_id1, ms_id2)
+            assert all (r.labez_clique1 == READINGS[ms_id1 - 1][r.pass_id - 1] for r in rows)
+
+            # a range only yields its own passages
+            with app.test_request_context (url + '&range=1'):
+                rows = comparison.comparison_detail ()
+            found = [(r.pass_id, r.older, r.newer, r.unclear) for r in rows]
+            assert found == [r for r in old_comparison_detail (ms_id1, ms_id2) if 2 <= r[0] <= 4]
+
+
+def make_affinity (conn, seed):
+    """ Fill the affinity tables of mss. 1-5 with random pairs, with lots of ties. """
+
+    rng = np.random.default_rng (seed)
+
+    affinity, view = [], []
+    for rg_id, range_ in ((1, 'All'), (2, '1')):
+        for ms_id1, ms_id2 in itertools.permutations (range (1, 6), 2):
+            aff = float (rng.choice ([0.5, 0.75, 1.0]))
+            older, newer = rng.integers (0, 3, 2).tolist ()
+            common = int (rng.integers (10, 20))
+            equal  = int (rng.integers (0, 10))
+            affinity.append ((rg_id, ms_id1, ms_id2, aff, older, newer))
+            view.append ((rg_id, range_, ms_id1, ms_id2, common, equal, older, newer, 0, aff, 20, 20))
+
+    conn.execute ('DROP TABLE IF EXISTS affinity')
+    conn.execute ('DROP TABLE IF EXISTS affinity_p_view')
+    conn.execute ('CREATE TABLE affinity (rg_id INTEGER, ms_id1 INTEGER, ms_id2 INTEGER, affinity REAL, '
+                  'p_older INTEGER, p_newer INTEGER)')
+    conn.execute ('CREATE TABLE affinity_p_view (rg_id INTEGER, range TEXT, ms_id1 INTEGER, ms_id2 INTEGER, '
+                  'common INTEGER, equal INTEGER, older INTEGER, newer INTEGER, unclear INTEGER, '
+                  'affinity REAL, ms1_length INTEGER, ms2_length INTEGER)')
+    conn.execute ('INSERT INTO affinity VALUES (?, ?, ?, ?, ?, ?)', affinity)
+    conn.execute ('INSERT INTO affinity_p_view VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', view)
+
+
+def old_comparison_summary (conn, ms_id1, ms_id2):
+    """ The query of the old comparison of 2 witnesses.
+
+    SQLite does not know parenthesized selects in a union, so the three parts
+    of the union run one by one.
+    """
+
+    params = dict (ms_id1 = ms_id1, ms_id2 = ms_id2)
+    rows = []
+    for sql in ("""
+        WITH ranks AS (
+          SELECT ms_id1, ms_id2, rg_id, rank () OVER (PARTITION BY rg_id ORDER BY affinity DESC) AS rank, affinity
+          FROM affinity aff
+          WHERE ms_id1 = :ms_id1
+            AND p_newer > p_older
+        )
+        SELECT a.rg_id, a.range, a.common, a.equal,
+               a.older, a.newer, a.unclear, a.affinity, r.rank, ms1_length, ms2_length
+        FROM affinity_p_view a
+        JOIN ranks r USING (rg_id, ms_id1, ms_id2)
+        WHERE a.ms_id1 = :ms_id1 AND a.ms_id2 = :ms_id2
+        """, """
+        WITH ranks2 AS (
+          SELECT ms_id1, ms_id2, rg_id, rank () OVER (PARTITION BY rg_id ORDER BY affinity DESC) AS rank, affinity
+          FROM affinity aff
+          WHERE ms_id2 = :ms_id2
+            AND p_newer < p_older
+        )
+        SELECT a.rg_id, a.range, a.common, a.equal,
+               a.older, a.newer, a.unclear, a.affinity, r.rank, ms1_length, ms2_length
+        FROM affinity_p_view a
+        JOIN ranks2 r USING (rg_id, ms_id1, ms_id2)
+        WHERE a.ms_id1 = :ms_id1 AND a.ms_id2 = :ms_id2
+        """, """
+        SELECT a.rg_id, a.range, a.common, a.equal,
+               a.older, a.newer, a.unclear, a.affinity, NULL, ms1_length, ms2_length
+        FROM affinity_p_view a
+        WHERE a.ms_id1 = :ms_id1 AND a.ms_id2 = :ms_id2 AND a.newer = a.older
+        """):
+        rows += [tuple (row) for row in conn.execute (sqlalchemy.text (sql), params)]
+    return sorted (rows)
+
+
+def test_comparison_summary_multi (monkeypatch):
+    """ Every ms2 gets the rows of the old comparison of 2 witnesses. """
+
+    def execute (conn, sql, params):
+        # SQLite knows IN but not ANY
+        ms_ids2 = ', '.join (map (str, params['ms_ids2']))
+        return db_tools.execute (conn, sql.replace ('= ANY (:ms_ids2)', 'IN (%s)' % ms_ids2), params)
+
+    monkeypatch.setattr (comparison, 'execute', execute)
+    monkeypatch.setattr (helpers, 'change_marker', lambda conn, tables: 'marker')
+
+    app = make_app ()
+    conn = app.config.dba.engine.connect ()
+
+    for seed in range (3):
+        make_affinity (conn, seed)
+        for ms_id1 in range (1, 6):
+            mss2 = [ms_id2 for ms_id2 in (5, 3, 1, 4, 2) if ms_id2 != ms_id1]
+            # the duplicate is dropped
+            url = '/comparison-summary-multi.json?ms1=id%d&' % ms_id1 + \
+                '&'.join ('ms2[]=id%d' % ms_id2 for ms_id2 in mss2 + mss2[:1])
+            with app.test_request_context (url):
+                ms1, found_mss2, rows = comparison.comparison_summary_multi ()
+
+            assert ms1.ms_id == ms_id1
+            assert [ms.ms_id for ms in found_mss2] == mss2
+            assert [(row.rg_id, row.ms_id2) for row in rows] == \
+                [(rg_id, ms_id2) for rg_id in (1, 2) for ms_id2 in mss2]
+            for ms_id2 in mss2:
+                assert sorted (tuple (row)[2:] for row in rows if row.ms_id2 == ms_id2) == \
+                    old_comparison_summary (conn, ms_id1, ms_id2)
+
+    # too many witnesses
+    monkeypatch.setattr (comparison, 'MAX_COMPARISONS', 1)
+    with app.test_request_context ('/comparison-summary-multi.json?ms1=id1&ms2[]=id2&ms2[]=id3'):
+        with pytest.raises (EditError):
+            comparison.comparison_summary_multi ()
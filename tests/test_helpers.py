@@ -0,0 +1,247 @@
+# -*- encoding: utf-8 -*-
+
+""" Tests for server/helpers.py. """
+
+import itertools
+
+import flask
+import numpy as np
+import sqlalchemy
+from sqlalchemy.pool import StaticPool
+
+import server # adds the server directory to sys.path
+import helpers
+from helpers import Manuscript, Passage
+
+
+MANUSCRIPTS = [
+    (1, 'A',  0),
+    (2, 'MT', 1),
+    (3, '01', 300010),
+    (4, '03', 300030),
+    (5, 'P74', 100740),
+]
+
+PASSAGES = [
+    (1, 50101002, 50101004),
+    (2, 50101006, 50101006),
+    (3, 50102002, 50102010),
+    (4, 50201002, 50201002),
+]
+
+RANGES = [
+    (5, 'All', 1),
+    (5, '1',   2),
+    (5, '2',   3),
+]
+
+
+def make_engine ():
+    """ An in-memory database with the tables the lookups read. """
+
+    # all connections share the same in-memory database
+    engine = sqlalchemy.create_engine ('sqlite://', poolclass = StaticPool,
+                                       connect_args = { 'check_same_thread' : False })
+
+    @sqlalchemy.event.listens_for (engine, 'connect')
+    def connect (dbapi_conn, _record):
+        dbapi_conn.create_function ('adr2bk_id',   1, lambda adr: adr // 10000000)
+        dbapi_conn.create_function ('adr2chapter', 1, lambda adr: adr // 100000 % 100)
+
+    conn = engine.connect ()
+    conn.execute ('CREATE TABLE manuscripts (ms_id INTEGER, hs TEXT, hsnr INTEGER)')
+    conn.execute ('CREATE TABLE passages (pass_id INTEGER, begadr INTEGER, endadr INTEGER)')
+    conn.execute ('CREATE TABLE ranges_view (bk_id INTEGER, range TEXT, rg_id INTEGER)')
+    conn.execute ('INSERT INTO manuscripts VALUES (?, ?, ?)', MANUSCRIPTS)
+    conn.execute ('INSERT INTO passages VALUES (?, ?, ?)', PASSAGES)
+    conn.execute ('INSERT INTO ranges_view VALUES (?, ?, ?)', RANGES)
+    return engine
+
+
+def make_conn ():
+    """ A connection to :func:`make_engine`. """
+
+    return make_engine ().connect ()
+
+
+def make_app ():
+    """ An app with the lookup tables on :func:`make_engine`. """
+
+    app = flask.Flask (__name__)
+    app.config.dba = helpers.Bag ()
+    app.config.dba.engine = make_engine ()
+    helpers.init_app (app)
+    return app
+
+
+def lookup_all (conn):
+    """ Look up every manuscript and passage by every key. """
+
+    result = []
+    for ms_id, hs, hsnr in MANUSCRIPTS + [(9, '02', 300020)]:
+        for key in ('id%d' % ms_id, hs, '%06d' % hsnr):
+            result.append (Manuscript (conn, key).to_json ())
+    for pass_id, begadr, endadr in PASSAGES + [(9, 50301002, 50301004)]:
+        for key in (str (pass_id), '%d-%d' % (begadr, endadr)):
+            passage = Passage (conn, key)
+            result.append ((passage.to_json () if passage.pass_id else None,
+                            passage.range_id ('All'), passage.range_id ('9')))
+    return result
+
+
+def test_lookup_tables (monkeypatch):
+    """ The lookup tables find what the old queries found. """
+
+    monkeypatch.setattr (helpers, 'change_marker', lambda conn, tables: 'marker')
+    conn = make_conn ()
+
+    # outside of an app there are no lookup tables and the queries run
+    expected = lookup_all (conn)
+
+    app = flask.Flask (__name__)
+    helpers.init_app (app)
+    with app.app_context ():
+        assert lookup_all (conn) == expected
+        assert len (app.config.lookup_tables.passages) == 2 * len (PASSAGES)
+
+
+def make_affinity (conn, seed):
+    """ Fill the affinity views with random pairs, with lots of ties. """
+
+    rng = np.random.default_rng (seed)
+    n_mss = 12
+
+    rows = []
+    for rg_id in (1, 2):
+        length = rng.integers (10, 30, n_mss + 1)
+        for i, j in itertools.combinations (range (1, n_mss + 1), 2):
+            common = int (rng.integers (1, 20))
+            affinity = float (rng.choice ([0.5, 0.75, 1.0]))
+            older, newer = rng.integers (0, 4, 2).tolist ()
+            rows.append ((rg_id, i, j, affinity, common, older, newer, int (length[i]), int (length[j])))
+            rows.append ((rg_id, j, i, affinity, common, newer, older, int (length[j]), int (length[i])))
+
+    for view in ('affinity_view', 'affinity_p_view'):
+        conn.execute ('DROP TABLE IF EXISTS %s' % view)
+        conn.execute ('CREATE TABLE %s (rg_id INTEGER, ms_id1 INTEGER, ms_id2 INTEGER, affinity REAL, '
+                      'common INTEGER, older INTEGER, newer INTEGER, '
+                      'ms1_length INTEGER, ms2_length INTEGER)' % view)
+        conn.execute ('INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)' % view, rows)
+    return n_mss
+
+
+def old_textflow_ranks (conn, view, rg_id, exclude, fragments, connectivity):
+    """ The rank query of the old textflow. """
+
+    res = conn.execute (sqlalchemy.text ("""
+    SELECT ms_id1, ms_id2, rank
+    FROM (
+      SELECT ms_id1, ms_id2, rank () OVER (PARTITION BY ms_id1
+         ORDER BY affinity DESC, common, older, newer DESC, ms_id2) AS rank
+      FROM {view} a
+      WHERE a.rg_id = :rg_id AND ms_id2 NOT IN ({exclude})
+        AND newer > older {frag_where}
+    ) AS r
+    WHERE rank <= :connectivity
+    ORDER BY ms_id1, rank
+    """.format (view = view, exclude = ', '.join (map (str, exclude)),
+                frag_where = '' if fragments else 'AND a.common > a.ms1_length / 2')),
+                        dict (rg_id = rg_id, connectivity = connectivity))
+    ranks = {}
+    for ms_id1, ms_id2, rank in res:
+        ranks.setdefault (ms_id1, []).append (ms_id2)
+        assert rank == len (ranks[ms_id1])
+    return ranks
+
+
+def old_congruence_ranks (conn, rg_id, exclude, connectivity):
+    """ The ranked query of the old congruence check. """
+
+    res = conn.execute (sqlalchemy.text ("""
+    SELECT ms_id1, ms_id2, rank
+    FROM (
+      SELECT
+        ms_id1,
+        ms_id2,
+        rank () OVER (PARTITION BY ms_id2 ORDER BY affinity DESC, common, older, newer DESC, ms_id1) AS rank
+      FROM affinity_p_view aff
+      WHERE ms_id1 NOT IN ({exclude})
+        AND ms_id2 NOT IN ({exclude})
+        AND aff.rg_id = :rg_id
+        AND aff.newer < aff.older
+        AND aff.common > aff.ms2_length / 2
+    ) AS r
+    WHERE rank <= 2 * :connectivity
+    ORDER BY ms_id2, rank
+    """.format (exclude = ', '.join (map (str, exclude)))),
+                        dict (rg_id = rg_id, connectivity = connectivity))
+    ranks = {}
+    for ms_id1, ms_id2, rank in res:
+        ranks.setdefault (ms_id2, []).append (ms_id1)
+        assert rank == len (ranks[ms_id2])
+    return ranks
+
+
+def test_affinity_ranks (monkeypatch):
+    """ The cached rankings yield the ranks of the old window queries. """
+
+    monkeypatch.setattr (helpers, 'change_marker', lambda conn, tables: 'marker')
+    conn = make_conn ()
+
+    for seed in range (3):
+        n_mss = make_affinity (conn, seed)
+        ranks = helpers.AffinityRanks ()
+
+        for rg_id in (1, 2):
+            for mode, view in helpers.AffinityRanks.VIEWS.items ():
+                ranking = ranks.get (conn, rg_id, mode)
+                for exclude, fragments, connectivity in ((2, ), True, 5), ((2, 5), False, 3), ((7, ), True, 9999):
+                    old = old_textflow_ranks (conn, view, rg_id, exclude, fragments, connectivity)
+                    for ms_id1 in range (1, n_mss + 1):
+                        assert ranking.ancestors (ms_id1, exclude, fragments, connectivity) == \
+                            old.get (ms_id1, [])
+
+            # the congruence check ranks the rows of the ancestor
+            ranking = ranks.get (conn, rg_id, 'sim', 'ms2')
+            exclude, connectivity = (2, ), 5
+            old = old_congruence_ranks (conn, rg_id, exclude, connectivity)
+            for ms_id2 in range (1, n_mss + 1):
+                if ms_id2 not in exclude:
+                    assert ranking.ancestors (ms_id2, exclude, False, 2 * connectivity) == \
+                        old.get (ms_id2, [])
+
+            # the top matrix of the congruence jobs
+            ms_ids, anc = ranking.top (2 * connectivity, exclude, False)
+            for ms_id2, row in zip (ms_ids.tolist (), anc.tolist ()):
+                assert [a for a in row if a] == old.get (ms_id2, [])
+
+        ranks.invalidate ()
+
+
+def test_render_cache (tmp_path):
+    """ The render cache returns what was put, from memory or from disk. """
+
+    key1, key2, key3 = [helpers.RenderCache.make_key (n, 'dot') for n in (1, 2, 3)]
+    assert len (set ([key1, key2, key3])) == 3
+    assert key1 == helpers.RenderCache.make_key (1, 'dot')
+
+    memory = helpers.RenderCache (2)
+    for key in (key1, key2, key3):
+        memory.put (key, key.encode ())
+    assert memory.get (key1) is None
+    assert memory.get (key3) == key3.encode ()
+
+    # another process sees the entries in the directory
+    cache  = helpers.RenderCache (2, str (tmp_path), max_files = 2)
+    shared = helpers.RenderCache (2, str (tmp_path))
+    for key in (key1, key2, key3):
+        cache.put (key, key.encode ())
+    assert shared.get (key1) == key1.encode ()
+
+    cache.prune ()
+    assert len (list (tmp_path.iterdir ())) == 2
+
+    cache.clear ()
+    assert list (tmp_path.iterdir ()) == []
+    assert cache.get (key3) is None
+
@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+
+""" Tests for the optimal substemma search in server/set_cover.py. """
+
+import collections
+import itertools
+
+import numpy as np
+
+import server # adds the server directory to sys.path
+from set_cover import Combination, _subset_counts, _optimal_substemma, _explain_bits, \
+     _top_combinations
+from ntg_common.cbgm_common import CBGM_Params, pack_bits, popcount
+
+
+MS_ID = 1  # the ms. to explain (numpy index)
+
+Ms = collections.namedtuple ('Ms', 'ms_id hs')
+
+
+def make_params (seed, n_mss = 9, n_passages = 70):
+    """ Build random params and the explain matrix of ms. MS_ID. """
+
+    rng = np.random.default_rng (seed)
+
+    # every ms. reads one of a..d (bits 2..16) or is undefined
+    val = CBGM_Params ()
+    val.n_mss, val.n_passages = n_mss, n_passages
+    val.mask_matrix = (np.uint64 (2) << rng.integers (0, 4, (n_mss, n_passages)).astype (np.uint64))
+    val.mask_matrix[rng.random ((n_mss, n_passages)) < 0.1] = 0
+    val.def_bits = pack_bits (val.mask_matrix > 0)
+
+    # the reading of the ms., some prior readings, and sometimes an unknown source
+    explain_matrix = val.mask_matrix[MS_ID] | rng.integers (0, 32, n_passages).astype (np.uint64)
+    explain_matrix[val.mask_matrix[MS_ID] == 0] = 0
+    return val, explain_matrix
+
+
+def all_combinations (selected):
+    """ All combinations of the selected mss. in the order of the old search. """
+
+    combinations = []
+    i = 0
+    for l in range (len (selected)):
+        for c in itertools.combinations (selected, l + 1):
+            combinations.append (Combination (c, i))
+            i += 1
+    return combinations
+
+
+def mask_of (comb, selected):
+    """ The bitmask of a combination, bit i = selected[i]. """
+
+    return sum (1 << selected.index (ms) for ms in comb.mss)
+
+
+def old_optimal_substemma (val, ms_id, explain_matrix, combinations):
+    """ The old exhaustive search: or the bitsets of every combination. """
+
+    ms_id = ms_id - 1  # numpy indices start at 0
+
+    b_defined = val.def_bits[ms_id]
+    b_common = np.bitwise_and (val.def_bits, b_defined)
+
+    explain_equal_matrix = val.mask_matrix[ms_id]
+
+    b_equal = pack_bits (np.bitwise_and (val.mask_matrix, explain_equal_matrix) > 0)
+    b_equal = np.bitwise_and (b_equal, b_common)
+
+    b_post = pack_bits (np.bitwise_and (val.mask_matrix, explain_matrix) > 0)
+    b_post = np.bitwise_and (b_post, b_common)
+
+    b_source_unknown = np.bitwise_and (explain_matrix, 0x1) > 0
+    b_source_known   = np.logical_and (explain_matrix > 0, np.logical_not (b_source_unknown))
+    b_source_unknown = np.bitwise_and (pack_bits (b_source_unknown), b_defined)
+    b_source_known   = np.bitwise_and (pack_bits (b_source_known),   b_defined)
+
+    for comb in combinations:
+        # pylint: disable=no-member
+        b_explained_equal = np.bitwise_or.reduce (b_equal[comb.vec])
+        b_explained_post  = np.bitwise_or.reduce (b_post[comb.vec])
+        b_explained_post  = np.bitwise_and (b_explained_post, np.invert (b_explained_equal))
+        b_unexplained     = np.invert (np.bitwise_or (b_explained_equal, b_explained_post))
+
+        comb.n_explained_equal = int (popcount (b_explained_equal))
+        comb.n_explained_post  = int (popcount (b_explained_post))
+        comb.n_unknown = int (popcount (np.bitwise_and (b_source_unknown, b_unexplained)))
+        comb.n_open    = int (popcount (np.bitwise_and (b_source_known,   b_unexplained)))
+
+    # add the 'hint' column
+    def key_len (c):
+        return c.len
+
+    def key_explained (c):
+        return -c.explained ()
+
+    for _k, g in itertools.groupby (sorted (combinations, key = key_len), key = key_len):
+        sorted (g, key = key_explained)[0].hint = True
+
+
+def test_subset_counts ():
+    """ The subset-sum engine yields the counts of the old search. """
+
+    for seed in range (5):
+        val, explain_matrix = make_params (seed)
+        selected = [Ms (i + 1, 'ms%d' % (i + 1)) for i in range (val.n_mss) if i != MS_ID]
+        vec = np.array ([s.ms_id - 1 for s in selected], dtype = np.int64)
+
+        equal, post, unknown, open_ = _subset_counts (val, MS_ID + 1, explain_matrix, vec)
+
+        combinations = all_combinations (selected)
+        old_optimal_substemma (val, MS_ID + 1, explain_matrix, combinations)
+
+        for comb in combinations:
+            mask = mask_of (comb, selected)
+            assert (equal[mask], post[mask], unknown[mask], open_[mask]) == \
+                (comb.n_explained_equal, comb.n_explained_post, comb.n_unknown, comb.n_open)
+
+        # the hint marks the first combination of each size that explains most
+        explained = equal + post
+        for l in range (1, len (selected) + 1):
+            masks = [mask_of (c, selected) for c in combinations if c.len == l]
+            hint = [mask_of (c, selected) for c in combinations if c.len == l and c.hint]
+            assert hint == [masks[int (np.argmax (explained[masks]))]]
+
+
+def test_optimal_substemma_detail ():
+    """ The detail view yields the counts of the old search. """
+
+    val, explain_matrix = make_params (0)
+    selected = [Ms (i + 1, 'ms%d' % (i + 1)) for i in range (val.n_mss) if i != MS_ID]
+
+    combinations = all_combinations (selected)
+    old_optimal_substemma (val, MS_ID + 1, explain_matrix, combinations)
+
+    for comb in combinations[::17]:
+        new = Combination (comb.mss, 0)
+        _optimal_substemma (val, MS_ID + 1, explain_matrix, new)
+        assert (new.n_explained_equal, new.n_explained_post, new.n_unknown, new.n_open) == \
+            (comb.n_explained_equal, comb.n_explained_post, comb.n_unknown, comb.n_open)
+        assert len (new.open_indices) == new.n_open
+        assert len (new.unknown_indices) == new.n_unknown
+
+
+def test_top_combinations ():
+    """ The branch-and-bound search finds the best combinations of the
+    exhaustive search, ties in the order of the old search. """
+
+    for seed in range (5):
+        val, explain_matrix = make_params (seed, n_mss = 12, n_passages = 90)
+        vec = np.array ([i for i in range (val.n_mss) if i != MS_ID], dtype = np.int64)
+        n = len (vec)
+
+        b_equal, b_post, _unknown, _known = _explain_bits (val, MS_ID, explain_matrix, vec)
+        b_any = b_equal | b_post
+
+        for k in (1, 3):
+            top = _top_combinations (b_any, k)
+
+            for l in range (1, n + 1):
+                masks = [sum (1 << i for i in c) for c in itertools.combinations (range (n), l)]
+                # pylint: disable=no-member
+                explained = [int (popcount (np.bitwise_or.reduce (
+                    b_any[[i for i in range (n) if m & (1 << i)]]))) for m in masks]
+                order = sorted (range (len (masks)), key = lambda i: -explained[i])
+                assert top[l - 1] == [masks[i] for i in order[:k]]
@@ -0,0 +1,115 @@
+# -*- encoding: utf-8 -*-
+
+""" Tests for server/textflow.py.
+
+The textflow module needs flask_user.  The tests are skipped without it.
+
+"""
+
+import networkx as nx
+import pytest
+
+import server # adds the server directory to sys.path
+import helpers
+
+from test_helpers import make_app
+
+textflow = pytest.importorskip ('textflow', reason = 'needs flask_user')
+
+
+def test_render_textflow (monkeypatch):
+    """ A cached global textflow is the same as a freshly rendered one. """
+
+    layouts = []
+    marker = ['marker']
+
+    def layout (dot, format = 'dot'):
+        layouts.append (dot)
+        return ('%s %s' % (format, dot)).encode ()
+
+    monkeypatch.setattr (textflow, 'textflow', lambda passage_or_id: 'digraph { %s }' % passage_or_id)
+    monkeypatch.setattr (textflow.tools, 'graphviz_layout', layout)
+    monkeypatch.setattr (textflow, 'change_marker', lambda conn, tables: marker[0])
+    monkeypatch.setattr (helpers, 'change_marker', lambda conn, tables: 'marker')
+
+    app = make_app ()
+    textflow.init_app (app)
+
+    for url, cached in (('/textflow.dot/1?rg_id=2', True), ('/textflow.dot/1?labez=a', False)):
+        with app.test_request_context (url):
+            # the old implementation
+            expected = layout (textflow.textflow (1))
+            del layouts[:]
+
+            assert textflow.render_textflow (1) == expected
+            assert textflow.render_textflow (1) == expected
+            assert len (layouts) == (1 if cached else 2)
+            assert textflow.render_textflow (1, 'png') == layout (textflow.textflow (1), 'png')
+
+            # a change of the data gives a new key
+            del layouts[:]
+            marker[0] = 'changed ' + url
+            assert textflow.render_textflow (1) == expected
+            assert len (layouts) == 1
+
+
+def test_stemma (monkeypatch):
+    """ A cached local stemma is the same as a freshly laid out one, and a
+    client with the current version gets a 304. """
+
+    layouts = []
+    revision = ['r1']
+    edges = [('*', 'a1'), ('a1', 'b1')]
+
+    def layout (dot, format = 'dot'):
+        layouts.append (dot)
+        return ('%s %s' % (format, dot)).encode ()
+
+    def local_stemma_to_nx (_conn, _pass_id, _add_isolated_roots = False):
+        graph = nx.DiGraph ()
+        for u, v in edges:
+            graph.add_edge (u, v)
+        for n in graph:
+            graph.nodes[n]['label'] = n
+        return graph
+
+    monkeypatch.setattr (textflow, 'user_can_write', lambda app: False)
+    monkeypatch.setattr (textflow, 'locstem_revision', lambda conn, pass_id: revision[0])
+    monkeypatch.setattr (textflow.db_tools, 'local_stemma_to_nx', local_stemma_to_nx)
+    monkeypatch.setattr (textflow.tools, 'graphviz_layout', layout)
+    monkeypatch.setattr (helpers, 'change_marker', lambda conn, tables: 'marker')
+
+    app = make_app ()
+    textflow.init_app (app)
+
+    def old_stemma (format = 'dot'):
+        graph = local_stemma_to_nx (None, 1, False)
+        return layout (helpers.nx_to_dot (graph, 500.0, 10.0, nodesep = 0.2), format = format)
+
+    with app.test_request_context ('/stemma.dot/1?width=500'):
+        expected = old_stemma ()
+        del layouts[:]
+
+        etag, data = textflow.stemma (1)
+        assert data == expected
+        assert textflow.stemma (1) == (etag, expected)
+        assert len (layouts) == 1
+
+        etag_png, data = textflow.stemma (1, 'png')
+        assert data == old_stemma ('png')
+        assert etag_png != etag
+
+    with app.test_request_context ('/stemma.dot/1?width=500', headers = { 'If-None-Match' : '"%s"' % etag }):
+        assert textflow.stemma (1) == (etag, None)
+
+        response = textflow.make_stemma_response (etag, None, None)
+        assert response.status_code == 304
+        assert response.get_etag () == (etag, False)
+        assert response.headers['Cache-Control'] == 'private, no-cache'
+
+        # an edit gives a new revision
+        revision[0] = 'r2'
+        edges.append (('a1', 'c1'))
+        etag2, data = textflow.stemma (1)
+        assert etag2 != etag
+        assert data == old_stemma ()